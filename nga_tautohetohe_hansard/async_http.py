@@ -0,0 +1,227 @@
+# import libraries
+import asyncio
+import ssl
+import time
+import zlib
+from urllib.parse import urlsplit, urljoin
+from nga_tautohetohe_hansard.metrics import metrics
+from nga_tautohetohe_hansard.rate_limiter import AdaptiveRateLimiter
+
+user_agent = 'nga-tautohetohe/1.0'
+max_redirects = 5
+
+
+class HTTPError(Exception):
+    """Raised when a server answers with an error status that is worth retrying."""
+
+    def __init__(self, url, status, reason=''):
+        super().__init__(f'HTTP Error {status}: {reason} ({url})')
+        self.url = url
+        self.status = status
+
+
+class Response:
+    """This class stores the status, headers and decoded body of a completed request."""
+
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def text(self, encoding='utf8'):
+        return self.body.decode(encoding, errors='replace')
+
+
+class AsyncHTTPClient:
+    """Minimal asyncio HTTP/1.1 client which reuses keep-alive connections, caps the number of requests in flight
+    and paces each host independently with an adaptive rate limiter."""
+
+    def __init__(self, max_in_flight=100, timeout=60, retries=None, limiter=None, cache=None, max_age=None):
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.retries = retries  # None retries forever, like download_soup
+        self.limiter = limiter or AdaptiveRateLimiter()
+        self.ssl_context = ssl.create_default_context()
+        self.cache = cache  # Optional http_cache.ResponseCache
+        self.max_age = max_age
+        self.requests = self.errors = 0
+        self.__semaphore = None
+        self.__idle = {}  # (scheme, host, port) -> list of idle (reader, writer) pairs
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def get(self, url, headers=None):
+        # Serve the url from the response cache when fresh, otherwise fetch and revalidate.
+        # The cache reads and writes SQLite and gzip files, so it is used from the executor to keep the event loop
+        # free for the requests in flight:
+        loop = asyncio.get_running_loop()
+        entry = await loop.run_in_executor(None, self.cache.lookup, url) if self.cache else None
+        if entry and self.cache.is_fresh(entry, self.max_age):
+            metrics.count('cache_hits', host=urlsplit(url).netloc)
+            return Response(url, 200, {}, await loop.run_in_executor(None, self.cache.load, entry))
+        if self.cache:
+            headers = {**self.cache.conditional_headers(entry), **(headers or {})}
+
+        response = await self.__get(url, headers)
+        if self.cache:
+            if response.status == 304 and entry:
+                body = await loop.run_in_executor(None, self.cache.load, entry, True)
+                return Response(url, 200, response.headers, body)
+            if response.status == 200:
+                await loop.run_in_executor(None, self.cache.store, url, response.body, response.headers)
+        return response
+
+    async def __get(self, url, headers):
+        # Fetch a url, retrying and slowing the host down on connection errors, bodies that fail to decompress,
+        # 429s and 5xx responses:
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.max_in_flight)
+        host = urlsplit(url).netloc
+        attempt = 0
+        while True:
+            await self.limiter.acquire_async(host)
+            try:
+                async with self.__semaphore:
+                    t = time.perf_counter()
+                    response = await self.__fetch(url, headers or {})
+                    metrics.observe('fetch_latency_seconds', time.perf_counter() - t, host=host)
+                if response.status == 429 or response.status >= 500:
+                    retry_after = response.headers.get('retry-after', '')
+                    self.limiter.record(host, response.status,
+                                        retry_after=int(retry_after) if retry_after.isdigit() else None)
+                    raise HTTPError(response.url, response.status)
+                self.limiter.record(host, response.status)
+                self.requests += 1
+                metrics.count('bytes_fetched', len(response.body), host=host)
+                return response
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, HTTPError, ValueError,
+                    zlib.error) as exception:
+                if not isinstance(exception, HTTPError):
+                    self.limiter.record(host, error=exception)
+                self.errors += 1
+                metrics.count('fetch_retries', host=host)
+                attempt += 1
+                print(exception, f'\nSlowed {host} to {self.limiter.rate(host)} requests/s,',
+                      f'attempting to retrieve: {url}')
+                if self.retries is not None and attempt > self.retries:
+                    raise
+
+    async def close(self):
+        for connections in self.__idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.__idle.clear()
+
+    async def __fetch(self, url, headers):
+        for _ in range(max_redirects + 1):
+            response = await asyncio.wait_for(self.__request(url, headers), self.timeout)
+            if response.status in (301, 302, 303, 307, 308) and 'location' in response.headers:
+                url = urljoin(url, response.headers['location'])
+            else:
+                return response
+        raise HTTPError(url, response.status, 'Too many redirects')
+
+    async def __request(self, url, headers):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path = f'{path}?{parts.query}'
+        lines = [f'GET {path} HTTP/1.1', f'Host: {parts.netloc}', f'User-Agent: {user_agent}',
+                 'Accept-Encoding: gzip, deflate', 'Connection: keep-alive']
+        lines.extend(f'{k}: {v}' for k, v in headers.items())
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        # Try an idle keep-alive connection first, falling back to a fresh one if the server has dropped it:
+        while True:
+            reused = bool(self.__idle.get(key))
+            if reused:
+                reader, writer = self.__idle[key].pop()
+            else:
+                reader, writer = await asyncio.open_connection(
+                    parts.hostname, port, ssl=self.ssl_context if parts.scheme == 'https' else None)
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, reason, response_headers, body, keep_alive = await read_response(reader)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            break
+
+        if keep_alive:
+            self.__idle.setdefault(key, []).append((reader, writer))
+        else:
+            writer.close()
+
+        encoding = response_headers.get('content-encoding', '')
+        if encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            # Some servers send raw deflate data without the zlib header:
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:
+                body = zlib.decompress(body, -zlib.MAX_WBITS)
+        return Response(url, status, response_headers, body)
+
+
+async def read_response(reader):
+    # Parse a HTTP/1.1 response, returning whether the connection can be reused:
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError('Connection closed by server')
+    version, status, *reason = status_line.decode('latin-1').split(' ', 2)
+    if not version.startswith('HTTP/'):
+        raise ValueError(f'Bad status line: {status_line!r}')
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        k, _, v = line.decode('latin-1').partition(':')
+        headers[k.strip().lower()] = v.strip()
+
+    keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                # Skip trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    elif int(status) in (204, 304) or 100 <= int(status) < 200:
+        body = b''
+    else:
+        body = await reader.read()
+        keep_alive = False
+
+    return int(status), reason[0].strip() if reason else '', headers, body, keep_alive
+
+
+def fetch_all(urls, **kwargs):
+    # Synchronous entry point: download a list of urls concurrently and return the responses in order.
+    async def fetch():
+        async with AsyncHTTPClient(**kwargs) as client:
+            return await asyncio.gather(*(client.get(url) for url in urls))
+
+    return asyncio.run(fetch())
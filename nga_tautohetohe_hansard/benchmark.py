@@ -0,0 +1,342 @@
+# import libraries
+import json
+import os
+import platform
+import random
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+from multiprocessing import get_context
+from os import makedirs
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+import taumahi
+from nga_tautohetohe_hansard import html_scraper, ocr_text_cleaner, pdf_scraper
+from nga_tautohetohe_hansard.kupu_cache import kupu_cache
+from nga_tautohetohe_hansard.page_store import open_pages, write_page_store
+from nga_tautohetohe_hansard.versioning import extractor_fingerprint
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+manifest_filename = 'fixtures.json'
+results_dir = 'benchmarks'
+# Each benchmark is timed this many times and the fastest run is kept:
+repeat = 3
+# A benchmark more than this fraction slower than the previous results is reported as a regression:
+regression_threshold = 0.1
+# Size of the generated fixtures, the same seed always generates the same fixtures:
+seed = 1
+ocr_pages = 150
+pdf_days = 6
+html_debates = 20
+kupu_sentences = 20000
+
+# Vocabulary of the generated fixtures:
+reo_sentences = ['Tēnā koe e te Mana Whakawā, ko au te tangata whenua o tēnei rohe.', 'Kia ora koutou katoa.',
+                 'Ko te mea nui o te ao, he tangata, he tangata, he tangata.', 'Ka nui te mihi ki a rātou mā.',
+                 'E kore au e ngaro, he kākano i ruia mai i Rangiātea.', 'Me whakarongo tātou ki ngā kōrero.']
+english_sentences = ['The honourable member moved the second reading of the Bill.',
+                     'He thought the Government should give the matter further consideration.',
+                     'The question was put, that the words proposed to be struck out stand part of the question.',
+                     'I thank the Minister for his reply, but the answer does not address the problem.',
+                     'The House adjourned at half-past five o\'clock.', 'Motion agreed to.',
+                     'That is not what the member said at all [Interruption] and he knows it.']
+names = ['FOX', 'STAFFORD', 'TAIAROA', 'KATENE', 'NGATA', 'POMARE', 'WETERE', 'TIRIKATENE']
+weekdays = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']
+month_names = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+               'November', 'December']
+
+
+def paragraph(rng, reo_share=0.3):
+    return ' '.join(rng.choice(reo_sentences if rng.random() < reo_share else english_sentences)
+                    for _ in range(rng.randint(1, 7)))
+
+
+def ocr_volume(rng, name, year, pages=ocr_pages):
+    # Pages of a Hathi volume, in the narrative style before volume 410 or the quoted style after it:
+    quoted = int(name) >= 410
+    rows, day = [], 1
+    for page in range(1, pages + 1):
+        text = f'{page} HOUSE OF REPRESENTATIVES. [{day} {month_names[6]}\n'
+        for _ in range(rng.randint(3, 7)):
+            if rng.random() < 0.08 and day < 28:
+                day += 1
+                weekday = rng.choice(weekdays)
+                text += f'\n{weekday}, {day} July {year}\n' if int(name) >= 294 else \
+                    f'\n{weekday}, {day}th July, {year}.\n'
+            if rng.random() < 0.05:
+                text += f'AYES, {rng.randint(10, 40)}\n' + ', '.join(rng.sample(names, 4)).title() + '.\n'
+            if rng.random() < 0.3:
+                speaker = f'Mr. {rng.choice(names)}'
+                text += f'{speaker}: ' if quoted else f'{speaker} said, '
+            words = paragraph(rng).split(' ')
+            if rng.random() < 0.2:
+                # Words hyphenated across line breaks:
+                i = rng.randrange(len(words))
+                words[i] = f'{words[i][:2]}-\n{words[i][2:]}'
+            text += ' '.join(words) + '\n\n'
+        rows.append({'retrieved': '2018-01-01 00:00:00', 'url': f'/cgi/pt?id=mdp.39015{name};seq={page + 10}',
+                     'page': str(page), 'text': text})
+    return rows
+
+
+def pdf_volume(rng, days=pdf_days):
+    # Text of a volume as pdftotext writes it, with form feeds between pages:
+    text, day = 'HANSARD\n\n', 1
+    for _ in range(days):
+        day += rng.randint(1, 3)
+        text += f'{rng.choice(weekdays).upper()}, {day} MARCH 1990\n\nThe House met at 2 p.m.\n\n'
+        for _ in range(rng.randint(150, 400)):
+            if rng.random() < 0.2:
+                text += rng.choice(['Hon. KORO WETERE:', 'Mr PETERS (Tauranga):', 'Hon. Margaret Shields:',
+                                    'TAU HENARE:', 'Mr SPEAKER:']) + ' '
+            text += paragraph(rng) + '\n\n'
+            if rng.random() < 0.05:
+                text += f'\n{day} March 1990 Hansard\n\n\f'
+    return text
+
+
+def html_debate(rng, n):
+    # A debate page and its metadata page as parliament.nz serves them:
+    doc_id = f'{48 + n % 3}HansD_2005{n % 12 + 1:02}{n % 28 + 1:02}_000000{n:02}' if n % 2 else \
+        f'HansS_2005{n % 12 + 1:02}{n % 28 + 1:02}_000000{n:02}'
+    url = f'/en/pb/hansard-debates/rhr/document/{doc_id}/debate-{n}'
+    sections = []
+    for _ in range(rng.randint(3, 8)):
+        paragraphs = []
+        for i in range(rng.randint(5, 25)):
+            # Sections open with a speaker, as debates do:
+            speaker = f'<strong>{rng.choice(names).title()} (Labour):</strong> ' if not i or rng.random() < 0.3 else ''
+            paragraphs.append(f'<p class="a">{speaker}{paragraph(rng, 0.2)}</p>')
+        sections.append('<div class="section">{}</div>'.format(''.join(paragraphs)))
+    body = '<div class="Hansard">{}</div>' if doc_id[0].isdigit() else '<div class="section">{}</div>'
+    debate = '<html><head><title>Debate</title></head><body><nav><ul><li><a href="/">Home</a></li></ul></nav>' \
+             f'{body.format("".join(sections))}</body></html>'
+    metadata = '<html><body><table>' + ''.join(f'<tr><th>{k}</th><td>{v}</td></tr>' for k, v in [
+        ('Ref', f'Volume {628 + n % 3}; Page {n * 10}'), ('Date', f'{n % 28 + 1:02} {month_names[n % 12][:3]} 2005'),
+        ('Short title', f'Debate {n}')]) + '</table></body></html>'
+    return url, debate, metadata
+
+
+def write_fixtures(directory, seed=seed):
+    # Generate a set of fixtures with a manifest describing them:
+    rng = random.Random(seed)
+    for format in ['ocr', 'pdf', 'html']:
+        makedirs(join(directory, format), exist_ok=True)
+    manifest = {'seed': seed, 'ocr': [], 'pdf': [], 'html': []}
+
+    for name, year in [('120', 1875), ('300', 1953), ('420', 1978)]:
+        f = f'ocr/{name}.pages'
+        write_page_store(join(directory, f), ocr_volume(rng, name, year))
+        manifest['ocr'].append({'file': f, 'volume': {'name': name, 'url': f'/cgi/pt?id=mdp.39015{name}',
+                                                      'period': f'1 July {year}', 'retrieved': '2018-01-01'}})
+    for name in ['520', '521']:
+        f = f'pdf/Hansard {name}.txt'
+        with open(join(directory, f), 'w', newline='', encoding='utf8') as txt:
+            txt.write(pdf_volume(rng))
+        manifest['pdf'].append({'file': f, 'volume': {'name': name, 'url': f'/hansard/{name}.pdf'}})
+    for n in range(html_debates):
+        url, debate, metadata = html_debate(rng, n)
+        f = f'html/{n}'
+        for suffix, markup in [('.html', debate), ('.metadata.html', metadata)]:
+            with open(join(directory, f + suffix), 'w', encoding='utf8') as page:
+                page.write(markup)
+        manifest['html'].append({'url': url, 'debate': f'{f}.html', 'metadata': f'{f}.metadata.html'})
+
+    with open(join(directory, manifest_filename), 'w', encoding='utf8') as m:
+        json.dump(manifest, m, ensure_ascii=False, indent=1)
+    return manifest
+
+
+def read_fixtures(directory):
+    # Recorded fixtures, e.g. real volumes and debates, are used by listing them in a manifest of the same form:
+    with open(join(directory, manifest_filename), encoding='utf8') as m:
+        return json.load(m)
+
+
+def bench_ocr(directory, manifest):
+    ocr_text_cleaner.indir = directory
+    volumes = [(fixture['file'], fixture['volume']) for fixture in manifest['ocr']]
+    pages = [page['text'] for f, v in volumes for page in open_pages(join(directory, f))]
+
+    def run():
+        for f, v in volumes:
+            ocr_text_cleaner.Volume(f, v).process_pages()
+
+    return timed(run, len(pages), 'pages', text_bytes(pages))
+
+
+def bench_pdf(directory, manifest):
+    texts, pages = [], 0
+    for fixture in manifest['pdf']:
+        with open(join(directory, fixture['file']), encoding='utf8') as txt:
+            pages += txt.read().count('\f') + 1
+        texts.append(pdf_scraper.read_volume_text(join(directory, fixture['file'])))
+
+    def run():
+        for text in texts:
+            for date, speeches in pdf_scraper.get_daily_debates(text):
+                pass
+
+    return timed(run, pages, 'pages', text_bytes(texts))
+
+
+def bench_html(directory, manifest):
+    debates = []
+    for fixture in manifest['html']:
+        with open(join(directory, fixture['debate']), encoding='utf8') as d, \
+                open(join(directory, fixture['metadata']), encoding='utf8') as m:
+            debates.append((fixture['url'], (f'{html_scraper.hansard_url}{fixture["url"]}', None, d.read(),
+                                             m.read())))
+
+    def run():
+        # horoi_transcript_factory changes the soup, so each run parses the pages again untimed:
+        scrapers = [html_scraper.HansardTuhingaScraper(url, pages) for url, pages in debates]
+        t = time.perf_counter()
+        for scraper in scrapers:
+            scraper.horoi_transcript_factory()
+        return time.perf_counter() - t
+
+    return timed(run, len(debates), 'debates', text_bytes(p for _, pages in debates for p in pages[2:]))
+
+
+def fixture_sentences(directory, manifest):
+    # Sentences of the OCR and PDF fixtures:
+    texts = [page['text'] for fixture in manifest['ocr'] for page in open_pages(join(directory, fixture['file']))]
+    texts += [pdf_scraper.read_volume_text(join(directory, fixture['file'])) for fixture in manifest['pdf']]
+    sentences = []
+    for text in texts:
+        sentences.extend(s for s in taumahi.new_sentence.split(text) if s.strip())
+    return sentences[:kupu_sentences]
+
+
+def bench_kupu_ratios(directory, manifest):
+    # The sentences classified by taumahi without the cache:
+    sentences = fixture_sentences(directory, manifest)
+
+    def run():
+        for sentence in sentences:
+            taumahi.kupu_ratios(sentence, tohutō=False)
+
+    return timed(run, len(sentences), 'sentences', text_bytes(sentences))
+
+
+def bench_kupu_cache(directory, manifest):
+    # The same sentences classified through the word cache, starting empty, with the share of words and sentences
+    # it answered:
+    sentences = fixture_sentences(directory, manifest)
+
+    def run():
+        for sentence in sentences:
+            kupu_cache.kupu_ratios(sentence, tohutō=False)
+
+    result = timed(run, len(sentences), 'sentences', text_bytes(sentences))
+    result['word hit rate'] = kupu_cache.stats()['hit rate']
+    result['sentence hit rate'] = round(100 - 100 * len(kupu_cache.decisions) / len(sentences), 2) if sentences else 0
+    return result
+
+
+benchmarks = {
+    'OCR Volume.process_pages': bench_ocr,
+    'PDF get_daily_debates': bench_pdf,
+    'HTML horoi_transcript_factory': bench_html,
+    'kupu_ratios': bench_kupu_ratios,
+    'kupu_cache': bench_kupu_cache,
+}
+
+
+def timed(run, items, unit, size):
+    # Keep the fastest of the runs, each starting from an empty kupu cache as a fresh run would.
+    # A run can return its own timing to leave out setup that can't be done beforehand:
+    best = None
+    for _ in range(repeat):
+        kupu_cache.clear()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            t = time.perf_counter()
+            elapsed = run()
+            elapsed = time.perf_counter() - t if elapsed is None else elapsed
+        best = elapsed if best is None or elapsed < best else best
+    return {'items': items, 'unit': unit, 'bytes': size, 'seconds': round(best, 4),
+            'rate': round(items / best, 1) if best else 0, 'MB/s': round(size / best / 1e6, 3) if best else 0}
+
+
+def text_bytes(texts):
+    return sum(len(text.encode('utf8')) for text in texts)
+
+
+def peak_rss():
+    # Peak resident memory of this process in MB, ru_maxrss is in kilobytes on linux and bytes on macOS:
+    if not resource:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(maxrss / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+def run_benchmark(name, directory):
+    # Runs in a fresh process so the peak memory is that of this benchmark alone:
+    result = benchmarks[name](directory, read_fixtures(directory))
+    result['peak RSS MB'] = peak_rss()
+    return result
+
+
+def run_benchmarks(directory, names=None):
+    results = {}
+    for name in names or benchmarks:
+        print(f'Benchmarking {name}')
+        with get_context('spawn').Pool(1) as pool:
+            results[name] = pool.apply(run_benchmark, (name, directory))
+        print(f'{name}: {results[name]["rate"]} {results[name]["unit"]}/s, {results[name]["MB/s"]} MB/s, '
+              f'peak RSS {results[name]["peak RSS MB"]} MB')
+    return results
+
+
+def compare(previous, results, threshold=regression_threshold):
+    # Returns the benchmarks that got slower than the threshold allows, printing the change in each:
+    regressions = []
+    for name, result in results.items():
+        before = previous.get('results', {}).get(name)
+        if not before or not before['rate']:
+            continue
+        change = result['rate'] / before['rate'] - 1
+        print(f'{name}: {before["rate"]} -> {result["rate"]} {result["unit"]}/s ({change:+.1%})')
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    # Usage: python -m nga_tautohetohe_hansard.benchmark [fixtures directory] [previous results json]
+    # Fixtures are generated into the directory if it doesn't have a manifest, and kept for later runs:
+    directory = sys.argv[1] if len(sys.argv) > 1 else None
+    with TemporaryDirectory() as temporary:
+        directory = directory or temporary
+        if not exists(join(directory, manifest_filename)):
+            print(f'Generating fixtures in {directory}')
+            write_fixtures(directory)
+        results = run_benchmarks(directory)
+
+    report = {'created': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'fixtures': sys.argv[1] if len(sys.argv) > 1 else f'seed {seed}',
+              'extractors': {'OCR': extractor_fingerprint(ocr_text_cleaner, ocr_text_cleaner.extractor_version),
+                             'PDF': extractor_fingerprint(pdf_scraper, pdf_scraper.extractor_version)},
+              'results': results}
+    makedirs(results_dir, exist_ok=True)
+    filename = join(results_dir, f'{datetime.now():%Y%m%d-%H%M%S}.json')
+    with open(filename, 'w', encoding='utf8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print(f'Results saved to {filename}')
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], encoding='utf8') as f:
+            regressions = compare(json.load(f), results)
+        if regressions:
+            print(f'Slower than {sys.argv[2]} by more than {regression_threshold:.0%}:', ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+# import libraries
+import csv
+import os
+import re
+import shutil
+import sys
+from os import fsync, listdir, makedirs, remove, replace
+from os.path import exists, join
+from threading import Lock
+from nga_tautohetohe_hansard.metrics import metrics
+
+rāindexfilename = 'hansardrāindex.csv'
+corpusfilename = 'hansardreomāori.csv'
+rāindex_fieldnames = ['retrieved', 'url', 'volume', 'format', 'date1', 'date2', 'reo', 'ambiguous', 'other', 'percent',
+                      'incomplete']
+reo_fieldnames = ['url', 'volume', 'format', 'date1', 'date2', 'utterance', 'speaker', 'reo', 'ambiguous', 'other',
+                  'percent', 'text']
+
+# Each volume or HTML debate is written to its own pair of csvs under processed/<format>/,
+# which merge_partitions concatenates into the combined corpus and day index:
+partition_dir = 'processed'
+formats = ['OCR', 'PDF', 'HTML']
+partition_lock = Lock()
+
+# Rows held in memory before they are handed to the open files:
+buffer_rows = 1000
+# Each batch of rows is written and flushed while holding this lock, so sinks appending to the same file can't
+# interleave their rows:
+write_lock = Lock()
+
+
+class CorpusSink:
+    """This class keeps the te reo corpus and day index csvs open for appending and buffers rows between checkpoints.
+    A checkpoint writes out the buffered rows and fsyncs both files, so a volume or day can be marked as done as
+    soon as checkpoint() returns."""
+
+    def __init__(self, corpus_filename=corpusfilename, dayindex_filename=rāindexfilename):
+        self.corpus_file = open_csv(corpus_filename, reo_fieldnames)
+        self.dayindex_file = open_csv(dayindex_filename, rāindex_fieldnames)
+        self.corpus_writer = csv.DictWriter(self.corpus_file, reo_fieldnames)
+        self.dayindex_writer = csv.DictWriter(self.dayindex_file, rāindex_fieldnames)
+        self.corpus_rows, self.day_rows = [], []
+        self.rows_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_corpus_rows(self, rows):
+        self.corpus_rows.extend(rows)
+        if len(self.corpus_rows) >= buffer_rows:
+            self.flush()
+
+    def write_day_rows(self, rows):
+        self.day_rows.extend(rows)
+        if len(self.day_rows) >= buffer_rows:
+            self.flush()
+
+    def flush(self):
+        with write_lock:
+            self.corpus_writer.writerows(self.corpus_rows)
+            self.dayindex_writer.writerows(self.day_rows)
+            self.corpus_file.flush()
+            self.dayindex_file.flush()
+        self.rows_written += len(self.corpus_rows) + len(self.day_rows)
+        metrics.count('rows_written', len(self.corpus_rows), output='merged', kind='corpus')
+        metrics.count('rows_written', len(self.day_rows), output='merged', kind='days')
+        self.corpus_rows, self.day_rows = [], []
+
+    def checkpoint(self):
+        # Make everything written so far durable before the caller records its progress:
+        self.flush()
+        for f in (self.corpus_file, self.dayindex_file):
+            f.flush()
+            fsync(f.fileno())
+
+    def close(self):
+        if not self.corpus_file.closed:
+            self.checkpoint()
+            self.corpus_file.close()
+            self.dayindex_file.close()
+
+
+def open_csv(filename, fieldnames):
+    # Open a csv for appending, writing its header first if it is new:
+    with write_lock:
+        new = not exists(filename)
+        f = open(filename, 'a', newline='', encoding='utf8')
+        if new:
+            csv.DictWriter(f, fieldnames).writeheader()
+            f.flush()
+    return f
+
+
+def partition_path(format, name, directory=partition_dir):
+    # Volume names can hold characters that aren't safe in file names, e.g. combined volumes:
+    return join(directory, format, re.sub(r'[^\w .-]', '_', name))
+
+
+def write_partition(format, name, day_rows, corpus_rows, directory=partition_dir):
+    # Replace the rows of one volume or debate. Each file is written beside its old version and renamed over it,
+    # so replacing a volume costs no more than writing it. The partition is durable once this returns:
+    path = partition_path(format, name, directory)
+    makedirs(join(directory, format), exist_ok=True)
+    for suffix, fieldnames, rows in (('.days.csv', rāindex_fieldnames, day_rows),
+                                     ('.corpus.csv', reo_fieldnames, corpus_rows)):
+        with open(f'{path}{suffix}.tmp', 'w', newline='', encoding='utf8') as f:
+            writer = csv.DictWriter(f, fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+            f.flush()
+            fsync(f.fileno())
+        replace(f'{path}{suffix}.tmp', f'{path}{suffix}')
+        metrics.count('rows_written', len(rows), output='partition', kind=suffix.split('.')[1], format=format)
+
+
+def partition_exists(format, name, directory=partition_dir):
+    path = partition_path(format, name, directory)
+    return exists(f'{path}.days.csv') and exists(f'{path}.corpus.csv')
+
+
+def read_partition(path, suffix):
+    with open(f'{path}{suffix}', 'r', newline='', encoding='utf8') as f:
+        yield from csv.DictReader(f)
+
+
+def partition_order(directory=partition_dir):
+    # Returns the path of every partition in volume order, OCR then PDF volumes in the order of the volume index,
+    # then HTML debates in date order:
+    from nga_tautohetohe_hansard.state_store import get_store
+    store = get_store()
+    positions = {name: i for i, name in enumerate(row['name'] for row in store.volume_rows())}
+    paths = []
+    for rank, format in enumerate(formats):
+        folder = join(directory, format)
+        if not exists(folder):
+            continue
+        names = [f[:-len('.days.csv')] for f in listdir(folder) if f.endswith('.days.csv')]
+        if format == 'HTML':
+            keys = {name: debate_order(join(folder, name)) for name in names}
+        else:
+            index = {partition_path(format, name, directory): i for name, i in positions.items()}
+            keys = {name: (index.get(join(folder, name), len(index)), name) for name in names}
+        paths.extend(join(folder, name) for name in sorted(names, key=keys.get))
+    return paths
+
+
+def debate_order(path):
+    # Sort key of an HTML debate, from the numeric date of its day row:
+    for row in read_partition(path, '.days.csv'):
+        date = re.match(r'(\d+)-(\d+)-(\d+)', row['date2'] or '')
+        if date:
+            return tuple(int(d) for d in date.groups()), path
+    return (0, 0, 0), path
+
+
+def merge_partitions(corpus_filename=corpusfilename, dayindex_filename=rāindexfilename, directory=partition_dir):
+    # Build the combined corpus and day index by streaming each partition in order into new files,
+    # which replace the old ones once they are complete:
+    paths = partition_order(directory)
+    with partition_lock:
+        for filename in (corpus_filename, dayindex_filename):
+            if exists(f'{filename}.tmp'):
+                remove(f'{filename}.tmp')
+        with CorpusSink(f'{corpus_filename}.tmp', f'{dayindex_filename}.tmp') as sink:
+            for path in paths:
+                sink.write_day_rows(read_partition(path, '.days.csv'))
+                sink.write_corpus_rows(read_partition(path, '.corpus.csv'))
+        rows = sink.rows_written
+        replace(f'{corpus_filename}.tmp', corpus_filename)
+        replace(f'{dayindex_filename}.tmp', dayindex_filename)
+    print(f'Merged {len(paths)} partitions, {rows} rows, into {corpus_filename} and {dayindex_filename}')
+
+
+def split_combined_files(corpus_filename=corpusfilename, dayindex_filename=rāindexfilename, directory=partition_dir):
+    # A corpus built before outputs were partitioned is split into partitions the first time, so merging keeps it:
+    with partition_lock:
+        if exists(directory) or not exists(dayindex_filename):
+            return
+        print(f'Splitting {corpus_filename} and {dayindex_filename} into partitions under {directory}')
+        shutil.rmtree(f'{directory}.tmp', ignore_errors=True)
+        partitions = {}
+        for filename, i in ((dayindex_filename, 0), (corpus_filename, 1)):
+            if exists(filename):
+                with open(filename, 'r', newline='', encoding='utf8') as f:
+                    for row in csv.DictReader(f):
+                        key = (row['format'], document_id(row['url']) if row['format'] == 'HTML' else row['volume'])
+                        partitions.setdefault(key, ([], []))[i].append(row)
+        for (format, name), (day_rows, corpus_rows) in partitions.items():
+            write_partition(format, name, day_rows, corpus_rows, f'{directory}.tmp')
+        makedirs(f'{directory}.tmp', exist_ok=True)
+        replace(f'{directory}.tmp', directory)
+
+
+def document_id(url):
+    # The id of an HTML debate, from either its rhr or its document url:
+    match = re.search(r'/document/([^/]+)', url)
+    return match.group(1) if match else url.rstrip('/').rsplit('/', 1)[-1]
+
+
+def reset_after_fork():
+    # Threads writing HTML debates may have held a lock when an extraction pool forked, so the child starts with
+    # new ones:
+    global partition_lock, write_lock
+    partition_lock = Lock()
+    write_lock = Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def main():
+    # Usage: python -m nga_tautohetohe_hansard.corpus_writer
+    split_combined_files()
+    merge_partitions(*sys.argv[1:3])
+    metrics.export()
+
+
+if __name__ == '__main__':
+    main()
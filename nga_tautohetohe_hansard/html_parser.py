@@ -0,0 +1,111 @@
+# import libraries
+import gzip
+import sys
+import time
+from os import listdir
+from os.path import isdir, join
+from bs4 import BeautifulSoup as bs, SoupStrainer
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+# BeautifulSoup tree builder, lxml is several times faster than the pure python html.parser when it is installed:
+soup_backend = 'lxml' if lxml else 'html.parser'
+# Use lxml directly for Hathi pages, which only need the page text and the page anchors:
+hathi_fast_path = bool(lxml)
+
+# Only these parts of each page are kept when parsing:
+hathi_page_strainer = SoupStrainer(id='mdpPage')
+strainers = {
+    'hathi page': hathi_page_strainer,
+    'debate': SoupStrainer('div', class_=('section', 'Hansard')),
+    'metadata': SoupStrainer('table'),
+    'rhr listing': SoupStrainer(['ul', 'li']),
+}
+
+
+def make_soup(markup, only=None, backend=None):
+    # Parse markup with the configured backend, keeping only the subtrees matched by the named strainer:
+    return bs(markup, backend or soup_backend, parse_only=strainers[only] if only else None)
+
+
+def hathi_page(markup, fast=None):
+    # Returns whether a Hathi page has a text div, the string it holds, or None, and the (text, href) pairs of the
+    # anchors in the page div:
+    if hathi_fast_path if fast is None else fast:
+        return hathi_page_lxml(markup)
+    page_soup = make_soup(markup, 'hathi page').find(id='mdpPage')
+    text = page_soup.find(class_='Text')
+    return bool(text), text.string if text else None, [(a.get_text(), a.get('href')) for a in page_soup('a')]
+
+
+def hathi_page_lxml(markup):
+    tree = lxml.html.fromstring(markup)
+    page = tree.get_element_by_id('mdpPage')
+    text = page.find_class('Text')
+    return bool(text), element_string(text[0]) if text else None, [(a.text_content(), a.get('href'))
+                                                                     for a in page.iter('a')]
+
+
+def element_string(element):
+    # The lxml equivalent of a BeautifulSoup tag's .string, i.e. its text if it holds a single string and no markup:
+    while len(element):
+        if len(element) > 1 or element.text or element[0].tail or not isinstance(element[0].tag, str):
+            return None
+        element = element[0]
+    return element.text
+
+
+def benchmark(markups, repeat=3):
+    # Time each way of extracting a Hathi page, returning the best pages/s of each:
+    backends = {'html.parser': lambda m: bs(m, 'html.parser'),
+                'html.parser strained': lambda m: hathi_page(m, fast=False)}
+    if lxml:
+        backends['lxml'] = lambda m: bs(m, 'lxml')
+        backends['lxml strained'] = lambda m: bs(m, 'lxml', parse_only=hathi_page_strainer)
+        backends['lxml fast path'] = hathi_page_lxml
+
+    results = {}
+    for name, parse in backends.items():
+        best = None
+        for _ in range(repeat):
+            t = time.perf_counter()
+            for markup in markups:
+                parse(markup)
+            elapsed = time.perf_counter() - t
+            best = elapsed if best is None or elapsed < best else best
+        results[name] = round(len(markups) / best, 1) if best else 0
+    return results
+
+
+def read_samples(directory):
+    # Reads saved pages from a directory, including the gzip blobs of the http response cache:
+    markups = []
+    for f in sorted(listdir(directory)):
+        path = join(directory, f)
+        if isdir(path):
+            markups.extend(read_samples(path))
+        elif f.endswith(('.html', '.htm', '.gz')):
+            with (gzip.open if f.endswith('.gz') else open)(path, 'rb') as sample:
+                markup = sample.read()
+            if b'mdpPage' in markup:
+                markups.append(markup)
+    return markups
+
+
+def main():
+    # Usage: python -m nga_tautohetohe_hansard.html_parser [directory of saved Hathi pages]
+    directory = sys.argv[1] if len(sys.argv) > 1 else '.cache/http/blobs'
+    markups = read_samples(directory)
+    if not markups:
+        print(f'No saved Hathi pages found in {directory}')
+        return
+    print(f'Parsing {len(markups)} pages:')
+    for name, rate in benchmark(markups).items():
+        print(f'{name}: {rate} pages/s')
+
+
+if __name__ == '__main__':
+    main()
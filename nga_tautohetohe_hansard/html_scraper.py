@@ -1,22 +1,28 @@
 # import libraries
 import csv
 import re
+import sys
 import time
+from collections import deque
+from multiprocessing.dummy import Pool as ThreadPool
 from pathlib import Path
-from urllib.request import urlopen
-from bs4 import BeautifulSoup as bs
+from urllib.parse import urlsplit
 from datetime import datetime
 from taumahi import *
+from nga_tautohetohe_hansard.html_parser import make_soup
+from nga_tautohetohe_hansard.http_cache import cached_urlopen
+from nga_tautohetohe_hansard.kupu_cache import kupu_cache, kupu_ratios
+from nga_tautohetohe_hansard.metrics import log, metrics, progress, utterances
+from nga_tautohetohe_hansard.profiler import instrument, profile, set_context
+from nga_tautohetohe_hansard.state_store import get_store
+from nga_tautohetohe_hansard.corpus_writer import (document_id, merge_partitions, partition_exists,
+                                                    split_combined_files, write_partition)
 
 hansard_url = 'https://www.parliament.nz'
 hansard_meta_url = f'{hansard_url}{"/en/document/"}'
 htmlindexfilename = 'hansardhtmlindex.csv'
 rāindexfilename = 'hansardrāindex.csv'
 corpusfilename = 'hansardreomāori.csv'
-rāindex_fieldnames = ['retrieved', 'url', 'volume', 'format', 'date1', 'date2', 'reo', 'ambiguous', 'other', 'percent',
-                      'incomplete']
-reo_fieldnames = ['url', 'volume', 'format', 'date1', 'date2', 'utterance', 'speaker', 'reo', 'ambiguous', 'other',
-                  'percent', 'text']
 
 # Vars for generating clean numeric dates from OCRed dates:
 months = {1: 'jan', 2: 'feb', 3: 'mar', 4: 'apr', 5: 'may', 6: 'jun', 7: 'jul', 8: 'aug',
@@ -24,58 +30,53 @@ months = {1: 'jan', 2: 'feb', 3: 'mar', 4: 'apr', 5: 'may', 6: 'jun', 7: 'jul',
 inv_months = {v: k for k, v in months.items()}
 rā = māhina = tau = None
 
+# Debates are downloaded by a pool of threads while they are extracted in url order.
+# fetch_ahead limits how many downloaded debates can wait in memory for the extractor:
+num_threads = 8
+fetch_ahead = 32
+# Finds the page number in the query string of the rhr listing pagination links:
+page_number_pattern = re.compile(r'[?&;][\w.]*page[\w.]*=(\d+)', re.IGNORECASE)
+
+# Patterns used for every debate and paragraph are compiled once here.
+# Debate ids that start with a digit have the older page layout:
+digit_pattern = re.compile(r'\d')
+volume_pattern = re.compile(r'Volume\s*([0-9]{3})')
+date_pattern = re.compile('(\d{1,2}).([a-zA-Z]{3}).(\d{4})')
+# Bold text with a word of five or more letters names a new speaker:
+speaker_pattern = re.compile(r'[a-zA-Z]{5,}')
+# Bracketed paragraphs are skipped, unless they mark te reo text the speaker authorised:
+bracketed_pattern = re.compile(r'\[.*\]')
+authorised_reo_pattern = re.compile(r'\[Authorised Te Reo text')
+# Debates published before their te reo text is authorised hold this placeholder until the text is added,
+# so those pages aren't cached:
+authorised_reo_placeholder = b'[Authorised Te Reo text'
+letter_pattern = re.compile('[a-zA-Z]')
+
 
 class HansardTuhingaScraper:
     """Class for scraping HTML formatted debates from websites."""
 
-    def __init__(self, url):
+    def __init__(self, url, pages=None):
         self.doc_id = url.split('/')[6]
         self.url = f'{hansard_url}{url}'
         self.soup = self.metasoup = self.kōrero_hupo = None
-        self.hanga_hupo()
+        self.hanga_hupo(pages or fetch_debate(url))
         self.retrieved = datetime.now()
 
-    def hanga_hupo(self):
-        # query the website and parse the returned html using beautiful soup
-        alternative_url = f'{hansard_meta_url}{self.doc_id}'
-        get_stuff = ''
-        exception_flag = None
-        count = 0
-        while True:
-            try:
-                get_stuff = urlopen(self.url)
-                break
-            except Exception as e:
-                count += 1
-                if count > 8:
-                    print(e, '\nTrying alternative URL...')
-                    try:
-                        get_stuff = urlopen(alternative_url)
-                        exception_flag, self.url = True, alternative_url
-                        print('\nSuccess!\n')
-                        break
-                    except Exception as e:
-                        raise Exception(e, '\nCould not find data')
-                else:
-                    time.sleep(3)
-
-        self.soup = bs(get_stuff, 'html.parser')
+    def hanga_hupo(self, pages):
+        # parse the html returned by fetch_debate using beautiful soup
+        self.url, exception_flag, get_stuff, meta_stuff = pages
+        self.soup = make_soup(get_stuff, 'debate')
 
         if exception_flag:
             self.kōrero_hupo = self.soup.find('div', attrs={'class': 'section'}).select('div.section > div.section')
-        elif re.match(r'\d', self.doc_id):
+        elif digit_pattern.match(self.doc_id):
             self.kōrero_hupo = self.soup.select('div.Hansard > div')
         else:
             self.kōrero_hupo = self.soup.find_all('div', attrs={'class': 'section'})
 
         # Make soup from hansard metadata
-        meta_url = f'{alternative_url}{"/metadata"}'
-        while True:
-            try:
-                self.metasoup = bs(urlopen(meta_url), 'html.parser').table
-                break
-            except:
-                time.sleep(3)
+        self.metasoup = make_soup(meta_stuff, 'metadata').table
 
     def horoi_transcript_factory(self):
         meta_entries = {}
@@ -83,9 +84,9 @@ class HansardTuhingaScraper:
         for tr in meta_data:
             meta_entries[tr.th.get_text(" ", strip=True).lower()] = tr.td.get_text(" ", strip=True)
         i_row = {'url': self.url, 'format': 'HTML',
-                 'volume': re.search(r'Volume\s*([0-9]{3})', meta_entries['ref']).group(1),
+                 'volume': volume_pattern.search(meta_entries['ref']).group(1),
                  'date1': meta_entries['date']}
-        match = re.match('(\d{1,2}).([a-zA-Z]{3}).(\d{4})', meta_entries['date'])
+        match = date_pattern.match(meta_entries['date'])
         i_row['date2'] = f'{match.group(3)}-{inv_months[match.group(2).lower()]}-{match.group(1)}'
         c_rows, c_row = [], {'utterance': 0}
         totals = {'reo': 0, 'ambiguous': 0, 'other': 0}
@@ -93,11 +94,11 @@ class HansardTuhingaScraper:
             c_row[k] = v
         i_row.update({'retrieved': self.retrieved, 'incomplete': ''})
 
-        print('\n{}\n'.format(self.url))
+        log(progress, '\n{}\n'.format(self.url))
 
         for section in self.kōrero_hupo:
             p_list = section.find_all('p')
-            print('Paragraphs =', len(p_list))
+            log(utterances, 'Paragraphs =', len(p_list))
             for paragraph in p_list:
                 flag = check = False
 
@@ -105,13 +106,13 @@ class HansardTuhingaScraper:
                 strong_tags = paragraph.find_all('strong')
                 for strong in strong_tags:
                     string = strong.get_text(" ")
-                    if not flag and string and re.search(r'[a-zA-Z]{5,}', string):
+                    if not flag and string and speaker_pattern.search(string):
                         flag, c_row['speaker'] = True, clean_whitespace(string.replace(':', ''))
                     strong.replace_with(' ')
 
                 kōrero = paragraph.get_text(" ", strip=True)
-                if re.match(r'\[.*\]', kōrero):
-                    if re.match(r'\[Authorised Te Reo text', kōrero):
+                if bracketed_pattern.match(kōrero):
+                    if authorised_reo_pattern.match(kōrero):
                         i_row['incomplete'] = check = True
                     else:
                         continue
@@ -121,7 +122,7 @@ class HansardTuhingaScraper:
                     if p:
                         kōrero = p
 
-                if re.search(r'[a-zA-Z]', kōrero):
+                if letter_pattern.search(kōrero):
                     c_row['utterance'] += 1
 
                     save_corpus, nums = kupu_ratios(kōrero)
@@ -133,16 +134,77 @@ class HansardTuhingaScraper:
                     if (save_corpus and nums['reo'] > 2) or check:
                         c_row.update(nums)
                         c_row['text'] = clean_whitespace(kōrero)
-                        print(
+                        log(utterances,
                             '{date1}: {title}\nutterance {utterance}, Maori = {reo}%\nname:{speaker}\n{text}\n'.format(
                                 title=meta_entries['short title'], **c_row))
                         c_rows.append(dict(c_row))
-        print('Time:', self.retrieved)
+        log(utterances, 'Time:', self.retrieved)
         i_row['percent'] = get_percentage(**totals)
         i_row.update(totals)
         return c_rows, i_row
 
 
+def fetch_debate(url):
+    # query the website for a debate and its metadata, returning the url the debate was found at, whether that was
+    # the alternative url, and the html of both pages
+    doc_url = f'{hansard_url}{url}'
+    alternative_url = f'{hansard_meta_url}{url.split("/")[6]}'
+    get_stuff = ''
+    exception_flag = None
+    count = 0
+    while True:
+        try:
+            get_stuff = cached_urlopen(doc_url, max_age=None, cacheable=is_settled)
+            break
+        except Exception as e:
+            count += 1
+            metrics.count('fetch_retries', host=urlsplit(doc_url).netloc)
+            if count > 8:
+                print(e, '\nTrying alternative URL...')
+                try:
+                    get_stuff = cached_urlopen(alternative_url, max_age=None, cacheable=is_settled)
+                    exception_flag, doc_url = True, alternative_url
+                    print('\nSuccess!\n')
+                    break
+                except Exception as e:
+                    raise Exception(e, '\nCould not find data')
+            else:
+                time.sleep(3)
+
+    meta_url = f'{alternative_url}{"/metadata"}'
+    while True:
+        try:
+            meta_stuff = cached_urlopen(meta_url, max_age=None)
+            break
+        except:
+            metrics.count('fetch_retries', host=urlsplit(meta_url).netloc)
+            time.sleep(3)
+
+    return doc_url, exception_flag, get_stuff, meta_stuff
+
+
+def is_settled(body):
+    return authorised_reo_placeholder not in body
+
+
+def fetch_debates(doc_urls):
+    # Yields each url with its fetched pages in url order:
+    return zip(doc_urls, fetch_in_order(fetch_debate, doc_urls, fetch_ahead))
+
+
+def fetch_in_order(fetch, urls, ahead):
+    # Yields fetch(url) for each url in order, while a pool of threads fetches up to ahead urls in the background.
+    # Closing the generator early stops the pool, so callers can stop as soon as they have what they need:
+    with ThreadPool(num_threads) as pool:
+        pending = deque()
+        for url in urls:
+            pending.append(pool.apply_async(fetch, (url,)))
+            if len(pending) >= ahead:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
 def scrape_hansard_urls():
     doc_url_list = []
 
@@ -171,80 +233,98 @@ def scrape_hansard_urls():
 
 
 def get_new_urls(last_url):
-    rhr_soup = bs(urlopen(f'{hansard_url}{"/en/pb/hansard-debates/rhr/"}'), 'html.parser')
-
     new_list = []
-    while True:
-        print('\nChecking for new kōrerorero Hansard\n')
-
-        retreivedtime = datetime.now()
-        for h2 in rhr_soup.select('ul.hansard__list h2'):
-            new_url = h2.a['href']
-            if new_url == last_url:
+    pages = [fetch_listing(f'{hansard_url}{"/en/pb/hansard-debates/rhr/"}')]
+    while pages:
+        for rhr_soup in pages:
+            if read_listing(rhr_soup, last_url, new_list):
                 return new_list
-            else:
-                print(new_url)
-                new_list.append([retreivedtime, new_url])
+        pages = next_listings(rhr_soup)
+    return new_list
 
-        next_page = rhr_soup.find('li', attrs={'class', 'pagination__next'})
 
-        if next_page:
-            next_url = f'{hansard_url}{next_page.find("a")["href"]}'
-            rhr_soup = bs(urlopen(next_url), 'html.parser')
+def fetch_listing(url):
+    # The listing grows as debates are published, so its pages are always revalidated:
+    return make_soup(cached_urlopen(url, max_age=0), 'rhr listing')
+
+
+def read_listing(rhr_soup, last_url, new_list):
+    # Add the debate urls of a listing page to new_list, returning True once last_url is reached:
+    print('\nChecking for new kōrerorero Hansard\n')
+
+    retreivedtime = datetime.now()
+    for h2 in rhr_soup.select('ul.hansard__list h2'):
+        new_url = h2.a['href']
+        if new_url == last_url:
+            return True
         else:
-            return new_list
+            log(progress, new_url)
+            new_list.append([retreivedtime, new_url])
+    return False
+
+
+def next_listings(rhr_soup):
+    # Returns the listing pages that follow rhr_soup. When the page number can be read from the pagination links,
+    # every page up to the last one linked is fetched concurrently, otherwise only the next page is fetched:
+    next_page = rhr_soup.find('li', attrs={'class', 'pagination__next'})
+    if not next_page:
+        return []
+    next_href = next_page.find('a')['href']
+    number = page_number_pattern.search(next_href)
+    if not number:
+        return [fetch_listing(f'{hansard_url}{next_href}')]
+
+    # Find the highest page number linked with the same url pattern as the next page:
+    prefix, suffix = next_href[:number.start(1)], next_href[number.end(1):]
+    last = int(number.group(1))
+    for a in rhr_soup.find_all('a', href=True):
+        linked = page_number_pattern.search(a['href'])
+        if linked and a['href'][:linked.start(1)] == prefix:
+            last = max(last, int(linked.group(1)))
+
+    page_urls = [f'{hansard_url}{prefix}{n}{suffix}' for n in range(int(number.group(1)), last + 1)]
+    # Fetch no further ahead than the pool has threads, so an early stop at last_url wastes few requests:
+    return fetch_in_order(fetch_listing, page_urls, num_threads)
 
 
 def aggregate_hansard_corpus(doc_urls):
-    record_list = []
-    if Path(rāindexfilename).exists():
-        with open(rāindexfilename, 'r', newline='', encoding='utf8') as i:
-            record_list = [row for row in csv.DictReader(i)]
-
-            # rowcount = 0
-            # Doesn't do anything yet:
-            # waiting_for_reo = [row if row['incomplete'] for row in record_list]
-            # for row in record_list:
-            #     if row['incomplete']:
-            #         waiting_for_reo.append(rowcount)
-            #     rowcount += 1
-    else:
-        with open(rāindexfilename, 'w', newline='', encoding='utf8') as i:
-            csv.DictWriter(i, rāindex_fieldnames).writeheader()
-
-    if not Path(corpusfilename).exists():
-        with open(corpusfilename, 'w', newline='', encoding='utf8') as c:
-            csv.DictWriter(c, reo_fieldnames).writeheader()
-
-    remaining_urls = []
-    if record_list:
-        last_record_url = record_list[-1]['url'].replace(hansard_url, '')
-        remaining_urls = doc_urls if (last_record_url not in doc_urls) else doc_urls[
-                                                                            doc_urls.index(last_record_url) + 1:]
-    else:
-        remaining_urls = doc_urls
+    # Each debate has its own partition, so any debate without one is yet to be scraped:
+    remaining_urls = [doc_url for doc_url in doc_urls if not partition_exists('HTML', document_id(doc_url))]
 
-    for doc_url in remaining_urls:
-        c_rows, i_row = HansardTuhingaScraper(doc_url).horoi_transcript_factory()
+    for doc_url, pages in fetch_debates(remaining_urls):
+        set_context(format='HTML', debate=document_id(doc_url))
+        c_rows, i_row = HansardTuhingaScraper(doc_url, pages).horoi_transcript_factory()
 
-        with open(rāindexfilename, 'a', newline='', encoding='utf8') as i, open(corpusfilename, 'a', newline='',
-                                                                                encoding='utf8') as c:
-            csv.DictWriter(i, rāindex_fieldnames).writerow(i_row)
-            if c_rows:
-                csv.DictWriter(c, reo_fieldnames).writerows(c_rows)
+        write_partition('HTML', document_id(doc_url), [i_row], c_rows)
+        get_store().set_day(doc_url, i_row['volume'], 'HTML', i_row['date2'], 'processed')
+        metrics.count('days_extracted', format='HTML')
+        metrics.checkpoint()
 
-        print('---\n')
+        log(progress, '---\n')
 
 
-def main():
+def main(merge=True):
     start_time = time.time()
 
-    hansard_doc_urls = scrape_hansard_urls()
-    aggregate_hansard_corpus(hansard_doc_urls)
+    split_combined_files()
+    kupu_cache.load()
+    try:
+        hansard_doc_urls = scrape_hansard_urls()
+        aggregate_hansard_corpus(hansard_doc_urls)
+        if merge:
+            merge_partitions(corpusfilename, rāindexfilename)
+    finally:
+        kupu_cache.save()
+        metrics.export()
+        profile.write_report()
+        print('Kupu cache:', kupu_cache.stats())
 
     print('Web Hansard scraping successful')
     print(f"--- Job took {time.time() - start_time} seconds ---\n")
 
 
+# Time every pattern and kupu_ratios call when profiling is switched on:
+instrument(sys.modules[__name__])
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,197 @@
+# import libraries
+import gzip
+import hashlib
+import os
+import sqlite3
+import time
+from os import getpid, makedirs, remove, replace
+from os.path import dirname, exists, join
+from threading import Lock, get_ident
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from urllib.request import Request, urlopen
+from nga_tautohetohe_hansard.metrics import metrics
+
+cache_dir = '.cache/http'
+max_cache_bytes = 8 * 1024 ** 3
+# Seconds a response is served without revalidation. Scanned volumes and published debates never change,
+# so callers pass max_age=None for those, while index pages that grow should be revalidated more often.
+# Debates still waiting on their authorised te reo text do change, so they aren't cached at all.
+default_max_age = 7 * 24 * 3600
+
+
+class ResponseCache:
+    """This class stores HTTP response bodies on disk, gzip compressed and addressed by the sha256 of their content,
+    with a SQLite index from url to body, ETag/Last-Modified validators and last access time for eviction."""
+
+    def __init__(self, directory=cache_dir, max_bytes=max_cache_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = self.revalidated = self.misses = 0
+        makedirs(join(directory, 'blobs'), exist_ok=True)
+        self.lock = Lock()
+        self.db = sqlite3.connect(join(directory, 'index.sqlite'), check_same_thread=False, isolation_level=None,
+                                  timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, digest TEXT, etag TEXT, '
+                        'last_modified TEXT, stored REAL, accessed REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        # Running total of the blob sizes, so storing a response doesn't have to add them all up again:
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def lookup(self, url):
+        # Returns the index entry of a cached url or None:
+        with self.lock:
+            row = self.db.execute('SELECT url, digest, etag, last_modified, stored FROM responses WHERE url = ?',
+                                  (url,)).fetchone()
+        if row and exists(self.__blob_path(row[1])):
+            return dict(zip(('url', 'digest', 'etag', 'last_modified', 'stored'), row))
+
+    def is_fresh(self, entry, max_age=default_max_age):
+        return max_age is None or time.time() - entry['stored'] < max_age
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def load(self, entry, revalidated=False):
+        # Read a cached body and mark it as recently used:
+        with open(self.__blob_path(entry['digest']), 'rb') as blob:
+            body = gzip.decompress(blob.read())
+        now = time.time()
+        with self.lock:
+            if revalidated:
+                self.revalidated += 1
+                self.db.execute('UPDATE responses SET stored = ?, accessed = ? WHERE url = ?', (now, now, entry['url']))
+            else:
+                self.hits += 1
+                self.db.execute('UPDATE responses SET accessed = ? WHERE url = ?', (now, entry['url']))
+        return body
+
+    def store(self, url, body, headers):
+        # Save a body under its content hash, identical bodies are only stored once:
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.__blob_path(digest)
+        if not exists(path):
+            makedirs(dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{getpid()}.{get_ident()}.tmp'
+            with open(tmp_path, 'wb') as blob:
+                blob.write(gzip.compress(body))
+            replace(tmp_path, path)
+        size = len(body)
+        now = time.time()
+        with self.lock:
+            self.misses += 1
+            old = self.db.execute('SELECT digest FROM responses WHERE url = ?', (url,)).fetchone()
+            if self.db.execute('INSERT OR IGNORE INTO blobs VALUES (?, ?)', (digest, size)).rowcount:
+                self.total_bytes += size
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                            (url, digest, headers.get('ETag') or headers.get('etag'),
+                             headers.get('Last-Modified') or headers.get('last-modified'), now, now))
+            if old and old[0] != digest:
+                self.__drop_orphan(old[0])
+        self.evict()
+
+    def remove(self, url):
+        with self.lock:
+            row = self.db.execute('SELECT digest FROM responses WHERE url = ?', (url,)).fetchone()
+            self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+            if row:
+                self.__drop_orphan(row[0])
+
+    def evict(self):
+        # Remove the least recently used responses until the cache is back under its size limit.
+        # Other processes may share the cache, so the running total is only checked against the index once over:
+        with self.lock:
+            if self.total_bytes <= self.max_bytes:
+                return
+            self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+            if self.total_bytes <= self.max_bytes:
+                return
+            for url, digest in self.db.execute('SELECT url, digest FROM responses ORDER BY accessed').fetchall():
+                self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+                self.__drop_orphan(digest)
+                if self.total_bytes <= self.max_bytes * 0.9:
+                    break
+
+    def stats(self):
+        return {'hits': self.hits, 'revalidated': self.revalidated, 'misses': self.misses}
+
+    def __drop_orphan(self, digest):
+        # Delete a blob once no url refers to it:
+        if self.db.execute('SELECT 1 FROM responses WHERE digest = ? LIMIT 1', (digest,)).fetchone():
+            return
+        row = self.db.execute('SELECT size FROM blobs WHERE digest = ?', (digest,)).fetchone()
+        self.db.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+        if row:
+            self.total_bytes -= row[0]
+        path = self.__blob_path(digest)
+        if exists(path):
+            remove(path)
+
+    def __blob_path(self, digest):
+        return join(self.directory, 'blobs', digest[:2], f'{digest}.gz')
+
+
+shared_cache = None
+cache_lock = Lock()
+
+
+def get_cache():
+    # The one cache instance shared by all the scrapers in this process:
+    global shared_cache
+    with cache_lock:
+        if shared_cache is None:
+            shared_cache = ResponseCache()
+        return shared_cache
+
+
+def reset_after_fork():
+    # Another thread may have held the lock or been using the cache's connection when the process forked, and a
+    # SQLite connection can't be used on both sides of a fork, so the child opens its own cache if it needs one:
+    global shared_cache, cache_lock
+    shared_cache = None
+    cache_lock = Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def cached_urlopen(url, max_age=default_max_age, cache=None, cacheable=None):
+    # Drop-in for urlopen(url).read() which serves fresh cached copies and revalidates stale ones.
+    # Bodies that cacheable returns False for, e.g. pages still waiting on content, are fetched every time:
+    cache = cache or get_cache()
+    host = urlsplit(url).netloc
+    entry = cache.lookup(url)
+    if entry and cache.is_fresh(entry, max_age):
+        body = cache.load(entry)
+        if cacheable is None or cacheable(body):
+            metrics.count('cache_hits', host=host)
+            return body
+        # A copy cached before its url was checked is dropped, so the page is fetched in full:
+        cache.remove(url)
+        entry = None
+
+    headers = cache.conditional_headers(entry)
+    t = time.perf_counter()
+    try:
+        with urlopen(Request(url, headers=headers)) as response:
+            body = response.read()
+            metrics.observe('fetch_latency_seconds', time.perf_counter() - t, host=host)
+            metrics.count('bytes_fetched', len(body), host=host)
+            if cacheable is None or cacheable(body):
+                cache.store(url, body, response.headers)
+            else:
+                metrics.count('cache_skipped', host=host)
+            return body
+    except HTTPError as e:
+        if e.code == 304 and entry:
+            return cache.load(entry, revalidated=True)
+        raise
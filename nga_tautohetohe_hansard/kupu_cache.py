@@ -0,0 +1,189 @@
+# import libraries
+import gzip
+import json
+import os
+from collections import OrderedDict, deque
+from os import makedirs, replace
+from os.path import dirname, exists
+from threading import Lock
+import taumahi
+from nga_tautohetohe_hansard.metrics import metrics
+
+cache_size = 100000
+cache_filename = '.cache/kupu_words.json.gz'
+# Keep the results between runs, set to False to start from an empty cache every run:
+persist_cache = True
+# Set to False to classify every sentence with taumahi:
+cache_words = True
+# Every this many sentences answered from the cache are also classified by taumahi, to check that adding up their
+# words gives the same result. If it doesn't, the cache stops and every sentence is classified by taumahi:
+check_every = 1000
+
+
+class KupuCache:
+    """This class memoises taumahi.kupu_ratios word by word. Hansard uses the same words enormously often, so each
+    word is only classified by taumahi the first time it is seen, keeping the most recently used up to a fixed size,
+    and a sentence's counts are added up from its words. Whether taumahi keeps a sentence depends on its counts, so
+    that decision is memoised by the counts. Worker processes hand the words they classified and their hits and
+    misses back with their metrics, so the parent can save them."""
+
+    def __init__(self, maxsize=cache_size):
+        self.maxsize = maxsize
+        self.words = OrderedDict()  # (word, tohutō) -> (reo, ambiguous, other)
+        self.decisions = OrderedDict()  # (reo, ambiguous, other, tohutō) -> kupu_ratios result
+        self.hits = self.misses = self.sentences = 0
+        self.by_word = True
+        self.lock = Lock()
+        self.reset_drained()
+        # Stages running at the same time share the cache, so it is only loaded once and saved by one at a time:
+        self.file_lock = Lock()
+        self.loaded = False
+
+    def kupu_ratios(self, text, tohutō=None):
+        if not (cache_words and self.by_word):
+            return classify(text, tohutō)
+
+        # Add up the counts of the words seen before, and classify the others:
+        reo = ambiguous = other = 0
+        unknown = {}
+        words = self.words
+        text_words = text.split()
+        with self.lock:
+            for word in text_words:
+                key = (word, tohutō)
+                word_counts = words.get(key)
+                if word_counts is None:
+                    unknown[word] = unknown.get(word, 0) + 1
+                else:
+                    words.move_to_end(key)
+                    reo += word_counts[0]
+                    ambiguous += word_counts[1]
+                    other += word_counts[2]
+            self.hits += len(text_words) - sum(unknown.values())
+        for word, n in unknown.items():
+            word_counts = ratio_counts(classify(word, tohutō)[1])
+            reo += word_counts[0] * n
+            ambiguous += word_counts[1] * n
+            other += word_counts[2] * n
+            with self.lock:
+                self.misses += n
+                self.words[(word, tohutō)] = word_counts
+                self.added.append(((word, tohutō), word_counts))
+                if len(self.words) > self.maxsize:
+                    self.words.popitem(last=False)
+        counts = [reo, ambiguous, other]
+
+        # Sentences with new counts, and every so often one with counts seen before, are classified by taumahi:
+        key = (*counts, tohutō)
+        with self.lock:
+            result = self.decisions.get(key)
+            self.sentences += 1
+            check = result is not None and not self.sentences % check_every
+        metrics.count('sentences_classified', cache='miss' if result is None else 'hit')
+        if result is None or check:
+            direct = classify(text, tohutō)
+            if list(ratio_counts(direct[1])) != counts or (check and direct != result):
+                print('Adding up kupu_ratios word by word gave a different result for:', text,
+                      '\nEvery sentence is classified by taumahi from now on')
+                metrics.count('kupu_cache_mismatches')
+                self.by_word = False
+                return direct
+            result = direct
+            with self.lock:
+                self.decisions[key] = result
+                if len(self.decisions) > self.maxsize:
+                    self.decisions.popitem(last=False)
+        # Callers update the ratios dict, so hand out a copy:
+        return result[0], dict(result[1])
+
+    def stats(self):
+        calls = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.words),
+                'hit rate': round(100 * self.hits / calls, 2) if calls else 0, 'sentence counts': len(self.decisions)}
+
+    def reset_drained(self):
+        # Words added and counts since the last drain:
+        self.added = deque(maxlen=self.maxsize)
+        self.drained_hits = self.drained_misses = 0
+
+    def reset_after_fork(self):
+        # Another thread may have held the lock when the process forked. The child keeps the words, but only hands
+        # back what it adds itself:
+        self.lock = Lock()
+        self.file_lock = Lock()
+        with self.lock:
+            self.drained_hits, self.drained_misses = self.hits, self.misses
+            self.added.clear()
+
+    def drain(self):
+        with self.lock:
+            drained = os.getpid(), list(self.added), self.hits - self.drained_hits, self.misses - self.drained_misses
+            self.added.clear()
+            self.drained_hits, self.drained_misses = self.hits, self.misses
+        return drained
+
+    def merge(self, drained):
+        pid, added, hits, misses = drained
+        # A volume extracted in this process already added its words here:
+        if pid == os.getpid():
+            return
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            for key, word_counts in added:
+                self.words[key] = word_counts
+                self.words.move_to_end(key)
+            while len(self.words) > self.maxsize:
+                self.words.popitem(last=False)
+            # Only this process's own counts are handed on by its next drain:
+            self.drained_hits += hits
+            self.drained_misses += misses
+
+    def clear(self):
+        with self.lock:
+            self.words.clear()
+            self.decisions.clear()
+            self.hits = self.misses = self.sentences = 0
+            self.by_word = True
+            self.reset_drained()
+
+    def load(self, filename=cache_filename):
+        # Reload words saved by a previous run:
+        with self.file_lock:
+            if persist_cache and not self.loaded and exists(filename):
+                with gzip.open(filename, 'rt', encoding='utf8') as f:
+                    with self.lock:
+                        for word, tohutō, word_counts in json.load(f)[-self.maxsize:]:
+                            self.words[(word, tohutō)] = tuple(word_counts)
+            self.loaded = True
+
+    def save(self, filename=cache_filename):
+        if not persist_cache:
+            return
+        makedirs(dirname(filename) or '.', exist_ok=True)
+        with self.lock:
+            entries = [[word, tohutō, word_counts] for (word, tohutō), word_counts in self.words.items()]
+        with self.file_lock:
+            with gzip.open(f'{filename}.tmp', 'wt', encoding='utf8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            replace(f'{filename}.tmp', filename)
+
+
+def classify(text, tohutō=None):
+    # Only pass tohutō when the caller did, so taumahi's own default still applies:
+    return taumahi.kupu_ratios(text) if tohutō is None else taumahi.kupu_ratios(text, tohutō=tohutō)
+
+
+def ratio_counts(nums):
+    return nums['reo'], nums['ambiguous'], nums['other']
+
+
+kupu_cache = KupuCache()
+metrics.register('kupu_cache', kupu_cache)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=kupu_cache.reset_after_fork)
+
+
+def kupu_ratios(text, tohutō=None):
+    # Drop-in replacement for taumahi.kupu_ratios backed by the shared cache:
+    return kupu_cache.kupu_ratios(text, tohutō)
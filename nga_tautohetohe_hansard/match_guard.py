@@ -0,0 +1,191 @@
+# import libraries
+import json
+import os
+import re
+import signal
+import time
+from datetime import datetime
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from threading import Lock, current_thread, main_thread
+from nga_tautohetohe_hansard.metrics import metrics
+
+# Seconds a guarded match may take before it is abandoned and its input quarantined:
+match_timeout = 2.0
+# Seconds each volume may lose to abandoned matches. Once spent, guarded matches in the volume only get
+# min_timeout each, so a volume full of pathological pages still finishes in predictable time:
+volume_timeout_budget = 30.0
+min_timeout = 0.05
+# Abandoned inputs are appended here as JSON lines, with the volume, page and date they came from:
+quarantine_filename = 'hansardquarantine.jsonl'
+
+
+class MatchTimeout(Exception):
+    """Raised when a guarded match runs past its time limit."""
+
+
+class MatchGuard:
+    """This class runs pattern matches with a time limit for one volume. A match that runs out of time counts as no
+    match, and its input is quarantined so the volume carries on without it."""
+
+    def __init__(self, volume, budget=volume_timeout_budget):
+        self.volume = volume
+        self.budget = budget
+        self.timeouts = 0
+
+    def match(self, pattern, text, name, **where):
+        timeout = max(min_timeout, min(match_timeout, self.budget))
+        t = time.perf_counter()
+        try:
+            return bounded_match(pattern, text, timeout)
+        except MatchTimeout:
+            seconds = time.perf_counter() - t
+            self.budget -= seconds
+            self.timeouts += 1
+            metrics.count('regex_timeouts', pattern=name)
+            quarantine.add({'volume': self.volume, **where, 'pattern': name, 'seconds': round(seconds, 3),
+                            'text': text})
+            print(f'Quarantined a {len(text)} character input to {name} in volume {self.volume} after',
+                  f'{round(seconds, 2)} seconds, {round(max(self.budget, 0), 1)} seconds of timeouts left')
+            return None
+
+
+def bounded_match(pattern, text, timeout):
+    # The re module checks for signals while it backtracks, so in the main thread an interval timer can interrupt a
+    # match. Other threads can't receive signals, so their matches are run in a helper process instead:
+    if hasattr(signal, 'setitimer') and current_thread() is main_thread():
+        previous = signal.signal(signal.SIGALRM, raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            return pattern.match(text)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+    return helper.match(pattern, text, timeout)
+
+
+def raise_timeout(signum, frame):
+    raise MatchTimeout()
+
+
+class MatchHelper:
+    """This class keeps a process for running matches that can't be interrupted in the calling thread. A match that
+    finishes in time is handed back as its group spans, a match that doesn't is stopped by ending the process, which
+    is started again for the next match."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.process = self.connection = None
+        self.unavailable = False
+
+    def match(self, pattern, text, timeout):
+        with self.lock:
+            if self.unavailable:
+                return pattern.match(text)
+            if self.process is None or not self.process.is_alive():
+                context = get_context('spawn')
+                self.connection, child = context.Pipe()
+                self.process = context.Process(target=match_worker, args=(child,), daemon=True)
+                self.process.start()
+                # Wait until the process is ready, so starting it doesn't count against the time limit. If it can't
+                # start, matches outside the main thread go without a time limit rather than failing:
+                wait([self.connection, self.process.sentinel])
+                if not self.connection.poll():
+                    print('Could not start the match helper, matches outside the main thread have no time limit')
+                    self.unavailable = True
+                    self.process = None
+                    return pattern.match(text)
+                self.connection.recv()
+            self.connection.send((pattern.pattern, pattern.flags, text))
+            if self.connection.poll(timeout):
+                spans = self.connection.recv()
+                return SpanMatch(text, spans) if spans else None
+            self.process.kill()
+            self.process.join()
+            self.process = None
+        raise MatchTimeout()
+
+    def reset_after_fork(self):
+        # Another thread may have been matching when the process forked, and the helper belongs to the parent:
+        self.lock = Lock()
+        self.process = self.connection = None
+
+
+def match_worker(connection):
+    connection.send(True)
+    while True:
+        pattern, flags, text = connection.recv()
+        match = re.compile(pattern, flags).match(text)
+        connection.send(match.regs if match else None)
+
+
+class SpanMatch:
+    """This class stands in for the match object of a match run in the helper process, rebuilt from its group
+    spans so the text isn't matched a second time."""
+
+    def __init__(self, text, spans):
+        self.string = text
+        self.regs = spans
+
+    def span(self, group=0):
+        return self.regs[group]
+
+    def start(self, group=0):
+        return self.regs[group][0]
+
+    def end(self, group=0):
+        return self.regs[group][1]
+
+    def group(self, *groups):
+        values = [self.__group(g) for g in groups or (0,)]
+        return values[0] if len(values) == 1 else tuple(values)
+
+    def groups(self, default=None):
+        return tuple(default if start < 0 else self.string[start:end] for start, end in self.regs[1:])
+
+    def __group(self, group):
+        start, end = self.regs[group]
+        return None if start < 0 else self.string[start:end]
+
+    def __bool__(self):
+        return True
+
+
+class Quarantine:
+    """This class collects quarantined inputs. Worker processes hand theirs back with their metrics, and the
+    process that merges them appends them to the quarantine file."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = []
+
+    def add(self, entry):
+        with self.lock:
+            self.entries.append({'time': datetime.now().isoformat(timespec='seconds'), **entry})
+
+    def drain(self):
+        with self.lock:
+            entries, self.entries = self.entries, []
+        return entries
+
+    def merge(self, entries):
+        if entries:
+            with self.lock, open(quarantine_filename, 'a', encoding='utf8') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def flush(self):
+        self.merge(self.drain())
+
+    def reset_after_fork(self):
+        self.lock = Lock()
+        self.entries = []
+
+
+quarantine = Quarantine()
+metrics.register('quarantine', quarantine)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=quarantine.reset_after_fork)
+helper = MatchHelper()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=helper.reset_after_fork)
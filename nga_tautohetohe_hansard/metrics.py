@@ -0,0 +1,189 @@
+# import libraries
+import bisect
+import json
+import os
+import time
+from contextlib import contextmanager
+from os import makedirs, replace
+from os.path import dirname
+from threading import Lock
+
+# How much the scrapers print, set with the HANSARD_VERBOSITY environment variable:
+# 0 only prints stage summaries and errors, 1 also prints progress through volumes, days and pages,
+# 2 also prints every extracted utterance, which slows large volumes down noticeably.
+quiet, progress, utterances = 0, 1, 2
+
+
+def read_verbosity(value):
+    # A mistyped level falls back to printing progress rather than stopping every scraper at import:
+    if value is None:
+        return progress
+    try:
+        return int(value)
+    except ValueError:
+        print(f'HANSARD_VERBOSITY should be {quiet}, {progress} or {utterances}, not {value!r}, using {progress}')
+        return progress
+
+
+verbosity = read_verbosity(os.environ.get('HANSARD_VERBOSITY'))
+
+# Metrics are appended to a JSON lines file, or written as a Prometheus text file if the name ends with .prom:
+metrics_filename = os.environ.get('HANSARD_METRICS', 'hansardmetrics.jsonl')
+prometheus_prefix = 'hansard_'
+# Seconds between exports while a stage runs, every stage also exports when it finishes:
+export_interval = 60
+
+# Upper bounds of the histogram buckets, in seconds unless the histogram is named below:
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+histogram_buckets = {
+    'pdf_day_loops': (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+    'volume_seconds': (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+}
+
+
+def log(level, *args, **kwargs):
+    # print when the verbosity is at least level:
+    if verbosity >= level:
+        print(*args, **kwargs)
+
+
+class Metrics:
+    """This class counts events and records distributions of values, each under a name and optional labels, e.g.
+    metrics.count('pages_fetched', source='hathi'). Worker processes hand their metrics back with drain(), which
+    the parent adds to its own with merge(). Other records with drain and merge methods, e.g. the profile, can be
+    registered to be handed back along with them."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = {}
+        self.exported = time.time()
+
+    def register(self, name, collector):
+        self.collectors[name] = collector
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        # Add a value to a histogram, kept as a count per bucket with the sum and count of the values:
+        key = (name, tuple(sorted(labels.items())))
+        buckets = histogram_buckets.get(name, default_buckets)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = {'buckets': [0] * (len(buckets) + 1), 'sum': 0, 'count': 0}
+            h['buckets'][bisect.bisect_left(buckets, value)] += 1
+            h['sum'] += value
+            h['count'] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # Observe the seconds spent in a with block:
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t, **labels)
+
+    def reset_after_fork(self):
+        # Another thread may have held the lock when the process forked, so the child starts with a new one:
+        self.lock = Lock()
+        self.counters, self.histograms = {}, {}
+
+    def drain(self):
+        # Returns the metrics recorded since the last drain and starts again from zero:
+        with self.lock:
+            drained = self.counters, self.histograms
+            self.counters, self.histograms = {}, {}
+        return drained + ({name: collector.drain() for name, collector in self.collectors.items()},)
+
+    def merge(self, drained):
+        counters, histograms, collected = drained
+        for name, records in collected.items():
+            if name in self.collectors:
+                self.collectors[name].merge(records)
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other in histograms.items():
+                h = self.histograms.get(key)
+                if h is None:
+                    self.histograms[key] = {'buckets': list(other['buckets']), 'sum': other['sum'],
+                                            'count': other['count']}
+                else:
+                    h['buckets'] = [a + b for a, b in zip(h['buckets'], other['buckets'])]
+                    h['sum'] += other['sum']
+                    h['count'] += other['count']
+
+    def snapshot(self):
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = []
+            for (name, labels), h in sorted(self.histograms.items()):
+                bounds = [str(b) for b in histogram_buckets.get(name, default_buckets)] + ['+Inf']
+                histograms.append({'name': name, 'labels': dict(labels), 'buckets': dict(zip(bounds, h['buckets'])),
+                                   'sum': h['sum'], 'count': h['count']})
+        return {'time': time.time(), 'pid': os.getpid(), 'counters': counters, 'histograms': histograms}
+
+    def export(self, filename=None):
+        filename = filename or metrics_filename
+        if not filename:
+            return
+        snapshot = self.snapshot()
+        makedirs(dirname(filename) or '.', exist_ok=True)
+        with self.lock:
+            self.exported = time.time()
+            if filename.endswith('.prom'):
+                # Written to a temporary file first, so a Prometheus textfile collector never reads half a file:
+                with open(f'{filename}.tmp', 'w', encoding='utf8') as f:
+                    f.write(prometheus_text(snapshot))
+                replace(f'{filename}.tmp', filename)
+            else:
+                with open(filename, 'a', encoding='utf8') as f:
+                    f.write(json.dumps(snapshot, ensure_ascii=False) + '\n')
+
+    def checkpoint(self, interval=export_interval):
+        # Export if the last export was more than interval seconds ago:
+        if time.time() - self.exported >= interval:
+            self.export()
+
+
+def prometheus_text(snapshot):
+    # Format a snapshot in the Prometheus text exposition format, counting bucket values cumulatively:
+    lines, typed = [], set()
+    for c in snapshot['counters']:
+        name = f'{prometheus_prefix}{c["name"]}_total'
+        if name not in typed:
+            lines.append(f'# TYPE {name} counter')
+            typed.add(name)
+        lines.append(f'{name}{prometheus_labels(c["labels"])} {c["value"]}')
+    for h in snapshot['histograms']:
+        name = f'{prometheus_prefix}{h["name"]}'
+        if name not in typed:
+            lines.append(f'# TYPE {name} histogram')
+            typed.add(name)
+        total = 0
+        for bound, count in h['buckets'].items():
+            total += count
+            lines.append(f'{name}_bucket{prometheus_labels({**h["labels"], "le": bound})} {total}')
+        lines.append(f'{name}_sum{prometheus_labels(h["labels"])} {h["sum"]}')
+        lines.append(f'{name}_count{prometheus_labels(h["labels"])} {h["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = {k: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for k, v in labels.items()}
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped.items()) + '}'
+
+
+metrics = Metrics()
+# A forked worker starts with none of its parent's metrics, so draining it only hands back its own:
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=metrics.reset_after_fork)
@@ -1,18 +1,26 @@
 # import libraries
+import asyncio
 import csv
+import io
+import re
 import time
-from os import mkdir
+from os import mkdir, replace
 from pathlib import Path
+from urllib.parse import urlsplit
 from multiprocessing.dummy import Pool as ThreadPool, Lock
-from urllib.request import urlopen
-from bs4 import BeautifulSoup as bs
 from datetime import datetime
 from taumahi import *
+from nga_tautohetohe_hansard.async_http import AsyncHTTPClient, HTTPError
+from nga_tautohetohe_hansard.html_parser import hathi_page, make_soup
+from nga_tautohetohe_hansard.metrics import log, metrics, progress
+from nga_tautohetohe_hansard.http_cache import cached_urlopen, get_cache
+from nga_tautohetohe_hansard.ocr_text_cleaner import ExtractionFeed
+from nga_tautohetohe_hansard.page_store import convert_csv, page_fieldnames, store_extension
+from nga_tautohetohe_hansard.rate_limiter import AdaptiveRateLimiter
+from nga_tautohetohe_hansard.state_store import get_store
 
 hansard_url = 'https://www.parliament.nz/en/pb/hansard-debates/historical-hansard/'
 hathi_domain = 'https://babel.hathitrust.org'
-volumeindex_filename = 'hansardvolumeindex.csv'
-volumeindex_fieldnames = ['retrieved', 'url', 'name', 'period', 'session', 'format', 'downloaded', 'processed']
 volumes_dir = '1854-1987'
 
 # Volume counts:
@@ -20,60 +28,65 @@ num_volumes = 482 + 6  # The first 6 volumes do not follow an incremental intege
 complete = 0
 
 # Hathi network can download 100+ pages between errors,
-# so 100+ threads will maximise concurrent page download speed
+# so 100+ concurrent requests will maximise page download speed.
+# Threads are only used to scrape the volume urls, pages are downloaded by the asyncio client.
 num_threads = 100
-write_lock = Lock()
-sleep_lock = Lock()
+max_in_flight = 100
+# Volumes walked at once. Each keeps its csv open while it is walked, so this also caps the open files:
+max_open_volumes = 100
+
+# Hathi page urls increment a seq= parameter, so the next few pages of a volume can be requested before the
+# Next Page anchor confirms them. Only used while there are spare requests, i.e. in the tail of the crawl.
+speculative_pages = 4
+seq_pattern = re.compile(r'(?<=[;&?]seq=)\d+')
+active_volumes = speculative_hits = 0
+
+# The client retries 429s, 5xx responses and dropped connections itself. Other error statuses, e.g. a 403 while
+# Hathi briefly refuses a page, are retried this many times with a doubling delay before the volume is given up on
+# until the next run:
+page_retries = 5
+page_retry_delay = 10
+
+# Volume csvs are resumed from their last complete row, found by reading back from the end of the file:
+row_start_pattern = re.compile(rb'(?<=\n)\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?,[^,\r\n]*,\d+,')
+tail_block = 1 << 16
+# Header lines of the volume csvs, older csvs spell retrieved 'retreived':
+volume_headers = (','.join(page_fieldnames).encode(), b'retreived,url,page,text')
+# Convert each volume csv into a compressed page store once the volume is downloaded:
+store_pages = True
+# Extract the corpus from each volume on a pool of processes as soon as it is downloaded:
+extract_while_downloading = True
 count_lock = Lock()
-responsive_lock = Lock()
-responsive = True
-total_pages_processed = interval_pages_processed = tries = 0
+total_pages_processed = interval_pages_processed = tries = reported_errors = 0
+limiter = AdaptiveRateLimiter()
 start_time = time.time()
 
 
 def get_volume_meta():
-    print('Getting volume URLs:')
     global complete
-    incomplete = 0
-
-    # Check to see if all volume urls have been retrieved and
-    # if any volumes have already been downloaded and processed:
-    if Path(volumeindex_filename).exists():
-        with write_lock:
-            for row in read_index_rows():
-                if row['downloaded']:
-                    complete += 1
-                else:
-                    incomplete += 1
-                    print('Have link to volume:', row['name'])
-                    yield row
-    total = complete + incomplete
-    if not total:
-        with write_lock, open(volumeindex_filename, 'w', newline='', encoding='utf8') as v_index:
-            writer = csv.DictWriter(v_index, volumeindex_fieldnames)
-            writer.writeheader()
+    update_volume_index()
+
+    # Check to see if any volumes have already been downloaded:
+    for row in read_index_rows():
+        if row['downloaded']:
+            complete += 1
+        else:
+            log(progress, 'Have link to volume:', row['name'])
+            yield row
+
 
-    # Get remaining urls if they haven't been acquired yet:
+def update_volume_index():
+    # Get the remaining volume urls if they haven't been acquired yet:
+    print('Getting volume URLs:')
+    total = len(read_index_rows())
     if total < num_volumes - 4:
         for row in scrape_volume_urls(total):
-            while True:
-                with write_lock, open(volumeindex_filename, 'a', newline='', encoding='utf8') as v_index:
-                    writer = csv.DictWriter(v_index, volumeindex_fieldnames)
-                    writer.writerow(row)
-                    break
-            yield row
+            get_store().add_volume(row)
     print(f'Collected Hathi volume URLs after {get_rate(start_time)}')
 
 
 def read_index_rows():
-    while True:
-        rows = []
-        with open(volumeindex_filename, 'r', newline='', encoding='utf8') as url_file:
-            reader = csv.DictReader(url_file)
-            for row in reader:
-                if not (row['name'].isdigit() and int(row['name']) > 482):
-                    rows.append(row)
-            return rows
+    return [row for row in get_store().volume_rows() if not (row['name'].isdigit() and int(row['name']) > 482)]
 
 
 def scrape_volume_urls(count):
@@ -123,7 +136,7 @@ def scrape_volume_url(tr):
             else:
                 row['period'] = cell.string.strip()
                 switch = True
-    print('Got link to volume:', row['name'])
+    log(progress, 'Got link to volume:', row['name'])
     return row
 
 
@@ -133,147 +146,333 @@ def download_volumes():
 
     t = time.time()
     # Get list of volumes that are not finished downloading, then download:
-    volume_list = get_volume_meta()
-    with ThreadPool(num_volumes - complete if num_threads > num_volumes - complete else num_threads) as pool:
+    volume_list = list(get_volume_meta())
+    if extract_while_downloading:
+        with ExtractionFeed() as feed:
+            count = asyncio.run(download_volumes_async(volume_list, feed=feed))
+    else:
+        count = asyncio.run(download_volumes_async(volume_list))
+    print(f"--- {count} volumes downloaded in {get_rate(t)}, {speculative_hits} pages prefetched ---")
+
+
+async def download_volumes_async(volume_list, domain=hathi_domain, feed=None):
+    # Walk every volume concurrently, the client caps how many page requests are in flight at once:
+    # Scanned pages never change, so cached pages are reused without revalidation:
+    async with AsyncHTTPClient(max_in_flight=max_in_flight, limiter=limiter, cache=get_cache(),
+                               max_age=None) as client:
         count = 0
-        for result in pool.imap_unordered(download_volume, volume_list):
-            count += 1
-        print(f"--- {count} volumes downloaded in {get_rate(t)} ---")
+        failed = []
+        slots = asyncio.Semaphore(max_open_volumes)
+        for result in asyncio.as_completed([download_volume(client, volume, domain, feed, slots)
+                                            for volume in volume_list]):
+            # A volume that fails is left to be resumed by the next run, the others carry on:
+            name = await result
+            if name:
+                failed.append(name)
+            else:
+                count += 1
+        if failed:
+            print(f'{len(failed)} volumes failed to download and will be resumed next run:', ', '.join(failed))
+        return count
+
+
+async def download_volume(client, volume, domain=hathi_domain, feed=None, slots=None):
+    # Returns the volume name if the volume failed to download, otherwise None:
+    try:
+        if slots is None:
+            await download_volume_pages(client, volume, domain, feed)
+        else:
+            async with slots:
+                await download_volume_pages(client, volume, domain, feed)
+    except Exception as exception:
+        print(f'Failed to download volume {volume["name"]}: {exception!r}')
+        metrics.count('volumes_failed')
+        return volume['name']
 
 
-def download_volume(volume):
+async def download_volume_pages(client, volume, domain=hathi_domain, feed=None):
+    # File and state store I/O is done in the executor, to keep the event loop free for the requests in flight:
+    global active_volumes
+    loop = asyncio.get_running_loop()
     name = volume['name']
-    print(f'Downloading volume {name}')
+    log(progress, f'Downloading volume {name}')
+
+    # A page store is only written once a volume is complete:
+    if Path(f'{volumes_dir}/{name}{store_extension}').exists():
+        await loop.run_in_executor(None, mark_downloaded, name, volume, feed, f'{name}{store_extension}')
+        return
 
     # Check to see how much of the volume has been downloaded
     filepath = f'{volumes_dir}/{name}.csv'
+    fieldnames, url, pagecount = await loop.run_in_executor(None, open_volume_file, filepath)
+
+    # Download and save remaining volume pages:
+    active_volumes += 1
+    prefetched = {}
+    try:
+        more_pages = True
+        if url:
+            more_pages, url, _ = await download_page(client, url.replace(domain, '', 1), pagecount, domain)
+        else:
+            url = volume['url'].replace(domain, '', 1)
+        # Keep the volume csv open while walking its pages rather than reopening it for every page:
+        with open(filepath, 'a', newline='', encoding='utf8') as txt_file:
+            writer = csv.DictWriter(txt_file, fieldnames)
+            while more_pages:
+                pagecount += 1
+                more_pages, url, row = await download_page(client, url, pagecount, domain, prefetched)
+                if row:
+                    await loop.run_in_executor(None, writer.writerow, row)
+    finally:
+        active_volumes -= 1
+        for task in prefetched.values():
+            task.cancel()
+
+    if store_pages:
+        filepath = await loop.run_in_executor(None, convert_csv, filepath)
+
+    # Update the record of volume downloads:
+    await loop.run_in_executor(None, mark_downloaded, name, volume, feed, Path(filepath).name)
+
+
+def open_volume_file(filepath):
+    # Returns the csv fieldnames and the url and number of the last page saved, creating the file if need be.
+    # Only the end of an existing file is read, and a final row cut short by a crash is removed. A file with no
+    # complete rows is only started again if it holds nothing but a header, otherwise it is moved aside to be checked:
     url = ''
     pagecount = 0
-    fieldnames = []
-    if Path(filepath).exists():
-        with open(filepath, 'r', newline='', encoding='utf8') as txt_file:
-            reader = csv.DictReader(txt_file)
-            fieldnames = reader.fieldnames
-            c = 0
-            try:
-                for row in reader:
-                    url = row['url']
-                    pagecount = int(row['page'])
-                    c += 1
-            except Exception as exception:
-                print(filepath, c)
-                if not c:
-                    with open(filepath, 'w', newline='', encoding='utf8') as txt_file:
-                        fieldnames = ['retrieved', 'url', 'page', 'text']
-                        writer = csv.DictWriter(txt_file, fieldnames)
-                        writer.writeheader()
-                else:
-                    raise exception
+    last_page = read_last_page(filepath) if Path(filepath).exists() else None
+    if last_page:
+        url, pagecount, offset = last_page
+        if offset < Path(filepath).stat().st_size:
+            print(f'Repairing {filepath}, truncating at byte {offset}')
+            with open(filepath, 'r+b') as txt_file:
+                txt_file.truncate(offset)
     else:
+        if Path(filepath).exists() and not is_empty_volume_file(filepath):
+            aside = f'{filepath}.{int(time.time())}.unreadable'
+            print(f'Could not find a complete page in {filepath}, moving it to {aside} and starting again')
+            metrics.count('volume_files_unreadable')
+            replace(filepath, aside)
         with open(filepath, 'w', newline='', encoding='utf8') as txt_file:
-            fieldnames = ['retrieved', 'url', 'page', 'text']
-            writer = csv.DictWriter(txt_file, fieldnames)
+            writer = csv.DictWriter(txt_file, page_fieldnames)
             writer.writeheader()
+    return page_fieldnames, url, pagecount
 
-    # Download and save remaining volume pages:
-    more_pages = True
-    if url:
-        more_pages, url, _ = download_page(url.replace(hathi_domain, '', 1), pagecount)
-    else:
-        url = volume['url'].replace(hathi_domain, '', 1)
-    while more_pages:
-        pagecount += 1
-        more_pages, url, row = download_page(url, pagecount)
+
+def is_empty_volume_file(filepath):
+    with open(filepath, 'rb') as txt_file:
+        return txt_file.read(tail_block).rstrip(b'\r\n') in (b'',) + volume_headers
+
+
+def read_last_page(filepath):
+    # Returns the url, page number and end offset of the last complete row of a volume csv, or None if it has no
+    # complete rows. The file is read backwards in growing blocks until the last complete row is found:
+    size = Path(filepath).stat().st_size
+    block = tail_block
+    with open(filepath, 'rb') as txt_file:
+        while True:
+            start = max(0, size - block)
+            txt_file.seek(start)
+            data = txt_file.read()
+            found, row, row_end = find_last_row(data, whole_file=not start)
+            if found:
+                return (row['url'], int(row['page']), start + row_end) if row else None
+            block *= 4
+
+
+def find_last_row(data, whole_file):
+    # Returns whether the search is settled, with the last complete row and where it ends. Rows are tried from last
+    # to first, and a crash can leave part of a row after the last complete one. Page text can contain lines that
+    # look like a row, so a row is only accepted if its page comes after the row before it (pages without text are
+    # skipped, so the page numbers can have gaps). If the row before isn't in data, the search isn't settled until
+    # more of the file is read:
+    starts = [match.start() for match in row_start_pattern.finditer(data)]
+    for i in reversed(range(len(starts))):
+        row, row_end = read_page_row(data, starts[i])
         if row:
-            while True:
-                with open(filepath, 'a', newline='', encoding='utf8') as txt_file:
-                    writer = csv.DictWriter(txt_file, fieldnames)
-                    writer.writerow(row)
-                    break
+            previous = previous_page(data, starts[:i], starts[i], whole_file)
+            if previous is None:
+                return False, None, None
+            if 0 <= previous < int(row['page']):
+                return True, row, row_end
+    return whole_file, None, None
+
+
+def previous_page(data, starts, row_start, whole_file):
+    # Returns the page number of the row ending at row_start, 0 if the header does, -1 if neither does, or None if
+    # the row before may be further back than data. Quotes in the text are doubled, so a line inside the quoted text
+    # of a row is always an odd number of quotes away from a real row start, and only the nearest start an even
+    # number of quotes back can be the row before:
+    quotes = 0
+    end = row_start
+    for start in reversed(starts):
+        quotes += data.count(b'"', start, end)
+        end = start
+        if not quotes % 2:
+            row, row_end = read_page_row(data, start)
+            return int(row['page']) if row and row_end == row_start else -1
+    if whole_file:
+        return 0 if data[:row_start].rstrip(b'\r\n') in volume_headers else -1
+    return None
+
+
+def read_page_row(data, start):
+    # Returns the csv record starting at start and the offset it ends at, or None if it is cut short or isn't a
+    # page row. The reader takes one line at a time, so the record ends after the last line it took:
+    line_ends = []
+
+    def lines():
+        position = start
+        while position < len(data):
+            line_ends.append(data.find(b'\n', position) + 1 or len(data))
+            yield data[position:line_ends[-1]].decode('utf8')
+            position = line_ends[-1]
 
-    # Update the record of volume downloads:
-    with write_lock:
-        completion = 1
-        rows = []
-        for row in read_index_rows():
-            if row['downloaded']:
+    try:
+        row = next(csv.DictReader(lines(), page_fieldnames, strict=True))
+    except (StopIteration, UnicodeDecodeError, csv.Error):
+        return None, None
+    if (data[line_ends[-1] - 1:line_ends[-1]] == b'\n' and row['text'] is not None and None not in row
+            and seq_pattern.search(row['url']) and row['page'].isdigit()):
+        return row, line_ends[-1]
+    return None, None
+
+
+def mark_downloaded(name, volume=None, feed=None, filename=None):
+    # Update the volume's row in the state store, hand it over for extraction, then report progress:
+    get_store().set_volume(name, downloaded=True)
+    metrics.count('volumes_downloaded')
+    if feed:
+        feed.submit(filename, volume)
+    completion = 0
+    for row in read_index_rows():
+        if row['downloaded']:
+            completion += 1
+            if row['name'].startswith(('70', '97', '136', '145')):
                 completion += 1
-                if row['name'].startswith(('70', '97', '136', '145')):
-                    completion += 1
-            elif name == row['name']:
-                row['downloaded'] = True
-            rows.append(row)
-        percent = round(100 * completion / num_volumes, 2)
+    percent = round(100 * completion / num_volumes, 2)
+    log(progress, f'Volume {name} complete! Downloading {percent}{"%"} ({completion}/{num_volumes}) complete at',
+        f'{datetime.now()} after {get_rate(start_time)}\n')
 
-        while True:
-            with open(volumeindex_filename, 'w', newline='', encoding='utf8') as url_file:
-                writer = csv.DictWriter(url_file, volumeindex_fieldnames)
-                writer.writeheader()
-                writer.writerows(rows)
-            print(f'Volume {name} complete! Downloading {percent}{"%"} ({completion}/{num_volumes}) complete at',
-                  f'{datetime.now()} after {get_rate(start_time)}\n')
-            break
 
+async def download_page(client, url, page, domain=hathi_domain, prefetched=None):
+    if prefetched is None:
+        response = await client.get(f'{domain}{url}')
+    else:
+        response = await fetch_speculatively(client, url, domain, prefetched)
+    attempt = 0
+    while response.status != 200:
+        attempt += 1
+        if attempt > page_retries:
+            raise HTTPError(response.url, response.status)
+        delay = page_retry_delay * 2 ** (attempt - 1)
+        print(f'HTTP Error {response.status} ({response.url}), retrying in {delay} seconds')
+        metrics.count('fetch_retries', host=urlsplit(domain).netloc)
+        await asyncio.sleep(delay)
+        response = await client.get(f'{domain}{url}')
+    count_page(client, urlsplit(domain).netloc)
+    return parse_page(response.text(), url, page)
+
+
+async def fetch_speculatively(client, url, domain, prefetched):
+    # Use the prefetched page if the previous page's anchor matched the guess, otherwise discard the guesses:
+    global speculative_hits
+    task = prefetched.pop(url, None)
+    if task:
+        speculative_hits += 1
+    else:
+        for stale in prefetched.values():
+            stale.cancel()
+        prefetched.clear()
+        task = asyncio.ensure_future(client.get(f'{domain}{url}'))
+
+    # Request the pages predicted to follow while there are requests to spare:
+    depth = speculative_pages if active_volumes * (speculative_pages + 1) <= max_in_flight else 0
+    for k in range(1, depth + 1):
+        guess = predict_page_url(url, k)
+        if guess and guess not in prefetched:
+            prefetched[guess] = asyncio.ensure_future(client.get(f'{domain}{guess}'))
 
-def download_page(url, page):
-    soup = download_soup(f'{hathi_domain}{url}')
+    return await task
 
+
+def predict_page_url(url, k):
+    seq = seq_pattern.search(url)
+    if seq:
+        return f'{url[:seq.start()]}{int(seq.group(0)) + k}{url[seq.end():]}'
+
+
+def parse_page(markup, url, page):
+    # Extract the OCR text of a page and the url of the page that follows it:
     row = {}
-    page_soup = soup.find(id='mdpPage')
-    text = page_soup.find(class_='Text')
-    if text:
-        row = {'retrieved': datetime.now(), 'url': url, 'page': page, 'text': text.string}
+    has_text, text, anchors = hathi_page(markup)
+    if has_text:
+        row = {'retrieved': datetime.now(), 'url': url, 'page': page, 'text': text}
 
     url = ''
-    anchors = page_soup('a')
     if page == 1:
-        for a in anchors:
-            if a.get_text().strip() == 'Next Page':
-                url = a['href']
+        for a_text, href in anchors:
+            if a_text.strip() == 'Next Page':
+                url = href
     else:
-        url = anchors[1]['href']
+        url = anchors[1][1]
 
     return url != '#top', url, row
 
 
+def count_page(client, host):
+    # Report the download rate after the client has recovered from errors:
+    global total_pages_processed, interval_pages_processed, reported_errors
+    if client.errors > reported_errors:
+        reported_errors = client.errors
+        log(progress, f'Downloaded {total_pages_processed} pages in {get_rate(start_time)} at',
+            f'{round(total_pages_processed / (time.time() - start_time), 2)} p/s after {reported_errors} errors,',
+            f'{interval_pages_processed} pages downloaded since last error')
+        log(progress, 'Request rates:', limiter.stats())
+        interval_pages_processed = 0
+    total_pages_processed += 1
+    interval_pages_processed += 1
+    metrics.count('pages_fetched', host=host)
+    metrics.checkpoint()
+
+
 def download_soup(url):
     # Retrieves a url and returns soup from parsed HTML.
     # This method is threadsafe and from a single client IP it is useful for
     # bombarding a domain with hundreds of queries per second if their
-    # server allows it and puts threads to sleep if the server times out
-    # until the server is ready to start receiving requests again.
-    global total_pages_processed, responsive, tries, interval_pages_processed
+    # server allows it. Requests are paced per host by the adaptive rate limiter,
+    # so an error only slows down requests to the host that failed.
+    global total_pages_processed, tries, interval_pages_processed
+    host = urlsplit(url).netloc
 
-    with responsive_lock:
-        while not responsive:
-            time.sleep(0.5)
     while True:
+        limiter.acquire(host)
         try:
             # download then parse the page and return if successful
-            soup = bs(urlopen(url), 'html.parser')
-            responsive = True
+            soup = make_soup(cached_urlopen(url))
+            limiter.record(host, 200)
 
             with count_lock:
                 if tries > 0:
                     # reset attempt counter
                     interval_pages_processed = tries = 0
-                    print(f'Downloaded {total_pages_processed} pages in {get_rate(start_time)} at',
-                          f'{round(total_pages_processed / (time.time() - start_time), 2)} p/s')
+                    log(progress, f'Downloaded {total_pages_processed} pages in {get_rate(start_time)} at',
+                        f'{round(total_pages_processed / (time.time() - start_time), 2)} p/s')
                 total_pages_processed += 1
                 interval_pages_processed += 1
+            metrics.count('pages_fetched', host=host)
 
             return soup
 
         except Exception as exception:
-            responsive = False
-            with sleep_lock:
-                if not responsive:
-                    print(exception, f'\n{interval_pages_processed} pages downloaded since last error')
-                    time.sleep(1)
-                    if not responsive:
-                        time.sleep(4)
-                        tries += 1
-                        print(f'Attempting to retrieve: {url}')
+            status = getattr(exception, 'code', None)
+            limiter.record(host, status, error=None if status else exception)
+            metrics.count('fetch_retries', host=host)
+            with count_lock:
+                tries += 1
+                print(exception, f'\n{interval_pages_processed} pages downloaded since last error')
+                print(f'Attempting to retrieve: {url} at {limiter.rate(host)} requests/s')
 
 
 def main():
@@ -285,6 +484,9 @@ def main():
     except Exception as exception:
         raise exception
     finally:
+        get_store().export_csv()
+        metrics.export()
+        print('Request rates:', limiter.stats())
         print(f"--- Job took {get_rate(start_time)} ---\n")
 
 
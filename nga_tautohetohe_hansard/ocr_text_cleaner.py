@@ -1,97 +1,159 @@
 # import libraries
-import csv
+import sys
 import time
 import re
 from taumahi import *
-from os import listdir
-from os.path import isfile, join, exists
+from os import cpu_count
+from multiprocessing import Pool
+from threading import Lock
+from nga_tautohetohe_hansard.kupu_cache import kupu_cache, kupu_ratios
+from nga_tautohetohe_hansard.match_guard import MatchGuard, quarantine
+from nga_tautohetohe_hansard.metrics import log, metrics, progress, utterances
+from nga_tautohetohe_hansard.state_store import get_store, version_fieldnames, volumeindex_fieldnames
+from nga_tautohetohe_hansard.corpus_writer import merge_partitions, split_combined_files, write_partition
+from nga_tautohetohe_hansard.page_store import open_pages, pages_digest, volume_files
+from nga_tautohetohe_hansard.profiler import instrument, profile, set_context
+from nga_tautohetohe_hansard.versioning import extractor_fingerprint, file_signature, is_stale
 
 indir = '1854-1987'
-volumeindex_filename = 'hansardvolumeindex.csv'
 rāindexfilename = 'hansardrāindex.csv'
 corpusfilename = 'hansardreomāori.csv'
-volumeindex_fieldnames = ['retrieved', 'url', 'name', 'period', 'session', 'format', 'downloaded', 'processed']
-dayindex_fieldnames = ['retrieved', 'url', 'volume', 'format', 'date1', 'date2', 'reo', 'ambiguous', 'other', 'percent',
-                       'incomplete']
-reo_fieldnames = ['url', 'volume', 'format', 'date1', 'date2', 'utterance', 'speaker', 'reo', 'ambiguous', 'other',
-                  'percent', 'text']
 hathi_domain = 'https://babel.hathitrust.org'
 
 # Vars for generating clean numeric dates from OCRed dates:
 months = {1: 'january', 2: 'february', 3: 'march', 4: 'april', 5: 'may', 6: 'june', 7: 'july', 8: 'august',
           9: 'september', 10: 'october', 11: 'november', 12: 'december'}
 inv_months = {v: k for k, v in months.items()}
-rā = māhina = tau = None
 
-
-def process_csv_files():
-    # Make output files if not exist:
-    if not exists(rāindexfilename):
-        with open(rāindexfilename, 'w', newline='', encoding='utf8') as f:
-            writer = csv.DictWriter(f, dayindex_fieldnames)
-            writer.writeheader()
-    if not exists(corpusfilename):
-        with open(corpusfilename, 'w', newline='', encoding='utf8') as f:
-            writer = csv.DictWriter(f, reo_fieldnames)
-            writer.writeheader()
-
-    # Process list of unprocessed volumes:
-    for result in map(process_csv, get_file_list()):
-        pass
+# Volumes are extracted in parallel by a pool of processes, set to 1 to extract them serially:
+num_processes = cpu_count()
+# Bump when a change other than to a regular expression alters the output, to have every volume reprocessed:
+extractor_version = 1
+
+
+def process_csv_files(processes=None):
+    # Process list of unprocessed volumes. Workers extract whole volumes while this process writes their rows,
+    # in volume order so the output is the same as a serial run:
+    processes = processes or num_processes
+    file_list = get_file_list()
+
+    # Reprocessed volumes simply replace their partitions:
+    stale = [v['name'] for f, v in file_list if v['processed']]
+    if stale:
+        print(f'Reprocessing {len(stale)} volumes whose pages or extractor changed:', ', '.join(stale))
+
+    if processes == 1:
+        for result in map(extract_volume, file_list):
+            write_volume(*result)
+    else:
+        with Pool(processes) as pool:
+            for result in pool.imap(extract_volume, file_list):
+                write_volume(*result)
+
+
+class ExtractionFeed:
+    """This class extracts volumes on a pool of processes as the downloader hands them over, so the corpus grows
+    while the crawl runs. Each volume's partition is written as its extraction finishes, from the pool's result
+    thread."""
+
+    def __init__(self, processes=None):
+        # Load the kupu cache first so the workers start with it:
+        split_combined_files()
+        kupu_cache.load()
+        self.pool = Pool(processes or num_processes)
+        self.errors = []
+        self.submitted = 0
+        self.lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_value is None:
+            self.close()
+            return
+        # The queued volumes are still extracted when the download fails, but an extraction error mustn't hide the
+        # download error, so it is printed instead:
+        try:
+            self.close()
+        except Exception as exception:
+            print('Extraction failed while the download was stopping:', repr(exception))
+
+    def submit(self, f, v):
+        # Queue a downloaded volume, f is its file name in indir. Volumes are handed over from executor threads:
+        with self.lock:
+            self.submitted += 1
+        self.pool.apply_async(extract_volume, ((f, v),), callback=self.__write, error_callback=self.errors.append)
+
+    def close(self):
+        # Wait for the queued volumes, then raise the first extraction error if there was one:
+        self.pool.close()
+        self.pool.join()
+        print(f'Extracted {self.submitted - len(self.errors)} of {self.submitted} volumes while downloading')
+        if self.errors:
+            raise self.errors[0]
+
+    def __write(self, result):
+        try:
+            write_volume(*result)
+        except Exception as exception:
+            self.errors.append(exception)
 
 
 def get_file_list():
-    volume_list = read_index_rows()
-    file_list = [f for f in listdir(indir) if isfile(join(indir, f)) and f.endswith('.csv')]
+    # List the volumes that haven't been processed, or whose pages or extractor changed since they were:
+    volume_list = read_index_rows(volumeindex_fieldnames + version_fieldnames)
+    # Volumes are read from their page store, or their csv if they haven't been converted:
+    file_list = volume_files(indir)
+    fingerprint = extractor_fingerprint(sys.modules[__name__], extractor_version)
 
-    for v in volume_list:
-        for f in file_list:
-            if v['name'] == f[:f.index('.csv')] and not v['processed']:
-                yield f, v
+    return [(file_list[v['name']], v) for v in volume_list if v['name'] in file_list and (
+        not v['processed'] or is_stale(get_store(), v, f'{indir}/{file_list[v["name"]]}', fingerprint, pages_digest))]
 
 
-def read_index_rows():
-    while True:
-        rows = []
-        with open(volumeindex_filename, 'r', newline='', encoding='utf8') as v_index:
-            reader = csv.DictReader(v_index)
-            for row in reader:
-                if not row['name'].isdigit() or int(row['name']) < 483:
-                    rows.append(row)
-            return rows
+def read_index_rows(fieldnames=volumeindex_fieldnames):
+    return [row for row in get_store().volume_rows(fieldnames)
+            if not row['name'].isdigit() or int(row['name']) < 483]
 
 
-def process_csv(args):
+def extract_volume(args):
     f, v = args
-    print(f'Extracting corpus from {f}:')
+    log(progress, f'Extracting corpus from {f}:')
+
+    # Record which pages and extractor the rows come from, the signature is taken first in case the file changes:
+    filepath = f'{indir}/{f}'
+    versions = {'input_signature': file_signature(filepath), 'input_hash': pages_digest(filepath),
+                'extractor': extractor_fingerprint(sys.modules[__name__], extractor_version)}
 
     # Process the volume:
-    Volume(f, v).process_pages()
-
-    # Update the record of processed volumes:
-    rows = []
-    for row in read_index_rows():
-        if v['name'] == row['name']:
-            row['processed'] = True
-        rows.append(row)
-
-    while True:
-        with open(volumeindex_filename, 'w', newline='', encoding='utf8') as v_index:
-            writer = csv.DictWriter(v_index, volumeindex_fieldnames)
-            writer.writeheader()
-            writer.writerows(rows)
-        break
+    volume = Volume(f, v)
+    with metrics.timer('volume_seconds', format='OCR'):
+        volume.process_pages()
+    log(progress, f'Kupu cache after {f}:', kupu_cache.stats())
+    # Hand this process's metrics back with the rows, as the volume may have been extracted by a worker:
+    return v, volume.day_rows, volume.corpus_rows, versions, metrics.drain()
+
+
+def write_volume(v, day_rows, corpus_rows, versions, worker_metrics):
+    metrics.merge(worker_metrics)
+    write_partition('OCR', v['name'], day_rows, corpus_rows)
+
+    # Update the record of processed volumes once its rows are safely on disk:
+    get_store().set_volume(v['name'], processed=True, **versions)
+    metrics.count('volumes_extracted', format='OCR')
+    metrics.checkpoint()
 
     return v['name']
 
 
 class Volume(object):
-    """This class loads the pages of a volume from a csv and sorts through the text to extract kōrero reo Māori &
+    """This class loads the pages of a volume from a page store or csv and sorts through the text to extract kōrero reo Māori &
     numerical information."""
 
     def __init__(self, filename, v):
         # Initialise instance and store some associated meta data:
         self.filename = filename
+        self.day_rows, self.corpus_rows = [], []
         self.day, self.speech, self.totals = {}, {'utterance': 0}, {'reo': 0, 'ambiguous': 0, 'other': 0}
         self.day['format'] = self.speech['format'] = 'OCR'
         self.day['volume'] = self.speech['volume'] = v['name']
@@ -102,38 +164,46 @@ class Volume(object):
             self.day['retrieved'] = v['retreived']
         self.flag294 = int(self.speech['volume'].isdigit() and int(self.speech['volume']) >= 294)
         self.flag410 = int(self.flag294 and int(self.speech['volume']) >= 410)
-
-        date = re.match('(\d{1,2}) ([a-zA-Z]+) (\d{4})', v['period'])
-        global rā, māhina, tau
-        rā = int(date.group(1))
-        māhina = inv_months[date.group(2).lower()]
-        tau = int(date.group(3))
+        # The header and speaker patterns can backtrack for minutes on some OCR pages, so they are time limited:
+        self.guard = MatchGuard(v['name'])
+        # Time spent in each stage's patterns, added up over the volume as they run on every page and paragraph:
+        self.regex_seconds = dict.fromkeys(['OCR dates', 'OCR headers', 'OCR line filters', 'OCR speakers'], 0)
+
+        date = period_pattern.match(v['period'])
+        self.rā = int(date.group(1))
+        self.māhina = inv_months[date.group(2).lower()]
+        self.tau = int(date.group(3))
         self.day['date1'] = self.speech['date1'] = date.group(0)
-        self.speech['date2'] = self.day['date2'] = f'{tau}-{māhina}-{rā}'
+        self.speech['date2'] = self.day['date2'] = f'{self.tau}-{self.māhina}-{self.rā}'
         self.same_day_flag = False
+        set_context(format='OCR', volume=self.day['volume'], date=self.day['date2'])
 
     def process_pages(self):
         """Invoke this method from a class instance to process the debates."""
 
-        # Open volume csv & read row pages:
-        with open(f'{indir}/{self.filename}', 'r', newline='', encoding='utf8') as kiroto:
-            reader = csv.DictReader(kiroto)
-            day = []  # day list will hold pages of text
-            for page in reader:
-                if not (page['url'].endswith(('c', 'l', 'x', 'v', 'i')) or page['page'] == '1') and re.search(
-                        '[a-zA-Z]', page['text']):
-                    day = self.__process_page(page, day)
+        # Open volume & read row pages:
+        day = []  # day list will hold pages of text
+        for page in open_pages(f'{indir}/{self.filename}'):
+            if not (page['url'].endswith(('c', 'l', 'x', 'v', 'i')) or page['page'] == '1') and \
+                    letter_pattern.search(page['text']):
+                day = self.__process_page(page, day)
+                metrics.count('pages_extracted', format='OCR')
+        for stage, seconds in self.regex_seconds.items():
+            metrics.count('regex_seconds', seconds, stage=stage)
 
     def __process_page(self, page, day):
+        # Scan the page by offset rather than slicing off each day found:
         text = page['text']
+        pos = 0
         looped = 0
-        global rā, māhina, tau
 
         while True:
-            next_day = date_pattern[self.flag294].search(text)
+            t = time.perf_counter()
+            next_day = date_pattern[self.flag294].search(text, pos)
+            self.regex_seconds['OCR dates'] += time.perf_counter() - t
             if next_day and not next_day.group(0).startswith('Swainson'):
-                header = None if looped else header_pattern.match(text[:next_day.start()])
-                previoustext = text[:next_day.start()] if not header else text[header.end():next_day.start()]
+                header = None if looped else self.__match_header(text[:next_day.start()], page)
+                previoustext = text[pos:next_day.start()] if not header else text[header.end():next_day.start()]
                 # if not looped:
                 #     header = header_pattern.match(text[:next_day.start()])
                 # if header:
@@ -151,13 +221,13 @@ class Volume(object):
                 m = next_day.group(2).lower()
                 m = 1 if m not in inv_months else inv_months[m]
                 t = next_day.group(3)
-                if re.match('[ABCDE]'|'261', self.day['volume']) and t.isdigit() and int(t) - tau == 1:
-                    tau += 1
-                    rā, māhina = r, m
-                elif 0 < m - māhina:
-                    rā, māhina = r, m
-                elif 0 < r - rā:
-                    rā = r
+                if split_year_pattern.match(self.day['volume']) and t.isdigit() and int(t) - self.tau == 1:
+                    self.tau += 1
+                    self.rā, self.māhina = r, m
+                elif 0 < m - self.māhina:
+                    self.rā, self.māhina = r, m
+                elif 0 < r - self.rā:
+                    self.rā = r
                 else:
                     self.same_day_flag = True
 
@@ -165,16 +235,16 @@ class Volume(object):
                 if not self.same_day_flag and sum(self.totals.values()) > 50:
                     self.day['percent'] = get_percentage(**self.totals)
                     self.day.update(self.totals)
-                    with open(rāindexfilename, 'a', newline='', encoding='utf8') as output:
-                        writer = csv.DictWriter(output, dayindex_fieldnames)
-                        writer.writerow(self.day)
+                    self.day_rows.append(dict(self.day))
+                    metrics.count('days_extracted', format='OCR')
 
                 # Reset page list and day totals, get meta info for next day:
                 day = []
                 if not self.same_day_flag or sum(self.totals.values()) <= 50:
                     self.totals = {'reo': 0, 'ambiguous': 0, 'other': 0}
                     self.day['date1'] = clean_whitespace(next_day.group(0))
-                    self.speech['date2'] = self.day['date2'] = f'{tau}-{māhina}-{rā}'
+                    self.speech['date2'] = self.day['date2'] = f'{self.tau}-{self.māhina}-{self.rā}'
+                    set_context(date=self.day['date2'])
                     self.day['url'] = page['url'] if page['url'].startswith('https') else '{}{}'.format(hathi_domain,
                                                                                                         page['url'])
                     self.day['retrieved'] = page['retrieved'] if ('retrieved' in page) else page['retreived']
@@ -183,50 +253,61 @@ class Volume(object):
                 self.speech['date1'] = clean_whitespace(next_day.group(0))
                 self.speech['url'] = page['url'] if page['url'].startswith('https') else '{}{}'.format(hathi_domain,
                                                                                                        page['url'])
-                text = text[next_day.end():]
+                pos = next_day.end()
                 looped += 1
             else:
                 # No more dates in page, append rest of text to page list and return list:
                 if not looped:
-                    header = header_pattern.match(text)
+                    header = self.__match_header(text, page)
                     if header:
-                        text = text[header.end():]
-                if text:
-                    day.append(text.strip())
+                        pos = header.end()
+                if pos < len(text):
+                    day.append(text[pos:].strip())
                 return day
 
+    def __match_header(self, text, page):
+        t = time.perf_counter()
+        header = self.guard.match(header_pattern, text, 'header_pattern', page=page['page'], url=page['url'],
+                                  date=self.day['date2'])
+        self.regex_seconds['OCR headers'] += time.perf_counter() - t
+        return header
+
     def __process_day(self, day):
+        t = time.perf_counter()
         # Join pages and remove hyphenated line breaks
-        text = re.sub('(?<=[a-z]) *-\n+ *(?=[a-z])', '', '\n'.join(day))
+        text = hyphenation_pattern.sub('', '\n'.join(day))
 
         # Remove name lists, ayes and noes
         # Remove lines with no letters, short lines, single word lines and lines of punctuation, capitals, digits
-        regex = ['([A-Z][ a-zA-Z.]+, ){2}[A-Z][ a-zA-Z.]+\.', '(AYE|Aye|NOE|Noe)[^\n]*', '[^A-Za-z]*', '[^\n]{1,2}',
-                 '[ \-\d,A-Z.?!:]+', '[a-zA-Z]+', ]
-        for r in regex:
-            text = re.sub('(?<=\n){}\n'.format(r), '', text)
+        text = line_filter.sub('', text)
+        self.regex_seconds['OCR line filters'] += time.perf_counter() - t
 
         self.__process_paragraphs(text)
 
     def __process_paragraphs(self, text):
         utterance = []
+        pos = 0
         while True:
             # Look for paragraph endings and separate text:
-            p_break = paragraph_pattern.search(text)
+            p_break = paragraph_pattern.search(text, pos)
             if p_break:
 
-                utterance = self.__process_paragraph(text[:p_break.start()], utterance)
+                utterance = self.__process_paragraph(text[pos:p_break.start()], utterance)
 
-                text = text[p_break.end():]
+                pos = p_break.end()
             else:
-                utterance = self.__process_paragraph(text, utterance)
+                utterance = self.__process_paragraph(text[pos:], utterance)
                 if utterance:
                     self.__write_row(utterance)
                 break
 
     def __process_paragraph(self, text, utterance):
         # Check to see if paragraph declares name of speaker:
-        kaikōrero = newspeaker_pattern[self.flag410].match(text)
+        t = time.perf_counter()
+        kaikōrero = self.guard.match(newspeaker_pattern[self.flag410], text, f'newspeaker_pattern[{self.flag410}]',
+                                     url=self.day['url'], date=self.day['date2'])
+        self.regex_seconds['OCR speakers'] += time.perf_counter() - t
+        pos = 0
         if kaikōrero:
             name = kaikōrero.group(1)
             if name:
@@ -235,24 +316,24 @@ class Volume(object):
                     self.__write_row(utterance)
                     utterance = []
                 self.speech['speaker'] = clean_whitespace(name)
-                text = text[kaikōrero.end():]
+                pos = kaikōrero.end()
 
         # Build up list of consecutive te reo sentences and return:
-        return self.__process_sentences(text, utterance)
+        return self.__process_sentences(text, utterance, pos)
 
-    def __process_sentences(self, text, utterance):
+    def __process_sentences(self, text, utterance, pos=0):
         consecutive = {'reo': True} if utterance else {'reo': False}
         consecutive['other'] = False
         loop_flag, nums = True, {}
 
         while loop_flag:
             # Look for sentence / statement like endings and separate text:
-            next_sentence = new_sentence.search(text)
+            next_sentence = new_sentence.search(text, pos)
             if next_sentence:
-                sentence = text[:next_sentence.start() + 1]
-                text = text[next_sentence.end():]
+                sentence = text[pos:next_sentence.start() + 1]
+                pos = next_sentence.end()
             else:
-                sentence = text
+                sentence = text[pos:]
                 loop_flag = False
 
             # Check to see if sentence is te reo Māori and build list of consecutive sentences if so:
@@ -279,17 +360,11 @@ class Volume(object):
                     self.speech['utterance'] += 1
 
                 # Record nums count if text is part of speech:
-                first_letter = re.search('[a-zA-Z£]', sentence)
+                first_letter = first_letter_pattern.search(sentence)
                 if first_letter:
                     sentence = sentence[first_letter.start():]
                     if 5 < len(sentence):
-                        bad_egg = re.match(
-                            '([^ A-Z]+ )?[A-Z][^ ]*(([^a-zA-Z]+[^ A-Z]*){1,2}[A-Z][^ ]*)*(([^a-zA-Z]+[^ A-Z]*){2})?',
-                            sentence)
-                        if not bad_egg:
-                            bad_egg = re.match('([^ ]{1,3} )+[^ ]{1,3}', sentence)
-
-                        if not (bad_egg and bad_egg.group(0) == sentence):
+                        if not is_bad_egg(sentence):
                             for k, v in nums.items():
                                 if k != 'percent':
                                     self.totals[k] += v
@@ -300,17 +375,12 @@ class Volume(object):
 
     def __write_row(self, text):
         text = ' '.join(text)
-        first_letter = re.search('[a-zA-Z£]', text)
+        first_letter = first_letter_pattern.search(text)
         length = len(text)
         # Filter garbage and save results if good:
         if first_letter and length > 3:
             text = text[first_letter.start():]
-            bad_egg = re.match(
-                '([^ A-Z]+ )?[A-Z][^ ]*(([^a-zA-Z]+[^ A-Z]*){1,2}[A-Z][^ ]*)*(([^a-zA-Z]+[^ A-Z]*){2})?', text)
-            if not bad_egg:
-                bad_egg = re.match('([^ ]{1,3} )+[^ ]{1,3}', text)
-
-            if not (bad_egg and bad_egg.group(0) == text):
+            if not is_bad_egg(text):
                 c, nums = kupu_ratios(text, tohutō=False)
                 for k, v in nums.items():
                     if k != 'percent':
@@ -320,11 +390,36 @@ class Volume(object):
                 if c and nums['reo'] > 2 and nums['other'] < 20:
                     self.speech['text'] = text
                     self.speech.update(nums)
-                    print(self.speech['text'])
-                    with open(corpusfilename, 'a', newline='', encoding='utf8') as output:
-                        writer = csv.DictWriter(output, reo_fieldnames)
-                        writer.writerow(self.speech)
+                    log(utterances, self.speech['text'])
+                    self.corpus_rows.append(dict(self.speech))
+
+
+def is_bad_egg(text):
+    # Checks whether text is entirely OCR garbage of capitalised fragments or short clumps of characters:
+    bad_egg = bad_egg_patterns[0].match(text) or bad_egg_patterns[1].match(text)
+    return bad_egg and bad_egg.group(0) == text
+
 
+# Patterns used for every volume, page, day and sentence are compiled once here:
+period_pattern = re.compile('(\d{1,2}) ([a-zA-Z]+) (\d{4})')
+letter_pattern = re.compile('[a-zA-Z]')
+first_letter_pattern = re.compile('[a-zA-Z£]')
+bad_egg_patterns = [
+    re.compile('([^ A-Z]+ )?[A-Z][^ ]*(([^a-zA-Z]+[^ A-Z]*){1,2}[A-Z][^ ]*)*(([^a-zA-Z]+[^ A-Z]*){2})?'),
+    re.compile('([^ ]{1,3} )+[^ ]{1,3}')]
+
+# Volumes whose dates roll over into the next year without a new volume:
+split_year_pattern = re.compile('[ABCDE]|261')
+
+# Joins words hyphenated across line breaks:
+hyphenation_pattern = re.compile('(?<=[a-z]) *-\n+ *(?=[a-z])')
+
+# Lines removed from each day: name lists, ayes and noes, lines with no letters, short lines,
+# lines of punctuation, capitals and digits, and single word lines. Each alternative only matches whole lines,
+# so one pass over the day removes the same lines as applying them one after another:
+line_filter = re.compile('(?<=\n)({})\n'.format('|'.join([
+    '([A-Z][ a-zA-Z.]+, ){2}[A-Z][ a-zA-Z.]+\.', '(AYE|Aye|NOE|Noe)[^\n]*', '[^A-Za-z]*', '[^\n]{1,2}',
+    '[ \-\d,A-Z.?!:]+', '[a-zA-Z]+'])))
 
 # New header pattern from volume 359 onwards (5 Dec 1968), 440 onwards - first 3 lines, 466 onward - 1 line
 header_pattern = re.compile(
@@ -355,14 +450,23 @@ newspeaker_pattern = [re.compile(
 # '([A-Z .:—-]*\n)*[A-Z]([^(\n]+\([^-—\n]+[-—]*\n)?[a-zA-Z". ()]+\. ?[-—]+(?!\n)'
 
 
-def main():
+def main(merge=True):
     try:
         print('Processing text from volumes 1854-1987:')
+        split_combined_files()
+        kupu_cache.load()
         process_csv_files()
+        if merge:
+            merge_partitions(corpusfilename, rāindexfilename)
         print('Corpus aggregation successful')
     except Exception as exception:
         raise exception
     finally:
+        get_store().export_csv()
+        kupu_cache.save()
+        metrics.export()
+        quarantine.flush()
+        profile.write_report()
         print(f"--- Job took {get_rate()} ---\n")
 
 
@@ -380,5 +484,8 @@ def get_rate():
     return f'{s} seconds'
 
 
+# Time every pattern and kupu_ratios call when profiling is switched on:
+instrument(sys.modules[__name__])
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,207 @@
+# import libraries
+import csv
+import hashlib
+import json
+import mmap
+import struct
+import zlib
+from os import listdir, remove, replace
+from os.path import exists, join, splitext
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+volumes_dir = '1854-1987'
+page_fieldnames = ['retrieved', 'url', 'page', 'text']
+store_extension = '.pages'
+magic = b'HANSARDPAGES\x01'
+# Pages compressed together, larger blocks compress better but a random page read decompresses the whole block:
+block_pages = 16
+# Use zstd when the zstandard package is installed, otherwise zlib from the standard library:
+default_codec = 'zstd' if zstandard else 'zlib'
+
+
+class PageStore:
+    """This class reads a volume saved by write_page_store. The file starts with a header holding the fieldnames,
+    codec and the offset and page count of every compressed block of pages, and is memory mapped so any page can be
+    read by decompressing only the block holding it."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.file = open(filepath, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(magic)] != magic:
+            self.close()
+            raise ValueError(f'{filepath} is not a page store')
+        header_length, = struct.unpack_from('>I', self.map, len(magic))
+        data_start = len(magic) + 4 + header_length
+        header = json.loads(self.map[len(magic) + 4:data_start].decode('utf8'))
+        self.fieldnames = header['fieldnames']
+        self.codec = header['codec']
+        self.blocks = [(data_start + offset, length, count) for offset, length, count in header['blocks']]
+
+        # Index of the first page of each block:
+        self.block_starts, n = [], 0
+        for _, _, count in self.blocks:
+            self.block_starts.append(n)
+            n += count
+        self.page_count = n
+        self.cached_block = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.page_count
+
+    def __getitem__(self, i):
+        # Random access to the row of page i, counting from 0:
+        if i < 0:
+            i += self.page_count
+        if not 0 <= i < self.page_count:
+            raise IndexError(i)
+        b = self.__block_of(i)
+        return self.__read_block(b)[i - self.block_starts[b]]
+
+    def __iter__(self):
+        return self.pages()
+
+    def pages(self, start=0, stop=None):
+        # Stream rows from page start up to page stop one block at a time:
+        stop = self.page_count if stop is None else min(stop, self.page_count)
+        if start >= stop:
+            return
+        for b in range(self.__block_of(start), len(self.blocks)):
+            first = self.block_starts[b]
+            if first >= stop:
+                break
+            for row in self.__read_block(b)[max(start - first, 0):stop - first]:
+                yield row
+
+    def close(self):
+        if not self.map.closed:
+            self.map.close()
+        self.file.close()
+
+    def __block_of(self, i):
+        # Binary search for the block holding page i:
+        lo, hi = 0, len(self.block_starts) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.block_starts[mid] <= i:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def __read_block(self, b):
+        # Decompress a block into csv style row dictionaries, keeping the last block read for sequential access:
+        if self.cached_block[0] != b:
+            offset, length, _ = self.blocks[b]
+            rows = json.loads(decompress(self.map[offset:offset + length], self.codec).decode('utf8'))
+            self.cached_block = (b, [dict(zip(self.fieldnames, row)) for row in rows])
+        return self.cached_block[1]
+
+
+def write_page_store(filepath, rows, fieldnames=page_fieldnames, codec=default_codec):
+    # Save rows in the page store format, written to a temporary file first so a crash can't leave half a store:
+    blocks, data, block = [], [], []
+    offset = 0
+
+    def add_block():
+        nonlocal offset
+        compressed = compress(json.dumps(block, ensure_ascii=False).encode('utf8'), codec)
+        blocks.append([offset, len(compressed), len(block)])
+        data.append(compressed)
+        offset += len(compressed)
+
+    for row in rows:
+        # Values are kept as the strings a csv would hold:
+        block.append(['' if row.get(k) is None else str(row[k]) for k in fieldnames])
+        if len(block) == block_pages:
+            add_block()
+            block = []
+    if block:
+        add_block()
+
+    header = json.dumps({'fieldnames': fieldnames, 'codec': codec, 'blocks': blocks}).encode('utf8')
+    with open(f'{filepath}.tmp', 'wb') as store:
+        store.write(magic)
+        store.write(struct.pack('>I', len(header)))
+        store.write(header)
+        for compressed in data:
+            store.write(compressed)
+    replace(f'{filepath}.tmp', filepath)
+
+
+def convert_csv(csv_path, remove_csv=True):
+    # Convert a downloaded volume csv into a page store beside it, returning the path of the store:
+    filepath = f'{splitext(csv_path)[0]}{store_extension}'
+    with open(csv_path, 'r', newline='', encoding='utf8') as kiroto:
+        reader = csv.DictReader(kiroto)
+        write_page_store(filepath, reader, reader.fieldnames)
+    if remove_csv:
+        remove(csv_path)
+    return filepath
+
+
+def open_pages(filepath):
+    # Yields the page rows of a volume from its page store, or from its csv if it hasn't been converted:
+    if filepath.endswith(store_extension):
+        with PageStore(filepath) as store:
+            yield from store
+    else:
+        with open(filepath, 'r', newline='', encoding='utf8') as kiroto:
+            yield from csv.DictReader(kiroto)
+
+
+def pages_digest(filepath):
+    # Hash of the page rows of a volume, the same for its csv and its page store:
+    digest = hashlib.sha256()
+    for row in open_pages(filepath):
+        digest.update('\x1f'.join(row.get(k) or '' for k in page_fieldnames).encode('utf8'))
+        digest.update(b'\x1e')
+    return digest.hexdigest()
+
+
+def volume_files(directory=volumes_dir):
+    # Maps each volume name to its page store, or its csv if there is no store:
+    files = {}
+    for f in sorted(listdir(directory)):
+        name, extension = splitext(f)
+        if extension == store_extension or (extension == '.csv' and name not in files):
+            files[name] = f
+    return files
+
+
+def compress(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return zlib.compress(data, 9)
+
+
+def decompress(data, codec):
+    if codec == 'zstd':
+        if not zstandard:
+            raise ImportError('The zstandard package is needed to read this page store')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def main():
+    # Convert the csvs of all downloaded volumes into page stores:
+    from nga_tautohetohe_hansard.state_store import get_store
+    downloaded = {row['name'] for row in get_store().volume_rows() if row['downloaded']}
+    for name, f in volume_files().items():
+        if name in downloaded and f.endswith('.csv') and exists(join(volumes_dir, f)):
+            print(f'Converting {f}')
+            convert_csv(join(volumes_dir, f))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,33 @@
 # import libraries
-import csv
+import sys
 import time
 from datetime import datetime
 from taumahi import *
-from os import listdir
-from os.path import isfile, join, exists
-from bs4 import BeautifulSoup as bs
+from os import listdir, cpu_count
+from multiprocessing import Pool
+from os.path import isfile, join
+from nga_tautohetohe_hansard.html_parser import make_soup
+from nga_tautohetohe_hansard.http_cache import cached_urlopen
+from nga_tautohetohe_hansard.kupu_cache import kupu_cache, kupu_ratios
+from nga_tautohetohe_hansard.metrics import log, metrics, progress, utterances
+from nga_tautohetohe_hansard.profiler import instrument, profile, set_context, tally
+from nga_tautohetohe_hansard.state_store import get_store, version_fieldnames, volumeindex_fieldnames
+from nga_tautohetohe_hansard.corpus_writer import merge_partitions, split_combined_files, write_partition
+from nga_tautohetohe_hansard.versioning import extractor_fingerprint, file_digest, file_signature, is_stale
 
-volumeindex_filename = 'hansardvolumeindex.csv'
 rāindexfilename = 'hansardrāindex.csv'
 corpusfilename = 'hansardreomāori.csv'
-volumeindex_fieldnames = ['retrieved', 'url', 'name', 'period', 'session', 'format', 'downloaded', 'processed']
-rāindex_fieldnames = ['retrieved', 'url', 'volume', 'format', 'date1', 'date2', 'reo', 'ambiguous', 'other', 'percent',
-                      'incomplete']
-reo_fieldnames = ['url', 'volume', 'format', 'date1', 'date2', 'utterance', 'speaker', 'reo', 'ambiguous', 'other',
-                  'percent', 'text']
 
 # Vars for generating numeric dates from literal regexed dates:
 months = {1: 'january', 2: 'february', 3: 'march', 4: 'april', 5: 'may', 6: 'june', 7: 'july', 8: 'august',
           9: 'september', 10: 'october', 11: 'november', 12: 'december'}
 inv_months = {v: k for k, v in months.items()}
 
+# Volumes are processed in parallel by a pool of processes, set to 1 to process them serially:
+num_processes = cpu_count()
+# Bump when a change other than to a regular expression alters the output, to have every volume reprocessed:
+extractor_version = 1
+
 
 class Speech:
     """This class stores the speaker name and the paragraphs of the speaker's speech."""
@@ -38,43 +45,77 @@ class Utterance:
         self.condition, self.ratios = kupu_ratios(txt, has_tohutō)
 
 
-def process_txt_files(dirpath):
-    # Create output files if not exists:
-    if not exists(rāindexfilename):
-        with open(rāindexfilename, 'w', newline='', encoding='utf8') as f:
-            csv.DictWriter(f, rāindex_fieldnames).writeheader()
-    if not exists(corpusfilename):
-        with open(corpusfilename, 'w', newline='', encoding='utf8') as f:
-            csv.DictWriter(f, reo_fieldnames).writeheader()
-
-    # Iterate through volume file list:
-    for f, v in get_file_list(dirpath):
-        print(f'\nProcessing {f}:\n')
-
-        # Read from volume text files
-        txt = None
-        with open(f'{dirpath}/{f}', 'r', newline='', encoding='utf8') as hansard_txt:
-            txt = sub_vowels(page_break.sub('\n', hansard_txt.read()))
-            txt = re.sub(r'\[[^\]]*]', '', txt)
-            txt = re.sub('(?<=\n)([A-Z][a-zA-Z]*( [A-Z][a-z]*)*|(Noes|Ayes)[^\n]*)\n', '', txt)
-
-        # Sort through text with RegEx,
-        # Extracting te reo corpus and information about each day of debates, then write to file:
-        tuhituhikifile(v, txt)
-
-        # Update record of processed volumes:
-        v_rows = []
-        with open(volumeindex_filename, 'r', newline='', encoding='utf8') as vol_file:
-            reader = csv.DictReader(vol_file)
-            for row in reader:
-                if row['name'] == v['name']:
-                    row['processed'] = True
-                v_rows.append(row)
-        with open(volumeindex_filename, 'w', newline='', encoding='utf8') as vol_file:
-            writer = csv.DictWriter(vol_file, volumeindex_fieldnames)
-            writer.writeheader()
-            writer.writerows(v_rows)
-        print(f'{f} processed at {datetime.now()} after {get_rate()}\n')
+def process_txt_files(dirpath, processes=None):
+    # Iterate through volume file list. Workers process whole volumes while this process writes their rows,
+    # in file list order so the output is the same as a serial run:
+    file_list = list(get_file_list(dirpath))
+    volumes = ((dirpath, f, v) for f, v in file_list)
+    processes = processes or num_processes
+
+    # Reprocessed volumes simply replace their partitions:
+    stale = [v['name'] for f, v in file_list if v['processed']]
+    if stale:
+        print(f'Reprocessing {len(stale)} volumes whose text or extractor changed:', ', '.join(stale))
+
+    if processes == 1:
+        for result in map(process_volume, volumes):
+            write_volume(*result)
+    else:
+        with Pool(processes) as pool:
+            for result in pool.imap(process_volume, volumes):
+                write_volume(*result)
+
+
+def process_volume(args):
+    dirpath, f, v = args
+    # Track the longest day of this volume, keeping the longest so far when running serially:
+    global most_loops, longest_day
+    previous = most_loops, longest_day
+    most_loops, longest_day = 0, ''
+    log(progress, f'\nProcessing {f}:\n')
+    set_context(format='PDF', volume=v['name'], date=None)
+
+    # Record which text and extractor the rows come from, the signature is taken first in case the file changes:
+    filepath = f'{dirpath}/{f}'
+    versions = {'input_signature': file_signature(filepath), 'input_hash': file_digest(filepath),
+                'extractor': extractor_fingerprint(sys.modules[__name__], extractor_version)}
+
+    # Sort through text with RegEx,
+    # Extracting te reo corpus and information about each day of debates:
+    with metrics.timer('volume_seconds', format='PDF'):
+        day_rows, corpus_rows = tuhituhikifile(v, read_volume_text(filepath))
+    log(progress, f'Kupu cache after {f}:', kupu_cache.stats())
+    loops, day = most_loops, longest_day
+    if previous[0] > loops:
+        most_loops, longest_day = previous
+    # Hand this process's metrics back with the rows, as the volume may have been processed by a worker:
+    return f, v, day_rows, corpus_rows, loops, day, versions, metrics.drain()
+
+
+def read_volume_text(filepath):
+    # Read a volume text file, removing page breaks, bracketed text, headings and division lists:
+    with open(filepath, 'r', newline='', encoding='utf8') as hansard_txt:
+        txt = hansard_txt.read()
+    t = time.perf_counter()
+    txt = cleanup_pattern.sub('', sub_vowels(page_break.sub('\n', txt)))
+    metrics.count('regex_seconds', time.perf_counter() - t, stage='PDF cleanup')
+    return txt
+
+
+def write_volume(f, v, day_rows, corpus_rows, loops, day, versions, worker_metrics):
+    global most_loops, longest_day
+    metrics.merge(worker_metrics)
+    if loops > most_loops:
+        most_loops, longest_day = loops, day
+
+    # Write te reo and day stats to file output:
+    write_partition('PDF', v['name'], day_rows, corpus_rows)
+
+    # Update record of processed volumes once its rows are safely on disk:
+    get_store().set_volume(v['name'], processed=True, **versions)
+    metrics.count('volumes_extracted', format='PDF')
+    metrics.checkpoint()
+    log(progress, f'{f} processed at {datetime.now()} after {get_rate()}\n')
 
 
 def get_file_list(dirpath):
@@ -85,12 +126,13 @@ def get_file_list(dirpath):
     file_list = [f for f in listdir(dirpath) if isfile(join(dirpath, f)) and f.endswith('.txt')]
     file_list.sort()
 
-    # Return list items if they haven't been processed yet:
+    # Return list items if they haven't been processed yet, or their text or extractor changed since they were:
+    fingerprint = extractor_fingerprint(sys.modules[__name__], extractor_version)
     for f in file_list:
         name = f[f.index(' ') + 1:f.index('.txt')]
         for v in volume_list:
             if v['name'] == name:
-                if not v['processed']:
+                if not v['processed'] or is_stale(get_store(), v, f'{dirpath}/{f}', fingerprint):
                     yield f, v
                 break
 
@@ -101,8 +143,8 @@ def scrape_volume_urls(last_index):
     index += 6
 
     # Scrape meta data from table list of Hansard volumes
-    for tr in bs(urlopen('https://www.parliament.nz/en/pb/hansard-debates/historical-hansard/'), 'html.parser').select(
-            '.wikitable')[0]('tr')[index:]:
+    for tr in make_soup(cached_urlopen('https://www.parliament.nz/en/pb/hansard-debates/historical-hansard/'),
+                        'metadata').select('.wikitable')[0]('tr')[index:]:
         # Sort data from each cell of each row of table list into list of dictionaries
         row = {'format': 'PDF', 'downloaded': True, 'processed': None}
         row_cells = tr('td')
@@ -132,47 +174,45 @@ def scrape_volume_urls(last_index):
 
 
 def read_index_rows():
-    while True:
-        rows = []
-        # Read the volume index file
-        with open(volumeindex_filename, 'r', newline='', encoding='utf8') as v_index:
-            reader = csv.DictReader(v_index)
-            for row in reader:
-                rows.append(row)
-        last_entry = rows[-1]['name']
+    # Read the volume index from the state store, adding any PDF volumes it doesn't have yet:
+    update_volume_index()
+    return get_store().volume_rows(volumeindex_fieldnames + version_fieldnames)
 
-        # Scrape remaining volume urls from parliament website & save to file if the index doesn't have them yet:
-        if not last_entry.isdigit() or int(last_entry) < 606:
-            with open(volumeindex_filename, 'a', newline='', encoding='utf8') as v_index:
-                writer = csv.DictWriter(v_index, volumeindex_fieldnames)
-                for entry in scrape_volume_urls(last_entry):
-                    writer.writerow(entry)
-                    rows.append(entry)
 
-        return rows
+def update_volume_index():
+    # Scrape the remaining volume urls from the parliament website, following on from the last PDF volume in the
+    # index. OCR volumes may still be being added, so only the PDF volumes are looked at:
+    names = [row['name'] for row in get_store().volume_rows(['name'])
+             if row['name'].isdigit() and int(row['name']) > 482]
+    last_entry = names[-1] if names else ''
+    if not last_entry or int(last_entry) < 606:
+        for entry in scrape_volume_urls(last_entry):
+            get_store().add_volume(entry)
 
 
 def get_daily_debates(text):
+    # Scan the volume by offset, only copying out the text of each day once:
     date = debate_date.search(text)
-    text = text[date.end():]
     cond = True
 
     while cond:
         loops = most_loops
-        print(f'Processing {date.group(0)}')
-        next_date = debate_date.search(text)
+        set_context(date=date.group(0))
+        log(progress, f'Processing {date.group(0)}')
+        next_date = debate_date.search(text, date.end())
         if next_date and not next_date.group(0).startswith(('ANSLATION','JOURNMENT')):
-            yield date, get_speeches(text[:next_date.start()])
-            date, text = next_date, text[next_date.end():]
+            yield date, get_speeches(text[date.end():next_date.start()])
+            date = next_date
         else:
-            yield date, get_speeches(text)
+            yield date, get_speeches(text[date.end():])
             cond = False
 
-        print(f'Processed {date.group(0)}')
+        log(progress, f'Processed {date.group(0)}')
+        metrics.count('days_extracted', format='PDF')
         if most_loops > loops:
             global longest_day
             longest_day = date.group(0)
-            print(f'Most strings! {most_loops}\n')
+            log(progress, f'Most strings! {most_loops}\n')
 
 
 def get_speeches(txt):
@@ -180,27 +220,43 @@ def get_speeches(txt):
     paragraphs = []
     speaker = ''
 
+    # Walk through the day with an offset into the text rather than slicing off each paragraph read,
+    # which copied the rest of the day every loop and made long sitting days quadratic:
+    pos, end = 0, len(txt)
     loops = 0
+    # Time spent matching speakers, added up over the day as it is counted on every loop:
+    speaker_seconds = 0
     while True:
         loops += 1
         if loops >= 1000 and loops % 500 == 0:
-            print('Loops exceeded', loops)
+            log(progress, 'Loops exceeded', loops)
 
-        kaikōrero = new_speaker.match(txt)
+        t = time.perf_counter()
+        kaikōrero = new_speaker.match(txt, pos)
+        name = kaikōrero and name_behaviour.match(kaikōrero.group(3))
+        speaker_seconds += time.perf_counter() - t
         if kaikōrero:
-            name = re.match(name_behaviour, kaikōrero.group(3))
             if name:
                 speeches.append(Speech(speaker, process_sentences(paragraphs)))
                 paragraphs = []
                 speaker = name.group(2)
-                txt = txt[kaikōrero.end():]
+                pos = kaikōrero.end()
 
-        p, txt = get_paragraph(txt)
-        paragraphs.append(p)
-        if not txt:
+        # Same split as taumahi's get_paragraph:
+        p_break = paragraph_pattern.search(txt, pos)
+        if p_break:
+            paragraphs.append(txt[pos:p_break.start()])
+            pos = p_break.end()
+        else:
+            paragraphs.append(txt[pos:])
+            pos = end
+        if pos >= end:
             speeches.append(Speech(speaker, process_sentences(paragraphs)))
             break
 
+    metrics.count('regex_seconds', speaker_seconds, stage='PDF speakers')
+    metrics.observe('pdf_day_loops', loops)
+    tally('get_speeches loops', loops)
     global most_loops
     if loops > most_loops:
         most_loops = loops
@@ -212,18 +268,19 @@ def process_sentences(paragraphs):
     # Check paragraph sentences to see if any contain te reo:
     utterances, reo, other = [], [], []
     consecutive_reo = consecutive_other = False
-    has_tohutō = re.search('[āēīōūĀĒĪŌŪ]', ' '.join(paragraphs)) is not None
+    has_tohutō = any(tohutō_pattern.search(text) for text in paragraphs)
     for text in paragraphs:
         loop_flag = True
+        pos = 0
         while loop_flag:
-            # Look for sentence / statement like endings and separate text:
-            next_sentence = new_sentence.search(text)
-            sentence = ''
+            # Look for sentence / statement like endings and separate text, scanning by offset rather than slicing
+            # off each sentence found:
+            next_sentence = new_sentence.search(text, pos)
             if next_sentence:
-                sentence = text[:next_sentence.start() + 1]
-                text = text[next_sentence.end():]
+                sentence = text[pos:next_sentence.start() + 1]
+                pos = next_sentence.end()
             else:
-                sentence = text
+                sentence = text[pos:]
                 loop_flag = False
 
             # Check to see if sentence is te reo Māori:
@@ -258,6 +315,18 @@ def process_sentences(paragraphs):
 # Regex to replace page breaks with new line
 page_break = re.compile('(\n{0,2}\d{1,2} [a-zA-Z]{3,9} \d{4}.*\n\n\f)')
 
+# Regex to remove bracketed text, and headings and division lists on lines of their own, in one pass. Brackets are
+# allowed anywhere in a heading line, so it removes the same lines as removing the brackets first would. Each heading
+# takes the line break before it and leaves the one after, so consecutive headings are all removed:
+bracket = r'\[[^\]]*]'
+cleanup_pattern = re.compile('\n({heading}|{division})(?=\n)|{bracket}'.format(
+    heading='{b}[A-Z]{b}([a-zA-Z]{b})*( {b}[A-Z]{b}([a-z]{b})*)*',
+    division='{b}(N{b}o{b}e{b}s|A{b}y{b}e{b}s){b}([^\n[]{b}|\\[(?![^\\]]*]){b})*',
+    bracket=bracket).replace('{b}', f'(?:{bracket})*'))
+
+# Regex to find paragraphs with vowels written with macrons:
+tohutō_pattern = re.compile('[āēīōūĀĒĪŌŪ]')
+
 # Regex to look for meeting date then split into date-debate key-value map
 debate_date = re.compile(pattern=r'[A-Z]{6,9}, (\d{1,2}) ([A-Z]{3,9}) (\d{4})')
 
@@ -270,7 +339,8 @@ name_behaviour = re.compile(
 
 
 def tuhituhikifile(volume, text):
-    # Write te reo and day stats to file output:
+    # Collect te reo and day stats rows for file output:
+    day_rows, corpus_rows = [], []
     rā = māhina = tau = None
     switch1 = True
     switch539 = int(volume['name']) == 539
@@ -300,38 +370,46 @@ def tuhituhikifile(volume, text):
         c_row = {'utterance': 0}
         for k, v in i_row.items():
             c_row[k] = v
-        with open(corpusfilename, 'a', newline='', encoding='utf8') as c:
-            corpus_writer = csv.DictWriter(c, reo_fieldnames)
-            for speech in speeches:
-                for paragraph in speech.paragraphs:
-                    for k, v in paragraph.ratios.items():
-                        if k != 'percent':
-                            totals[k] += v
-
-                    c_row['utterance'] += 1
-                    if paragraph.condition and paragraph.ratios['reo'] > 2:
-                        c_row.update({'text': paragraph.txt, 'speaker': speech.kaikōrero})
-                        c_row.update(paragraph.ratios)
-                        corpus_writer.writerow(c_row)
-                        print(
-                            'Volume {volume}: {date1}\n Utterance {utterance}: {speaker}\nMaori = {percent}%\n{text}\n'.format(
-                                **c_row))
+        for speech in speeches:
+            for paragraph in speech.paragraphs:
+                for k, v in paragraph.ratios.items():
+                    if k != 'percent':
+                        totals[k] += v
+
+                c_row['utterance'] += 1
+                if paragraph.condition and paragraph.ratios['reo'] > 2:
+                    c_row.update({'text': paragraph.txt, 'speaker': speech.kaikōrero})
+                    c_row.update(paragraph.ratios)
+                    corpus_rows.append(dict(c_row))
+                    log(utterances,
+                        'Volume {volume}: {date1}\n Utterance {utterance}: {speaker}\nMaori = {percent}%\n{text}\n'.format(
+                            **c_row))
 
         i_row.update({'percent': get_percentage(**totals)})
         i_row.update(totals)
-        with open(rāindexfilename, 'a', newline='', encoding='utf8') as i:
-            csv.DictWriter(i, rāindex_fieldnames).writerow(i_row)
-        print('Maori = {reo}, Ambiguous = {ambiguous}, Non-Māori = {other}, Percentage = {percent} %'.format(**i_row))
+        day_rows.append(i_row)
+        log(progress,
+            'Maori = {reo}, Ambiguous = {ambiguous}, Non-Māori = {other}, Percentage = {percent} %'.format(**i_row))
+
+    return day_rows, corpus_rows
 
 
-def main():
+def main(merge=True):
     try:
         print('Processing PDF volumes 1987-2002:')
+        split_combined_files()
+        kupu_cache.load()
         process_txt_files(dirpath='1987-2002')
+        if merge:
+            merge_partitions(corpusfilename, rāindexfilename)
         print('PDF Corpus compilation successful')
     except Exception as e:
         raise e
     finally:
+        get_store().export_csv()
+        kupu_cache.save()
+        metrics.export()
+        profile.write_report()
         print(f"--- Job took {get_rate()} ---")
         print(f'Looped through {most_loops} strings while processing {longest_day}')
 
@@ -354,5 +432,8 @@ def get_rate():
     return f'{s} seconds'
 
 
+# Time every pattern and kupu_ratios call when profiling is switched on:
+instrument(sys.modules[__name__])
+
 if __name__ == '__main__':
     main()
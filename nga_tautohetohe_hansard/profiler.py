@@ -0,0 +1,213 @@
+# import libraries
+import heapq
+import os
+import re
+import time
+from threading import Lock, local
+from nga_tautohetohe_hansard.metrics import metrics
+
+# Profiling is off unless the HANSARD_PROFILE environment variable is set, as timing every match slows extraction:
+profiling = bool(os.environ.get('HANSARD_PROFILE'))
+report_filename = os.environ.get('HANSARD_PROFILE_REPORT', 'hansardprofile.txt')
+# Slowest single calls kept for each pattern, and rows in each ranking of the report:
+slowest_calls = 10
+report_rows = 25
+# Characters of each slow input quoted in the report:
+excerpt_length = 120
+
+pattern_methods = ['match', 'fullmatch', 'search', 'sub', 'subn', 'split', 'findall', 'finditer']
+
+
+class Profile:
+    """This class adds up the time and calls of each profiled pattern and kupu_ratios call site, overall and for each
+    volume and day, and keeps the slowest calls with the start of their input. Other counts can be tallied for each
+    day too, e.g. the loops get_speeches takes."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.context = local()
+        self.reset()
+
+    def reset(self):
+        self.sites = {}  # name -> [seconds, calls]
+        self.days = {}  # (name, volume and date) -> seconds
+        self.slowest = {}  # name -> heap of (seconds, volume and date, input length, excerpt)
+        self.tallies = {}  # (name, volume and date) -> count
+
+    def set_context(self, **context):
+        # Record the volume, date or debate being extracted by this thread, e.g. set_context(volume='120'):
+        current = getattr(self.context, 'values', {})
+        self.context.values = {**current, **context}
+
+    def where(self):
+        values = getattr(self.context, 'values', {})
+        return ' '.join(str(v) for v in values.values() if v)
+
+    def record(self, name, seconds, text):
+        where = self.where()
+        with self.lock:
+            site = self.sites.setdefault(name, [0, 0])
+            site[0] += seconds
+            site[1] += 1
+            self.days[(name, where)] = self.days.get((name, where), 0) + seconds
+            heap = self.slowest.setdefault(name, [])
+            if len(heap) < slowest_calls or seconds > heap[0][0]:
+                entry = (seconds, where, len(text), text[:excerpt_length])
+                (heapq.heapreplace if len(heap) >= slowest_calls else heapq.heappush)(heap, entry)
+
+    def tally(self, name, value):
+        key = (name, self.where())
+        with self.lock:
+            self.tallies[key] = self.tallies.get(key, 0) + value
+
+    def reset_after_fork(self):
+        self.lock = Lock()
+        self.reset()
+
+    def drain(self):
+        with self.lock:
+            drained = self.sites, self.days, self.slowest, self.tallies
+            self.reset()
+        return drained
+
+    def merge(self, drained):
+        sites, days, slowest, tallies = drained
+        with self.lock:
+            for name, (seconds, calls) in sites.items():
+                site = self.sites.setdefault(name, [0, 0])
+                site[0] += seconds
+                site[1] += calls
+            for key, seconds in days.items():
+                self.days[key] = self.days.get(key, 0) + seconds
+            for name, entries in slowest.items():
+                self.slowest[name] = heapq.nlargest(slowest_calls, self.slowest.get(name, []) + entries)
+                heapq.heapify(self.slowest[name])
+            for key, value in tallies.items():
+                self.tallies[key] = self.tallies.get(key, 0) + value
+
+    def report(self):
+        # Rank the call sites by time, then the days by the time all sites spent on them:
+        with self.lock:
+            sites = sorted(self.sites.items(), key=lambda item: -item[1][0])
+            day_totals = {}
+            for (name, where), seconds in self.days.items():
+                day_totals[where] = day_totals.get(where, 0) + seconds
+            days = sorted(self.days.items(), key=lambda item: -item[1])
+            slowest = {name: sorted(heap, reverse=True) for name, heap in self.slowest.items()}
+            tallies = sorted(self.tallies.items(), key=lambda item: -item[1])
+            total = sum(seconds for seconds, _ in self.sites.values()) or 1
+
+        lines = ['Call sites by total time:',
+                 f'{"seconds":>10} {"share":>6} {"calls":>10} {"mean µs":>9} {"max ms":>9}  site']
+        for name, (seconds, calls) in sites:
+            longest = slowest[name][0][0] if slowest.get(name) else 0
+            lines.append(f'{seconds:10.3f} {seconds / total:6.1%} {calls:10} {1e6 * seconds / calls:9.1f} '
+                         f'{1e3 * longest:9.2f}  {name}')
+
+        lines += ['', 'Days by total time:', f'{"seconds":>10}  volume and date']
+        for where, seconds in sorted(day_totals.items(), key=lambda item: -item[1])[:report_rows]:
+            lines.append(f'{seconds:10.3f}  {where or "(none)"}')
+
+        lines += ['', 'Slowest days of each call site:', f'{"seconds":>10}  site, volume and date']
+        for (name, where), seconds in days[:report_rows]:
+            lines.append(f'{seconds:10.3f}  {name}, {where or "(none)"}')
+
+        for tally in sorted({name for (name, _), _ in tallies}):
+            lines += ['', f'Days by {tally}:', f'{"count":>10}  volume and date']
+            for (name, where), value in [t for t in tallies if t[0][0] == tally][:report_rows]:
+                lines.append(f'{value:10}  {where or "(none)"}')
+
+        lines += ['', 'Slowest calls:']
+        for name, _ in sites:
+            for seconds, where, length, excerpt in slowest.get(name, []):
+                lines.append(f'{1e3 * seconds:10.2f} ms  {name}, {where or "(none)"}, {length} characters: '
+                             f'{excerpt!r}')
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, filename=None):
+        if not profiling:
+            return
+        filename = filename or report_filename
+        with open(filename, 'w', encoding='utf8') as f:
+            f.write(self.report())
+        print(f'Profile written to {filename}')
+
+
+class ProfiledPattern:
+    """This class stands in for a compiled pattern, timing each call into the profile under the pattern's name.
+    The compiled pattern is kept as __wrapped__."""
+
+    def __init__(self, pattern, name):
+        self.__wrapped__ = pattern
+        self.name = name
+        self.pattern = pattern.pattern
+        self.flags = pattern.flags
+        self.groups = pattern.groups
+        self.groupindex = pattern.groupindex
+        for method in pattern_methods:
+            setattr(self, method, self.__timed(method))
+
+    def __timed(self, method):
+        call = getattr(self.__wrapped__, method)
+        # sub and subn take the replacement before the string:
+        text_index = 1 if method in ('sub', 'subn') else 0
+        site = f'{self.name}.{method}'
+
+        def timed(*args, **kwargs):
+            t = time.perf_counter()
+            result = call(*args, **kwargs)
+            if method == 'finditer':
+                result = list(result)
+            text = args[text_index] if len(args) > text_index else kwargs.get('string', '')
+            profile.record(site, time.perf_counter() - t, text)
+            return iter(result) if method == 'finditer' else result
+
+        return timed
+
+    def __repr__(self):
+        return f'ProfiledPattern({self.__wrapped__!r})'
+
+
+def profiled_function(function, name):
+    # Wrap a function whose first argument is the text it works on, e.g. kupu_ratios:
+    def timed(text, *args, **kwargs):
+        t = time.perf_counter()
+        result = function(text, *args, **kwargs)
+        profile.record(name, time.perf_counter() - t, text)
+        return result
+
+    timed.__wrapped__ = function
+    return timed
+
+
+def instrument(module, functions=('kupu_ratios',)):
+    # Replace the compiled patterns of a module, and lists of them, with profiled ones, and wrap the named functions.
+    # Does nothing unless profiling is on, so extractors can always call it once their patterns are defined:
+    if not profiling:
+        return
+    prefix = module.__name__.rsplit('.', 1)[-1]
+    for name, value in list(vars(module).items()):
+        if isinstance(value, re.Pattern):
+            setattr(module, name, ProfiledPattern(value, f'{prefix}.{name}'))
+        elif isinstance(value, list) and value and all(isinstance(v, re.Pattern) for v in value):
+            setattr(module, name, [ProfiledPattern(v, f'{prefix}.{name}[{i}]') for i, v in enumerate(value)])
+        elif name in functions and callable(value) and not hasattr(value, '__wrapped__'):
+            setattr(module, name, profiled_function(value, f'{prefix}.{name}'))
+
+
+def set_context(**context):
+    if profiling:
+        profile.set_context(**context)
+
+
+def tally(name, value=1):
+    if profiling:
+        profile.tally(name, value)
+
+
+profile = Profile()
+# Worker processes hand their profile back along with their metrics:
+if profiling:
+    metrics.register('profile', profile)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=profile.reset_after_fork)
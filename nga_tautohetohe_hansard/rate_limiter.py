@@ -0,0 +1,86 @@
+# import libraries
+import asyncio
+import time
+from threading import Lock
+
+# Statuses that mean the server is struggling, other errors are counted but don't slow the host down:
+backoff_statuses = {429, 500, 502, 503, 504}
+
+
+class AdaptiveRateLimiter:
+    """Token bucket per host whose request rate grows additively while responses succeed and is cut
+    multiplicatively on 429s, 5xx responses, timeouts and dropped connections (AIMD)."""
+
+    def __init__(self, initial_rate=50, min_rate=0.5, max_rate=1000, increase=2, decrease=0.5, burst=10):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase  # requests/s added per second of successful responses
+        self.decrease = decrease  # fraction of the rate kept after a failure
+        self.burst = burst
+        self.lock = Lock()
+        self.hosts = {}
+
+    def acquire(self, host):
+        # Block the calling thread until the host has a token to spend:
+        delay = self.__reserve(host)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, host):
+        delay = self.__reserve(host)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def record(self, host, status=None, error=None, retry_after=None):
+        # Adjust the rate of a host from the outcome of a request:
+        with self.lock:
+            h = self.__host(host)
+            h['requests'] += 1
+            failed = error is not None or (status is not None and status >= 400)
+            if not failed:
+                # Additive increase, spread over the responses received in a second:
+                h['rate'] = min(self.max_rate, h['rate'] + self.increase / h['rate'])
+                return
+            h['errors'] += 1
+            if isinstance(error, (TimeoutError, asyncio.TimeoutError)) or 'timed out' in str(error):
+                h['timeouts'] += 1
+            elif status is not None:
+                h[status] = h.get(status, 0) + 1
+            if error is not None or status in backoff_statuses:
+                now = time.monotonic()
+                # Multiplicative decrease, at most once per second so a burst of failures counts as one signal:
+                if now - h['last_cut'] >= 1:
+                    h['rate'] = max(self.min_rate, h['rate'] * self.decrease)
+                    h['last_cut'] = now
+                    h['tokens'] = min(h['tokens'], 0)
+                if retry_after:
+                    h['tokens'] = min(h['tokens'], -retry_after * h['rate'])
+
+    def rate(self, host):
+        with self.lock:
+            return round(self.__host(host)['rate'], 2)
+
+    def stats(self):
+        # Current rate and error counts of every host seen:
+        with self.lock:
+            return {host: {k: round(v, 2) if isinstance(v, float) else v for k, v in h.items()
+                           if k not in ('tokens', 'updated', 'last_cut')}
+                    for host, h in self.hosts.items()}
+
+    def __host(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = {'rate': float(self.initial_rate), 'tokens': float(self.burst),
+                                'updated': time.monotonic(), 'last_cut': 0.0, 'requests': 0, 'errors': 0,
+                                'timeouts': 0}
+        return self.hosts[host]
+
+    def __reserve(self, host):
+        # Take a token, returning how long the caller has to wait for it to refill:
+        with self.lock:
+            h = self.__host(host)
+            now = time.monotonic()
+            h['tokens'] = min(self.burst, h['tokens'] + (now - h['updated']) * h['rate'])
+            h['updated'] = now
+            h['tokens'] -= 1
+            return -h['tokens'] / h['rate'] if h['tokens'] < 0 else 0
@@ -0,0 +1,70 @@
+# import libraries
+import time
+from threading import Condition, Thread
+
+
+class Stage:
+    """This class is a step of the unified scraper, started once every stage named in after has finished
+    successfully. Stages run in threads, so a stage that waits on the network doesn't hold up one that doesn't."""
+
+    def __init__(self, name, run, after=()):
+        self.name = name
+        self.run = run
+        self.after = tuple(after)
+        self.error = None
+        self.started = self.finished = None
+
+
+def run_stages(stages):
+    # Run each stage as soon as its dependencies are done, returning the names of the stages that completed.
+    # If a stage fails, the stages that depend on it are skipped and its error is raised once the others stop:
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        unknown = set(stage.after) - names
+        if unknown:
+            raise ValueError(f'Stage {stage.name} depends on unknown stages {unknown}')
+
+    pending = list(stages)
+    running, done, failed, skipped = set(), [], [], []
+    condition = Condition()
+
+    def run(stage):
+        try:
+            stage.run()
+        except BaseException as exception:
+            stage.error = exception
+        with condition:
+            stage.finished = time.time()
+            running.discard(stage.name)
+            (failed if stage.error else done).append(stage)
+            condition.notify()
+
+    with condition:
+        while pending or running:
+            completed = {stage.name for stage in done}
+            stopped = {stage.name for stage in failed + skipped}
+            blocked = [stage for stage in pending if stopped.intersection(stage.after)]
+            if blocked:
+                # Skipping a stage can block the stages after it, so look again before starting anything:
+                for stage in blocked:
+                    print(f'Skipping {stage.name} as {", ".join(stopped.intersection(stage.after))} did not finish')
+                    pending.remove(stage)
+                    skipped.append(stage)
+                continue
+            for stage in list(pending):
+                if completed.issuperset(stage.after):
+                    print(f'Starting {stage.name}')
+                    pending.remove(stage)
+                    running.add(stage.name)
+                    stage.started = time.time()
+                    Thread(target=run, args=(stage,), name=stage.name, daemon=True).start()
+            if pending and not running:
+                raise ValueError(f'Circular stage dependencies between {[stage.name for stage in pending]}')
+            if running:
+                condition.wait()
+
+    for stage in done:
+        print(f'{stage.name} took {round(stage.finished - stage.started, 1)} seconds')
+    if failed:
+        raise failed[0].error
+    return [stage.name for stage in done]
@@ -0,0 +1,127 @@
+# import libraries
+import csv
+import os
+import sqlite3
+import time
+from os import replace
+from os.path import exists
+from threading import Lock
+
+state_filename = 'hansardstate.sqlite'
+volumeindex_filename = 'hansardvolumeindex.csv'
+volumeindex_fieldnames = ['retrieved', 'url', 'name', 'period', 'session', 'format', 'downloaded', 'processed']
+day_fieldnames = ['url', 'volume', 'format', 'date', 'status', 'updated']
+# Kept in the store but not exported to the csv, the extractor and input a processed volume's rows came from:
+version_fieldnames = ['extractor', 'input_hash', 'input_signature']
+
+
+class StateStore:
+    """This class keeps the status of every volume and daily debate in a SQLite database, so that marking a volume
+    downloaded or processed is a single row update instead of a rewrite of hansardvolumeindex.csv.
+    Volume rows keep the same string values as the csv, e.g. processed is '' or 'True'."""
+
+    def __init__(self, filename=state_filename, index_filename=volumeindex_filename):
+        self.filename = filename
+        self.index_filename = index_filename
+        self.lock = Lock()
+        self.export_lock = Lock()
+        new = not exists(filename)
+        self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS volumes (position INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'name TEXT UNIQUE, {})'.format(', '.join(f'{k} TEXT' for k in volumeindex_fieldnames
+                                                                 if k != 'name')))
+        # Stores created before volumes were versioned don't have the version columns yet:
+        columns = {row[1] for row in self.db.execute('PRAGMA table_info(volumes)')}
+        for k in version_fieldnames:
+            if k not in columns:
+                self.db.execute(f'ALTER TABLE volumes ADD COLUMN {k} TEXT')
+        self.db.execute('CREATE TABLE IF NOT EXISTS days (url TEXT PRIMARY KEY, volume TEXT, format TEXT, date TEXT, '
+                        'status TEXT, updated REAL)')
+
+        # Take over an existing volume index the first time the store is opened:
+        if new and exists(index_filename):
+            self.import_csv(index_filename)
+
+    def volume_rows(self, fieldnames=volumeindex_fieldnames):
+        # Returns every volume row in index order as csv style dictionaries:
+        with self.lock:
+            cursor = self.db.execute('SELECT {} FROM volumes ORDER BY position'.format(', '.join(fieldnames)))
+            return [{k: v or '' for k, v in zip(fieldnames, row)} for row in cursor]
+
+    def add_volume(self, row):
+        # Append a volume to the index, keeping the existing row if the volume is already known:
+        values = ['' if row.get(k) is None else str(row[k]) for k in volumeindex_fieldnames]
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO volumes ({}) VALUES ({})'.format(
+                ', '.join(volumeindex_fieldnames), ', '.join('?' * len(volumeindex_fieldnames))), values)
+
+    def set_volume(self, name, **fields):
+        # Atomically update the status columns of one volume, e.g. set_volume(name, processed=True):
+        with self.lock:
+            self.db.execute('UPDATE volumes SET {} WHERE name = ?'.format(', '.join(f'{k} = ?' for k in fields)),
+                            [str(v) if v not in (None, False) else '' for v in fields.values()] + [name])
+
+    def set_day(self, url, volume='', format='', date='', status=''):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?, ?, ?)',
+                            (url, volume, format, date, status, time.time()))
+
+    def day_rows(self, volume=None):
+        with self.lock:
+            if volume is None:
+                cursor = self.db.execute('SELECT * FROM days ORDER BY rowid')
+            else:
+                cursor = self.db.execute('SELECT * FROM days WHERE volume = ? ORDER BY rowid', (volume,))
+            return [dict(zip(day_fieldnames, row)) for row in cursor]
+
+    def import_csv(self, filename=None):
+        # Load volumes from a hansardvolumeindex.csv, overwriting the status of volumes already in the store:
+        with open(filename or self.index_filename, 'r', newline='', encoding='utf8') as v_index:
+            rows = list(csv.DictReader(v_index))
+        with self.lock:
+            self.db.execute('BEGIN')
+            for row in rows:
+                # Some older indexes spell the retrieved column 'retreived':
+                row.setdefault('retrieved', row.get('retreived'))
+                values = [row.get(k) or '' for k in volumeindex_fieldnames]
+                self.db.execute('INSERT INTO volumes ({0}) VALUES ({1}) ON CONFLICT(name) DO UPDATE SET {2}'.format(
+                    ', '.join(volumeindex_fieldnames), ', '.join('?' * len(volumeindex_fieldnames)),
+                    ', '.join(f'{k} = excluded.{k}' for k in volumeindex_fieldnames)), values)
+            self.db.execute('COMMIT')
+
+    def export_csv(self, filename=None):
+        # Write the volume index out as csv, replacing the old file in one step so a crash can't truncate it:
+        filename = filename or self.index_filename
+        with self.export_lock:
+            rows = self.volume_rows()
+            with open(f'{filename}.tmp', 'w', newline='', encoding='utf8') as v_index:
+                writer = csv.DictWriter(v_index, volumeindex_fieldnames)
+                writer.writeheader()
+                writer.writerows(rows)
+            replace(f'{filename}.tmp', filename)
+
+
+shared_store = None
+store_lock = Lock()
+
+
+def get_store():
+    # The state store shared by the scrapers in this process:
+    global shared_store
+    with store_lock:
+        if shared_store is None:
+            shared_store = StateStore()
+        return shared_store
+
+
+def reset_after_fork():
+    # Another thread may have held the lock or been using the store's connection when the process forked, and a
+    # SQLite connection can't be used on both sides of a fork, so the child opens its own store if it needs one:
+    global shared_store, store_lock
+    shared_store = None
+    store_lock = Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
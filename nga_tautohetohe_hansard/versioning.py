@@ -0,0 +1,57 @@
+# import libraries
+import hashlib
+import re
+from os import stat
+
+
+def extractor_fingerprint(module, version):
+    # Identifies an extractor by its version number and every regular expression in its module, so changing a
+    # pattern is enough to have the volumes it extracted reprocessed. Bump the version for other changes in logic:
+    digest = hashlib.sha256(str(version).encode())
+    for name, value in sorted(vars(module).items()):
+        for pattern in patterns_in(value):
+            digest.update(f'{name}\0{pattern.pattern}\0{pattern.flags}\0'.encode())
+    return f'{version}-{digest.hexdigest()[:16]}'
+
+
+def patterns_in(value):
+    # Profiled patterns are looked through, so profiling doesn't change the fingerprint:
+    value = getattr(value, '__wrapped__', value)
+    if isinstance(value, re.Pattern):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from patterns_in(item)
+
+
+def file_signature(filepath):
+    # Cheap check for a changed input, the content is only hashed again when the size or modification time differ:
+    s = stat(filepath)
+    return f'{s.st_size}-{s.st_mtime_ns}'
+
+
+def file_digest(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_stale(store, v, filepath, fingerprint, digest_function=file_digest):
+    # Returns True if a processed volume was extracted by a different extractor or from different input.
+    # Volumes processed before versions were recorded are taken as current and tagged with the current versions:
+    if not v.get('extractor'):
+        store.set_volume(v['name'], extractor=fingerprint, input_hash=digest_function(filepath),
+                         input_signature=file_signature(filepath))
+        return False
+    if v['extractor'] != fingerprint:
+        return True
+    signature = file_signature(filepath)
+    if v.get('input_signature') == signature:
+        return False
+    if digest_function(filepath) != v.get('input_hash'):
+        return True
+    # Same content in a touched or rewritten file:
+    store.set_volume(v['name'], input_signature=signature)
+    return False
@@ -0,0 +1,114 @@
+# import libraries
+import asyncio
+import gzip
+import io
+import time
+import unittest
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from unittest import mock
+from nga_tautohetohe_hansard import ocr_html_scraper
+from nga_tautohetohe_hansard.async_http import AsyncHTTPClient
+from nga_tautohetohe_hansard.rate_limiter import AdaptiveRateLimiter
+
+# Responses the stand-in server fails with before it answers each path, as (status, headers):
+failures = {
+    '/flaky': [(503, {})],
+    '/busy': [(429, {'Retry-After': '1'})],
+    '/cgi/pt?id=v1;seq=2': [(403, {})],
+}
+
+
+def hathi_markup(path):
+    # A Hathi plain text page, as html_parser.hathi_page reads it:
+    seq = int(path.rsplit('=', 1)[1])
+    anchors = f'<a href="/cgi/pt?id=v1;seq={seq - 1}">Previous Page</a><a href="/cgi/pt?id=v1;seq={seq + 1}">Next</a>'
+    return (f'<html><body><div id="mdpPage">{anchors}<div class="Text">Page {seq}\nKia ora</div></div>'
+            '</body></html>')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.client_address, time.monotonic()))
+        if server.failures.get(self.path):
+            status, headers = server.failures[self.path].pop(0)
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = hathi_markup(self.path).encode() if self.path.startswith('/cgi/') else f'body of {self.path}'.encode()
+        self.send_response(200)
+        if self.path == '/gzip':
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class AsyncHTTPClientTest(unittest.TestCase):
+    """This class checks the asyncio client against a local stand-in server."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.requests = []
+        self.server.failures = {path: list(responses) for path, responses in failures.items()}
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.domain = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, *paths):
+        async def fetch():
+            async with AsyncHTTPClient(limiter=AdaptiveRateLimiter(burst=100)) as client:
+                return [await client.get(f'{self.domain}{path}') for path in paths]
+
+        with redirect_stdout(io.StringIO()):
+            return asyncio.run(fetch())
+
+    def test_keep_alive(self):
+        responses = self.get('/a', '/b', '/c')
+        self.assertEqual([r.body for r in responses], [b'body of /a', b'body of /b', b'body of /c'])
+        self.assertEqual(len({address for _, address, _ in self.server.requests}), 1)
+
+    def test_gzip(self):
+        response, = self.get('/gzip')
+        self.assertEqual(response.body, b'body of /gzip')
+
+    def test_retries_server_errors(self):
+        response, = self.get('/flaky')
+        self.assertEqual((response.status, response.body), (200, b'body of /flaky'))
+        self.assertEqual([path for path, _, _ in self.server.requests], ['/flaky', '/flaky'])
+
+    def test_retry_after(self):
+        response, = self.get('/busy')
+        self.assertEqual(response.status, 200)
+        (_, _, first), (_, _, second) = self.server.requests
+        self.assertGreaterEqual(second - first, 0.9)
+
+    def test_download_page_retries_other_statuses(self):
+        # Statuses the client doesn't retry itself, e.g. a 403 while Hathi refuses a page, are retried per page:
+        async def download():
+            async with AsyncHTTPClient() as client:
+                return await ocr_html_scraper.download_page(client, '/cgi/pt?id=v1;seq=2', 2, self.domain)
+
+        with mock.patch.object(ocr_html_scraper, 'page_retry_delay', 0.01), redirect_stdout(io.StringIO()):
+            more_pages, url, row = asyncio.run(download())
+        self.assertEqual((more_pages, url, row['page'], row['text'].strip()), (True, '/cgi/pt?id=v1;seq=3', 2,
+                                                                              'Page 2\nKia ora'))
+        self.assertEqual(len(self.server.requests), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
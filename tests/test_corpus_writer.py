@@ -0,0 +1,113 @@
+# import libraries
+import csv
+import io
+import unittest
+from contextlib import redirect_stdout
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+from unittest import mock
+from nga_tautohetohe_hansard.corpus_writer import document_id, merge_partitions, partition_exists, partition_path, \
+    split_combined_files, write_partition
+from nga_tautohetohe_hansard.state_store import StateStore
+
+# Volumes in the order of the volume index, including a combined volume whose name isn't a safe file name:
+index_order = [('1', 'OCR'), ('2', 'OCR'), ('10', 'OCR'), ('5/6', 'OCR'), ('483', 'PDF'), ('484', 'PDF')]
+debates = {'20031104_00000001': '4 November 2003', '20030212_00000001': '12 February 2003',
+           '20031015_00000001': '15 October 2003'}
+
+
+def day_row(volume, format, date, url=''):
+    return {'url': url, 'volume': volume, 'format': format, 'date2': date, 'reo': '1', 'ambiguous': '0',
+            'other': '0', 'percent': '100.0'}
+
+
+def corpus_row(volume, format, date, utterance, url=''):
+    return {**day_row(volume, format, date, url), 'utterance': str(utterance), 'text': f'{volume} {utterance}'}
+
+
+def read_csv(filename):
+    with open(filename, 'r', newline='', encoding='utf8') as f:
+        return list(csv.DictReader(f))
+
+
+class CorpusWriterTest(unittest.TestCase):
+    """This class checks partitions replace the rows of one volume or debate, and merge into the corpus in volume
+    order whatever order they were written in."""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.processed = join(self.directory.name, 'processed')
+        self.store = StateStore(join(self.directory.name, 'hansardstate.sqlite'),
+                                join(self.directory.name, 'hansardvolumeindex.csv'))
+        for name, format in index_order:
+            self.store.add_volume({'name': name, 'format': format})
+        patcher = mock.patch('nga_tautohetohe_hansard.state_store.get_store', return_value=self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def filename(self, name):
+        return join(self.directory.name, name)
+
+    def write_volume(self, name, format, utterances=2):
+        write_partition(format, name, [day_row(name, format, '3 July 1870')],
+                        [corpus_row(name, format, '3 July 1870', u) for u in range(utterances)], self.processed)
+
+    def write_debate(self, id, date):
+        url = f'https://www.parliament.nz/en/pb/hansard-debates/rhr/document/{id}/'
+        write_partition('HTML', document_id(url), [day_row('', 'HTML', date, url)],
+                        [corpus_row('', 'HTML', date, 0, url)], self.processed)
+
+    def merge(self):
+        with redirect_stdout(io.StringIO()):
+            merge_partitions(self.filename('corpus.csv'), self.filename('days.csv'), self.processed)
+        return read_csv(self.filename('corpus.csv')), read_csv(self.filename('days.csv'))
+
+    def test_partition_replaced(self):
+        self.write_volume('1', 'OCR', utterances=3)
+        self.write_volume('1', 'OCR', utterances=1)
+        self.assertTrue(partition_exists('OCR', '1', self.processed))
+        self.assertFalse(partition_exists('OCR', '2', self.processed))
+        corpus, days = self.merge()
+        self.assertEqual([row['text'] for row in corpus], ['1 0'])
+        self.assertEqual(len(days), 1)
+
+    def test_merge_order(self):
+        for id, date in debates.items():
+            self.write_debate(id, date)
+        for name, format in reversed(index_order):
+            self.write_volume(name, format)
+        # A volume that isn't in the index goes after the indexed volumes of its format:
+        self.write_volume('9', 'OCR')
+        corpus, days = self.merge()
+        self.assertEqual([row['volume'] for row in days if row['format'] != 'HTML'],
+                         ['1', '2', '10', '5/6', '9', '483', '484'])
+        self.assertEqual([row['date2'] for row in days if row['format'] == 'HTML'],
+                         ['12 February 2003', '15 October 2003', '4 November 2003'])
+        self.assertEqual([row['text'] for row in corpus[:4]], ['1 0', '1 1', '2 0', '2 1'])
+        self.assertEqual(len(corpus), 2 * (len(index_order) + 1) + len(debates))
+        self.assertFalse(exists(self.filename('corpus.csv.tmp')))
+
+    def test_partition_path(self):
+        self.assertEqual(partition_path('OCR', '5/6', self.processed), join(self.processed, 'OCR', '5_6'))
+        self.assertEqual(document_id('https://www.parliament.nz/mi/pb/hansard-debates/rhr/combined/HansD_20031104/'),
+                         'HansD_20031104')
+
+    def test_split_combined_files(self):
+        self.write_volume('1', 'OCR')
+        self.write_volume('483', 'PDF')
+        self.write_debate('20031104_00000001', '4 November 2003')
+        corpus, days = self.merge()
+        # A corpus merged before partitions existed splits into the same partitions:
+        split = join(self.directory.name, 'split')
+        with redirect_stdout(io.StringIO()):
+            split_combined_files(self.filename('corpus.csv'), self.filename('days.csv'), split)
+            merge_partitions(self.filename('remerged.csv'), self.filename('remerged days.csv'), split)
+        self.assertEqual(read_csv(self.filename('remerged.csv')), corpus)
+        self.assertEqual(read_csv(self.filename('remerged days.csv')), days)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+# import libraries
+import io
+import unittest
+from contextlib import redirect_stdout
+from tempfile import TemporaryDirectory
+from unittest import mock
+from nga_tautohetohe_hansard import ocr_text_cleaner
+from nga_tautohetohe_hansard.ocr_text_cleaner import ExtractionFeed
+
+
+class ExtractionFeedTest(unittest.TestCase):
+    """This class checks an extraction error is raised when the feed closes, without hiding an error that stopped
+    the download."""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        for name, value in (('split_combined_files', lambda: None), ('indir', self.directory.name)):
+            patcher = mock.patch.object(ocr_text_cleaner, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(ocr_text_cleaner.kupu_cache, 'load')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def feed_missing_volume(self, feed):
+        feed.submit('missing.csv', {'name': 'missing'})
+
+    def test_extraction_error(self):
+        with redirect_stdout(io.StringIO()), self.assertRaises(FileNotFoundError):
+            with ExtractionFeed(1) as feed:
+                self.feed_missing_volume(feed)
+
+    def test_download_error_kept(self):
+        with redirect_stdout(io.StringIO()) as out, self.assertRaises(ConnectionResetError):
+            with ExtractionFeed(1) as feed:
+                self.feed_missing_volume(feed)
+                raise ConnectionResetError('download failed')
+        self.assertIn('Extraction failed while the download was stopping: FileNotFoundError', out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# import libraries
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Thread
+from nga_tautohetohe_hansard.http_cache import ResponseCache, cached_urlopen
+
+
+class ValidatingHandler(BaseHTTPRequestHandler):
+    # Answers with an ETag for each path, and a 304 when the client already holds the current version:
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        etag = f'"{self.server.versions.get(self.path, 1)}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = f'{self.path} version {etag}'.encode()
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ResponseCacheTest(unittest.TestCase):
+    """This class checks stale responses are revalidated with their validators, and that the least recently used
+    responses are evicted once the cache is over its size limit."""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ValidatingHandler)
+        self.server.requests = []
+        self.server.versions = {}
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.domain = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def cache(self, max_bytes=1024 ** 2):
+        return ResponseCache(join(self.directory.name, 'http'), max_bytes)
+
+    def test_fresh_and_revalidated(self):
+        cache = self.cache()
+        url = f'{self.domain}/index'
+        self.assertEqual(cached_urlopen(url, cache=cache), b'/index version "1"')
+        self.assertEqual(cached_urlopen(url, cache=cache), b'/index version "1"')
+        self.assertEqual(len(self.server.requests), 1)
+
+        # A stale copy is sent back with its ETag and kept when the server answers 304:
+        self.assertEqual(cached_urlopen(url, max_age=0, cache=cache), b'/index version "1"')
+        self.assertEqual(self.server.requests[-1], ('/index', '"1"'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'revalidated': 1, 'misses': 1})
+
+        # A changed page replaces the cached copy:
+        self.server.versions['/index'] = 2
+        self.assertEqual(cached_urlopen(url, max_age=0, cache=cache), b'/index version "2"')
+        self.assertEqual(cached_urlopen(url, cache=cache), b'/index version "2"')
+        self.assertEqual(cache.total_bytes, len(b'/index version "2"'))
+
+    def test_never_stale(self):
+        cache = self.cache()
+        url = f'{self.domain}/volume'
+        cached_urlopen(url, max_age=None, cache=cache)
+        entry = cache.lookup(url)
+        entry['stored'] -= 10 * 365 * 24 * 3600
+        self.assertTrue(cache.is_fresh(entry, None))
+        self.assertFalse(cache.is_fresh(entry))
+
+    def test_uncacheable_bodies(self):
+        cache = self.cache()
+        url = f'{self.domain}/debate'
+        settled = lambda body: b'version "1"' not in body
+        cached_urlopen(url, max_age=None, cache=cache, cacheable=settled)
+        cached_urlopen(url, max_age=None, cache=cache, cacheable=settled)
+        self.assertEqual([path for path, _ in self.server.requests], ['/debate', '/debate'])
+        self.assertIsNone(cache.lookup(url))
+
+        # A copy cached before it was checked is fetched again in full, and the new version is kept:
+        cached_urlopen(url, max_age=None, cache=cache)
+        self.server.versions['/debate'] = 2
+        self.assertEqual(cached_urlopen(url, max_age=None, cache=cache, cacheable=settled), b'/debate version "2"')
+        self.assertEqual(self.server.requests[-1], ('/debate', None))
+        self.assertEqual(cached_urlopen(url, max_age=None, cache=cache, cacheable=settled), b'/debate version "2"')
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_identical_bodies_stored_once(self):
+        cache = self.cache()
+        cache.store('https://example.org/a', b'same body', {})
+        cache.store('https://example.org/b', b'same body', {})
+        self.assertEqual(cache.total_bytes, len(b'same body'))
+        self.assertEqual(cache.load(cache.lookup('https://example.org/b')), b'same body')
+
+    def test_evicts_least_recently_used(self):
+        cache = self.cache(max_bytes=350)
+        for n in range(3):
+            cache.store(f'https://example.org/{n}', bytes([n]) * 100, {})
+            time.sleep(0.01)
+        # Reading the oldest response makes the second the least recently used:
+        cache.load(cache.lookup('https://example.org/0'))
+        time.sleep(0.01)
+        cache.store('https://example.org/3', b'\x03' * 100, {})
+        self.assertIsNone(cache.lookup('https://example.org/1'))
+        for n in (0, 2, 3):
+            self.assertIsNotNone(cache.lookup(f'https://example.org/{n}'))
+        self.assertLessEqual(cache.total_bytes, 350 * 0.9)
+
+        # The size limit also holds for a cache reopened from disk:
+        self.assertEqual(self.cache(max_bytes=350).total_bytes, cache.total_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
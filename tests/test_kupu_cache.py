@@ -0,0 +1,68 @@
+# import libraries
+import os
+import random
+import unittest
+from os.path import join
+from tempfile import TemporaryDirectory
+import taumahi
+from nga_tautohetohe_hansard import benchmark
+from nga_tautohetohe_hansard.kupu_cache import KupuCache
+
+# Generated sentences classified in each test:
+num_sentences = 2000
+
+
+def generated_sentences():
+    rng = random.Random(benchmark.seed)
+    text = benchmark.pdf_volume(rng, 2) + '\n'.join(benchmark.paragraph(rng) for _ in range(200))
+    sentences = [s for s in taumahi.new_sentence.split(text) if s.strip()][:num_sentences]
+    # Sentences are also classified joined together, as the OCR extractor does for whole utterances:
+    return sentences + [' '.join(sentences[i:i + 5]) for i in range(0, 200, 5)]
+
+
+class KupuCacheTest(unittest.TestCase):
+    """This class checks the word cache classifies sentences the same as taumahi does."""
+
+    def test_same_as_taumahi(self):
+        cache = KupuCache()
+        for tohutō in (None, False, True):
+            for sentence in generated_sentences():
+                expected = taumahi.kupu_ratios(sentence) if tohutō is None else \
+                    taumahi.kupu_ratios(sentence, tohutō=tohutō)
+                self.assertEqual(cache.kupu_ratios(sentence, tohutō), expected)
+        self.assertTrue(cache.by_word)
+        self.assertGreater(cache.stats()['hit rate'], 50)
+
+    def test_bounded(self):
+        cache = KupuCache(maxsize=10)
+        for sentence in generated_sentences()[:100]:
+            cache.kupu_ratios(sentence)
+        self.assertLessEqual(len(cache.words), 10)
+        self.assertLessEqual(len(cache.decisions), 10)
+
+    def test_drain_and_merge(self):
+        worker, parent = KupuCache(), KupuCache()
+        for sentence in generated_sentences()[:100]:
+            worker.kupu_ratios(sentence)
+        drained = worker.drain()
+        # The process that drained its own words doesn't add them again:
+        worker.merge(drained)
+        self.assertEqual(worker.stats()['hits'] + worker.stats()['misses'], sum(drained[2:]))
+        parent.merge((os.getpid() + 1,) + drained[1:])
+        self.assertEqual(dict(parent.words), dict(worker.words))
+        self.assertEqual(parent.stats()['misses'], worker.stats()['misses'])
+        self.assertEqual(worker.drain()[1:], ([], 0, 0))
+
+    def test_save_and_load(self):
+        cache, loaded = KupuCache(), KupuCache()
+        for sentence in generated_sentences()[:100]:
+            cache.kupu_ratios(sentence, False)
+        with TemporaryDirectory() as directory:
+            filename = join(directory, 'kupu_words.json.gz')
+            cache.save(filename)
+            loaded.load(filename)
+        self.assertEqual(dict(loaded.words), dict(cache.words))
+
+
+if __name__ == '__main__':
+    unittest.main()
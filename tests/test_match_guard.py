@@ -0,0 +1,81 @@
+# import libraries
+import io
+import json
+import re
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import mock
+from nga_tautohetohe_hansard import match_guard
+from nga_tautohetohe_hansard.match_guard import MatchGuard, quarantine
+
+# A pattern that backtracks exponentially on a run of a's that doesn't end the text:
+catastrophic = re.compile(r'(a|aa)+$')
+pathological = 'a' * 60 + 'b'
+
+
+class MatchGuardTest(unittest.TestCase):
+    """This class checks a match that runs out of time is abandoned and its input quarantined, in the main thread
+    and in other threads."""
+
+    def setUp(self):
+        quarantine.drain()
+        patcher = mock.patch.object(match_guard, 'match_timeout', 0.2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def guarded_match(self, guard, pattern, text, **where):
+        with redirect_stdout(io.StringIO()):
+            return guard.match(pattern, text, 'test', **where)
+
+    def test_matches_in_time(self):
+        guard = MatchGuard('1')
+        match = self.guarded_match(guard, re.compile(r'(\w+) (\w+)'), 'kia ora koutou')
+        self.assertEqual(match.groups(), ('kia', 'ora'))
+        self.assertIsNone(self.guarded_match(guard, catastrophic, 'b'))
+        self.assertEqual((guard.timeouts, quarantine.drain()), (0, []))
+
+    def test_timeout_quarantines_input(self):
+        guard = MatchGuard('1', budget=0.5)
+        self.assertIsNone(self.guarded_match(guard, catastrophic, pathological, page='12'))
+        self.assertEqual(guard.timeouts, 1)
+        self.assertLess(guard.budget, 0.35)
+        entry, = quarantine.drain()
+        self.assertEqual((entry['volume'], entry['page'], entry['pattern'], entry['text']),
+                         ('1', '12', 'test', pathological))
+
+        # Once the budget is spent, matches only get the minimum time:
+        for _ in range(3):
+            self.guarded_match(guard, catastrophic, pathological)
+        self.assertLessEqual(guard.budget, 0)
+        self.assertLess(quarantine.drain()[-1]['seconds'], 0.2)
+
+    def test_timeout_outside_main_thread(self):
+        guard = MatchGuard('2')
+        with ThreadPoolExecutor(1) as executor:
+            match = executor.submit(self.guarded_match, guard, re.compile(r'(\w+) (\w+)?'), 'kia ').result()
+            self.assertEqual((match.group(0, 1), match.groups(), match.span(1)), (('kia ', 'kia'), ('kia', None),
+                                                                                  (0, 3)))
+            self.assertIsNone(executor.submit(self.guarded_match, guard, catastrophic, pathological).result())
+            # The helper process is started again after a timeout:
+            self.assertIsNotNone(executor.submit(self.guarded_match, guard, catastrophic, 'aa').result())
+        self.assertEqual(guard.timeouts, 1)
+        self.assertEqual(len(quarantine.drain()), 1)
+
+    def test_flush(self):
+        guard = MatchGuard('3')
+        self.guarded_match(guard, catastrophic, pathological, date='3 July 1870')
+        with TemporaryDirectory() as directory:
+            filename = join(directory, 'hansardquarantine.jsonl')
+            with mock.patch.object(match_guard, 'quarantine_filename', filename):
+                quarantine.flush()
+                quarantine.flush()
+            with open(filename, 'r', encoding='utf8') as f:
+                entries = [json.loads(line) for line in f]
+        self.assertEqual([(entry['volume'], entry['date']) for entry in entries], [('3', '3 July 1870')])
+
+
+if __name__ == '__main__':
+    unittest.main()
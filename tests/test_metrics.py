@@ -0,0 +1,31 @@
+# import libraries
+import io
+import os
+import subprocess
+import sys
+import unittest
+from contextlib import redirect_stdout
+from nga_tautohetohe_hansard.metrics import progress, read_verbosity
+
+
+class VerbosityTest(unittest.TestCase):
+    """This class checks the HANSARD_VERBOSITY environment variable is read without stopping the scrapers."""
+
+    def test_levels(self):
+        self.assertEqual([read_verbosity(v) for v in (None, '0', '2', ' 1 ')], [progress, 0, 2, 1])
+
+    def test_not_a_number(self):
+        with redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(read_verbosity('debug'), progress)
+        self.assertIn("'debug'", out.getvalue())
+
+    def test_import(self):
+        env = {**os.environ, 'HANSARD_VERBOSITY': 'verbose'}
+        result = subprocess.run([sys.executable, '-c', 'from nga_tautohetohe_hansard.metrics import verbosity; '
+                                                       'print(verbosity)'], env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.splitlines()[-1], str(progress))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# import libraries
+import csv
+import unittest
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+from nga_tautohetohe_hansard import page_store
+from nga_tautohetohe_hansard.page_store import PageStore, convert_csv, open_pages, pages_digest, write_page_store
+
+# Pages in the test volume, enough for a few blocks and a part filled last block:
+num_pages = 3 * page_store.block_pages + 5
+
+
+def page_rows():
+    return [{'retrieved': '2018-01-01 00:00:00', 'url': f'https://babel.hathitrust.org/cgi/pt?id=v1;seq={n}',
+             'page': str(n), 'text': f'Page {n}\nKo te "whare" tēnei,\r\nē hoa.'} for n in range(1, num_pages + 1)]
+
+
+class PageStoreTest(unittest.TestCase):
+    """This class checks any page of a page store can be read on its own, and that converting a volume csv keeps
+    every row."""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.filepath = join(self.directory.name, '1.pages')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_random_access(self):
+        for codec in {'zlib', page_store.default_codec}:
+            write_page_store(self.filepath, page_rows(), codec=codec)
+            rows = page_rows()
+            with PageStore(self.filepath) as store:
+                self.assertEqual(len(store), num_pages)
+                # Pages either side of block boundaries, read out of order:
+                for i in (17, 0, num_pages - 1, 15, 16, 31, 32, 3):
+                    self.assertEqual(store[i], rows[i])
+                self.assertEqual(store[-1], rows[-1])
+                self.assertEqual(store[-num_pages], rows[0])
+                for i in (num_pages, -num_pages - 1):
+                    with self.assertRaises(IndexError):
+                        store[i]
+                self.assertEqual(list(store), rows)
+
+    def test_page_ranges(self):
+        write_page_store(self.filepath, page_rows())
+        rows = page_rows()
+        with PageStore(self.filepath) as store:
+            for start, stop in ((0, 16), (15, 33), (40, None), (5, 5), (50, 1000)):
+                self.assertEqual(list(store.pages(start, stop)), rows[start:stop])
+
+    def test_empty(self):
+        write_page_store(self.filepath, [])
+        with PageStore(self.filepath) as store:
+            self.assertEqual((len(store), list(store)), (0, []))
+
+    def test_not_a_page_store(self):
+        with open(self.filepath, 'wb') as f:
+            f.write(b'retrieved,url,page,text\r\n')
+        with self.assertRaises(ValueError):
+            PageStore(self.filepath)
+
+    def test_convert_csv(self):
+        csv_path = join(self.directory.name, '1.csv')
+        with open(csv_path, 'w', newline='', encoding='utf8') as f:
+            writer = csv.DictWriter(f, page_store.page_fieldnames)
+            writer.writeheader()
+            writer.writerows(page_rows())
+        csv_digest = pages_digest(csv_path)
+        self.assertEqual(convert_csv(csv_path), self.filepath)
+        self.assertFalse(exists(csv_path))
+        self.assertEqual(list(open_pages(self.filepath)), page_rows())
+        self.assertEqual(pages_digest(self.filepath), csv_digest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# import libraries
+import io
+import random
+import unittest
+from contextlib import redirect_stdout
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import mock
+import taumahi
+from nga_tautohetohe_hansard import benchmark, pdf_scraper
+from nga_tautohetohe_hansard.kupu_cache import kupu_cache
+
+# Sitting days generated into one long day, enough for slicing the day to have been slow:
+long_day_days = 20
+
+
+def slicing_get_speeches(txt):
+    # get_speeches as it was before it scanned by offset, slicing each paragraph off the rest of the day:
+    speeches = []
+    paragraphs = []
+    speaker = ''
+    while True:
+        kaikōrero = pdf_scraper.new_speaker.match(txt)
+        if kaikōrero:
+            name = pdf_scraper.name_behaviour.match(kaikōrero.group(3))
+            if name:
+                speeches.append(pdf_scraper.Speech(speaker, pdf_scraper.process_sentences(paragraphs)))
+                paragraphs = []
+                speaker = name.group(2)
+                txt = txt[kaikōrero.end():]
+
+        p, txt = taumahi.get_paragraph(txt)
+        paragraphs.append(p)
+        if not txt:
+            speeches.append(pdf_scraper.Speech(speaker, pdf_scraper.process_sentences(paragraphs)))
+            break
+    return speeches
+
+
+def summarise(speeches):
+    return [(speech.kaikōrero, [(u.txt, u.condition, u.ratios) for u in speech.paragraphs]) for speech in speeches]
+
+
+def generated_volume(days=benchmark.pdf_days, one_day=False):
+    # A generated pdftotext volume, cleaned as process_volume reads it. one_day drops all but the first date, so
+    # the whole volume is read as one long sitting day:
+    text = benchmark.pdf_volume(random.Random(benchmark.seed), days)
+    if one_day:
+        first = pdf_scraper.debate_date.search(text)
+        text = text[:first.end()] + pdf_scraper.debate_date.sub('', text[first.end():])
+    with TemporaryDirectory() as directory:
+        filepath = join(directory, 'Hansard 500.txt')
+        with open(filepath, 'w', encoding='utf8') as f:
+            f.write(text)
+        return pdf_scraper.read_volume_text(filepath)
+
+
+class GetSpeechesTest(unittest.TestCase):
+    """This class checks get_speeches splits days into the same speeches and utterances as slicing them did."""
+
+    def setUp(self):
+        kupu_cache.clear()
+
+    def test_long_day(self):
+        text = generated_volume(long_day_days, one_day=True)
+        day = text[pdf_scraper.debate_date.search(text).end():]
+        speeches = pdf_scraper.get_speeches(day)
+        self.assertGreater(len(speeches), 100)
+        self.assertEqual(summarise(speeches), summarise(slicing_get_speeches(day)))
+
+    def test_tuhituhikifile(self):
+        volume = {'name': '500', 'url': 'https://www.parliament.nz/hansard/500'}
+        text = generated_volume()
+        with redirect_stdout(io.StringIO()):
+            rows = pdf_scraper.tuhituhikifile(volume, text)
+            with mock.patch.object(pdf_scraper, 'get_speeches', slicing_get_speeches):
+                expected = pdf_scraper.tuhituhikifile(volume, text)
+        self.assertEqual(len(rows[0]), benchmark.pdf_days)
+        self.assertTrue(rows[1])
+        self.assertEqual(rows, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# import libraries
+import asyncio
+import unittest
+from unittest import mock
+from nga_tautohetohe_hansard import rate_limiter
+from nga_tautohetohe_hansard.rate_limiter import AdaptiveRateLimiter
+
+host = 'babel.hathitrust.org'
+
+
+class AdaptiveRateLimiterTest(unittest.TestCase):
+    """This class checks the additive increase and multiplicative decrease of each host's request rate."""
+
+    def setUp(self):
+        self.limiter = AdaptiveRateLimiter(initial_rate=10, min_rate=1, max_rate=12, increase=2, decrease=0.5)
+        self.now = 1000.0
+        patcher = mock.patch.object(rate_limiter.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_additive_increase(self):
+        self.limiter.record(host, 200)
+        self.assertEqual(self.limiter.rate(host), 10.2)
+        for _ in range(100):
+            self.limiter.record(host, 200)
+        self.assertEqual(self.limiter.rate(host), 12)
+
+    def test_multiplicative_decrease(self):
+        self.limiter.record(host, 503)
+        self.assertEqual(self.limiter.rate(host), 5)
+        # A burst of failures within a second is cut once:
+        self.limiter.record(host, 429)
+        self.limiter.record(host, error=ConnectionResetError())
+        self.assertEqual(self.limiter.rate(host), 5)
+        for _ in range(5):
+            self.now += 1
+            self.limiter.record(host, error=asyncio.TimeoutError())
+        self.assertEqual(self.limiter.rate(host), 1)
+        stats = self.limiter.stats()[host]
+        self.assertEqual((stats['errors'], stats['timeouts'], stats[503], stats[429]), (8, 5, 1, 1))
+
+    def test_client_errors_dont_slow_down(self):
+        self.limiter.record(host, 404)
+        self.assertEqual(self.limiter.rate(host), 10)
+        self.assertEqual(self.limiter.stats()[host]['errors'], 1)
+
+    def test_hosts_are_independent(self):
+        self.limiter.record(host, 503)
+        self.assertEqual(self.limiter.rate('www.parliament.nz'), 10)
+
+    def test_retry_after(self):
+        self.limiter.record(host, 429, retry_after=3)
+        with mock.patch.object(rate_limiter.time, 'sleep') as sleep:
+            self.limiter.acquire(host)
+        self.assertAlmostEqual(sleep.call_args[0][0], 3.2)
+
+    def test_burst(self):
+        limiter = AdaptiveRateLimiter(initial_rate=10, burst=2)
+        with mock.patch.object(rate_limiter.time, 'sleep') as sleep:
+            for _ in range(3):
+                limiter.acquire(host)
+            self.assertEqual(len(sleep.call_args_list), 1)
+            self.assertAlmostEqual(sleep.call_args[0][0], 0.1)
+            # Tokens refill at the host's rate:
+            self.now += 1
+            limiter.acquire(host)
+            self.assertEqual(len(sleep.call_args_list), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# import libraries
+import io
+import time
+import unittest
+from contextlib import redirect_stdout
+from threading import Lock
+from nga_tautohetohe_hansard.stage_scheduler import Stage, run_stages
+
+
+class StageSchedulerTest(unittest.TestCase):
+    """This class checks stages start once the stages they wait for finish, and that failures stop the stages
+    after them."""
+
+    def setUp(self):
+        self.events = []
+        self.lock = Lock()
+
+    def step(self, name, seconds=0, error=None):
+        def run():
+            with self.lock:
+                self.events.append(f'start {name}')
+            time.sleep(seconds)
+            with self.lock:
+                self.events.append(f'end {name}')
+            if error:
+                raise error
+        return run
+
+    def run_stages(self, stages):
+        with redirect_stdout(io.StringIO()):
+            return run_stages(stages)
+
+    def test_dependency_order(self):
+        done = self.run_stages([
+            Stage('merge', self.step('merge'), after=['ocr', 'pdf']),
+            Stage('ocr', self.step('ocr', 0.2), after=['index']),
+            Stage('pdf', self.step('pdf'), after=['index']),
+            Stage('index', self.step('index')),
+        ])
+        self.assertEqual(sorted(done), ['index', 'merge', 'ocr', 'pdf'])
+        self.assertEqual(self.events[:2], ['start index', 'end index'])
+        self.assertEqual(self.events[-2:], ['start merge', 'end merge'])
+        # Stages that don't wait for each other run at the same time:
+        self.assertLess(self.events.index('start pdf'), self.events.index('end ocr'))
+
+    def test_failure_skips_later_stages(self):
+        error = RuntimeError('download failed')
+        stages = [
+            Stage('download', self.step('download', error=error)),
+            Stage('extract', self.step('extract'), after=['download']),
+            Stage('merge', self.step('merge'), after=['extract', 'html']),
+            Stage('html', self.step('html', 0.1)),
+        ]
+        with self.assertRaises(RuntimeError) as raised:
+            self.run_stages(stages)
+        self.assertIs(raised.exception, error)
+        # The stage that didn't depend on the failure still finished:
+        self.assertIn('end html', self.events)
+        self.assertNotIn('start extract', self.events)
+        self.assertNotIn('start merge', self.events)
+        self.assertIs(stages[0].error, error)
+
+    def test_unknown_and_circular_dependencies(self):
+        with self.assertRaises(ValueError):
+            self.run_stages([Stage('a', self.step('a'), after=['missing'])])
+        with self.assertRaises(ValueError):
+            self.run_stages([Stage('a', self.step('a'), after=['b']), Stage('b', self.step('b'), after=['a'])])
+        self.assertEqual(self.events, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# import libraries
+import csv
+import unittest
+from os.path import join
+from tempfile import TemporaryDirectory
+from nga_tautohetohe_hansard.state_store import StateStore, volumeindex_fieldnames
+
+
+def index_rows():
+    return [{'retrieved': '2018-01-01 00:00:00', 'url': f'https://babel.hathitrust.org/cgi/pt?id=v{n};seq=1',
+             'name': str(n), 'period': '3 July 1870', 'session': 'I', 'format': 'OCR',
+             'downloaded': 'True' if n < 3 else '', 'processed': ''} for n in range(1, 6)]
+
+
+def read_csv(filename):
+    with open(filename, 'r', newline='', encoding='utf8') as f:
+        return list(csv.DictReader(f))
+
+
+class StateStoreTest(unittest.TestCase):
+    """This class checks the state store takes over a volume index csv and exports it back unchanged."""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.index_filename = join(self.directory.name, 'hansardvolumeindex.csv')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def store(self):
+        return StateStore(join(self.directory.name, 'hansardstate.sqlite'), self.index_filename)
+
+    def write_index(self, rows, fieldnames=volumeindex_fieldnames):
+        with open(self.index_filename, 'w', newline='', encoding='utf8') as f:
+            writer = csv.DictWriter(f, fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def test_round_trip(self):
+        self.write_index(index_rows())
+        store = self.store()
+        self.assertEqual(store.volume_rows(), index_rows())
+        exported = join(self.directory.name, 'exported.csv')
+        store.export_csv(exported)
+        self.assertEqual(read_csv(exported), index_rows())
+
+    def test_updates(self):
+        self.write_index(index_rows())
+        store = self.store()
+        store.set_volume('4', downloaded=True, processed=False)
+        store.add_volume({'name': '1', 'format': 'PDF'})
+        store.add_volume({'name': '6', 'format': 'OCR', 'downloaded': None})
+        rows = store.volume_rows()
+        self.assertEqual([row['name'] for row in rows], ['1', '2', '3', '4', '5', '6'])
+        self.assertEqual(rows[0]['format'], 'OCR')
+        self.assertEqual((rows[3]['downloaded'], rows[3]['processed']), ('True', ''))
+        self.assertEqual(rows[5]['downloaded'], '')
+
+    def test_legacy_spelling(self):
+        rows = [{('retreived' if k == 'retrieved' else k): v for k, v in row.items()} for row in index_rows()]
+        self.write_index(rows, ['retreived'] + volumeindex_fieldnames[1:])
+        self.assertEqual(self.store().volume_rows(), index_rows())
+
+    def test_reimport_overwrites_status(self):
+        self.write_index(index_rows())
+        store = self.store()
+        store.set_volume('1', downloaded=False)
+        store.import_csv()
+        self.assertEqual(store.volume_rows()[0]['downloaded'], 'True')
+
+    def test_days(self):
+        store = self.store()
+        store.set_day('https://www.parliament.nz/a', '600', 'HTML', '2003-2-11', 'processed')
+        store.set_day('https://www.parliament.nz/b', '601', 'HTML', '2003-2-12', 'processed')
+        self.assertEqual([day['url'] for day in store.day_rows('601')], ['https://www.parliament.nz/b'])
+        self.assertEqual(len(store.day_rows()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
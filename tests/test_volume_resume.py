@@ -0,0 +1,134 @@
+# import libraries
+import csv
+import io
+import os
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import mock
+from nga_tautohetohe_hansard import ocr_html_scraper
+from nga_tautohetohe_hansard.ocr_html_scraper import find_last_row, open_volume_file, previous_page, read_last_page
+from nga_tautohetohe_hansard.page_store import page_fieldnames
+
+# A line of OCR text that looks like the start of a row:
+fake_row = '2018-01-01 00:00:00,/u,1999,'
+
+
+def page_row(page, text=None):
+    return {'retrieved': datetime(2018, 1, 1), 'url': f'/cgi/pt?id=mdp.39015;seq={page + 10}', 'page': page,
+            'text': text if text is not None else f'Page {page}\nKia ora koutou'}
+
+
+def write_volume(filepath, rows, header=page_fieldnames):
+    with open(filepath, 'w', newline='', encoding='utf8') as txt_file:
+        csv.writer(txt_file).writerow(header)
+        writer = csv.DictWriter(txt_file, page_fieldnames)
+        writer.writerows(rows)
+    return os.path.getsize(filepath)
+
+
+class ReadLastPageTest(unittest.TestCase):
+    """This class checks volume csvs are resumed from their last complete row, however the file ends."""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.filepath = join(self.directory.name, '1.csv')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_complete_file(self):
+        size = write_volume(self.filepath, [page_row(page) for page in range(1, 11)])
+        self.assertEqual(read_last_page(self.filepath), ('/cgi/pt?id=mdp.39015;seq=20', 10, size))
+
+    def test_truncated_last_row(self):
+        size = write_volume(self.filepath, [page_row(page) for page in range(1, 11)])
+        with open(self.filepath, 'r+b') as txt_file:
+            txt_file.truncate(size - 5)
+        url, page, offset = read_last_page(self.filepath)
+        self.assertEqual((url, page), ('/cgi/pt?id=mdp.39015;seq=19', 9))
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(open_volume_file(self.filepath), (page_fieldnames, url, page))
+        self.assertEqual(os.path.getsize(self.filepath), offset)
+
+    def test_quoted_newlines(self):
+        # Lines inside the text that look like rows, including one with a page url, aren't taken for rows:
+        text = f'Kia ora\n{fake_row}\n"Quoted" words\n2018-01-01 00:00:00,/cgi/pt?id=x;seq=999,999,"x"\n'
+        size = write_volume(self.filepath, [page_row(page, text) for page in range(1, 6)])
+        self.assertEqual(read_last_page(self.filepath), ('/cgi/pt?id=mdp.39015;seq=15', 5, size))
+
+    def test_page_gaps(self):
+        # Pages without text aren't written, so page numbers can skip:
+        size = write_volume(self.filepath, [page_row(page) for page in (1, 2, 5, 9)])
+        self.assertEqual(read_last_page(self.filepath), ('/cgi/pt?id=mdp.39015;seq=19', 9, size))
+
+    def test_header_only(self):
+        write_volume(self.filepath, [])
+        self.assertIsNone(read_last_page(self.filepath))
+        self.assertEqual(open_volume_file(self.filepath), (page_fieldnames, '', 0))
+        self.assertEqual(os.listdir(self.directory.name), ['1.csv'])
+
+    def test_single_row(self):
+        size = write_volume(self.filepath, [page_row(1, f'Kia ora\n{fake_row}')])
+        self.assertEqual(read_last_page(self.filepath), ('/cgi/pt?id=mdp.39015;seq=11', 1, size))
+
+    def test_legacy_header(self):
+        size = write_volume(self.filepath, [page_row(1)], ['retreived', 'url', 'page', 'text'])
+        self.assertEqual(read_last_page(self.filepath), ('/cgi/pt?id=mdp.39015;seq=11', 1, size))
+
+    def test_unreadable_file_moved_aside(self):
+        with open(self.filepath, 'w', encoding='utf8') as txt_file:
+            txt_file.write('not,a,volume\ncsv\n')
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(open_volume_file(self.filepath), (page_fieldnames, '', 0))
+        aside = [f for f in os.listdir(self.directory.name) if f.endswith('.unreadable')]
+        self.assertEqual(len(aside), 1)
+        with open(join(self.directory.name, aside[0]), encoding='utf8') as txt_file:
+            self.assertEqual(txt_file.read(), 'not,a,volume\ncsv\n')
+        with open(self.filepath, encoding='utf8') as txt_file:
+            self.assertEqual(txt_file.read().strip(), ','.join(page_fieldnames))
+
+    def test_reads_back_in_growing_blocks(self):
+        size = write_volume(self.filepath, [page_row(page, 'Kia ora\n' * 50) for page in range(1, 21)])
+        with mock.patch.object(ocr_html_scraper, 'tail_block', 64):
+            self.assertEqual(read_last_page(self.filepath), ('/cgi/pt?id=mdp.39015;seq=30', 20, size))
+
+
+class FindLastRowTest(unittest.TestCase):
+    """This class checks the search for the last row and the row before it within a block of a volume csv."""
+
+    def rows(self, pages, text='Kia ora'):
+        txt_file = io.StringIO(newline='')
+        csv.DictWriter(txt_file, page_fieldnames).writerows(page_row(page, text) for page in pages)
+        return txt_file.getvalue().encode()
+
+    def test_needs_more_of_the_file(self):
+        # The row before the last one may be further back than the block:
+        data = b'...end of an earlier row"\r\n' + self.rows([7])
+        self.assertEqual(find_last_row(data, whole_file=False), (False, None, None))
+
+    def test_whole_file_without_rows(self):
+        self.assertEqual(find_last_row(b'retrieved,url,page,text\r\n', whole_file=True), (True, None, None))
+
+    def test_row_after_previous_row(self):
+        data = b'\n' + self.rows([7, 8])
+        found, row, row_end = find_last_row(data, whole_file=False)
+        self.assertTrue(found)
+        self.assertEqual((row['page'], row_end), ('8', len(data)))
+
+    def test_previous_page(self):
+        header = b'retrieved,url,page,text\r\n'
+        data = header + self.rows([1], f'Kia ora\n{fake_row}\n"x"')
+        self.assertEqual(previous_page(data, [], len(header), whole_file=True), 0)
+        # The fake row start inside the quoted text is skipped over by quote parity:
+        starts = [match.start() for match in ocr_html_scraper.row_start_pattern.finditer(data)]
+        self.assertEqual(len(starts), 2)
+        self.assertEqual(previous_page(data + self.rows([2]), starts, len(data), whole_file=True), 1)
+        self.assertEqual(previous_page(b'junk\n' + data[len(header):], [], 5, whole_file=True), -1)
+        self.assertIsNone(previous_page(data[len(header):], [], 0, whole_file=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
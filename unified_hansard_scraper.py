@@ -1,11 +1,37 @@
-from nga_tautohetohe_hansard import ocr_html_scraper, ocr_text_cleaner, pdf_scraper, html_scraper
+from functools import partial
+from nga_tautohetohe_hansard import corpus_writer, ocr_html_scraper, ocr_text_cleaner, pdf_scraper, html_scraper
+from nga_tautohetohe_hansard.match_guard import quarantine
+from nga_tautohetohe_hansard.metrics import metrics
+from nga_tautohetohe_hansard.profiler import profile
+from nga_tautohetohe_hansard.stage_scheduler import Stage, run_stages
+
+
+def update_volume_index():
+    # Both extractors read the volume index, so it is filled in before either starts, with the OCR volumes first:
+    ocr_html_scraper.update_volume_index()
+    pdf_scraper.update_volume_index()
+
+
+# Each stage only waits for the stages it needs, so the PDF and HTML debates are processed while the
+# OCR volumes download. Stages write per volume partitions, which are merged into the corpus once at the end:
+stages = [
+    Stage('Partition existing corpus', corpus_writer.split_combined_files),
+    Stage('Volume index', update_volume_index, after=['Partition existing corpus']),
+    Stage('OCR download', ocr_html_scraper.main, after=['Volume index']),
+    Stage('OCR extraction', partial(ocr_text_cleaner.main, merge=False), after=['OCR download']),
+    Stage('PDF extraction', partial(pdf_scraper.main, merge=False), after=['Volume index']),
+    Stage('HTML scraping', partial(html_scraper.main, merge=False), after=['Partition existing corpus']),
+    Stage('Merge', corpus_writer.merge_partitions, after=['OCR extraction', 'PDF extraction', 'HTML scraping']),
+]
 
 
 def main():
-    ocr_html_scraper.main()
-    ocr_text_cleaner.main()
-    pdf_scraper.main()
-    html_scraper.main()
+    try:
+        run_stages(stages)
+    finally:
+        metrics.export()
+        quarantine.flush()
+        profile.write_report()
     print('All te reo Hansard debates corpus aggregated')
 
 